@@ -0,0 +1,186 @@
+#!/usr/bin/python
+#
+# Behaviour checks for the drivers, run against their mock APIs. Each check
+# starts a fresh mock for every driver it covers, runs the driver against it
+# and reports PASS, or FAIL with what went wrong.
+#
+# Usage: checks.py [--drivers=docker,google,vcloud] [check ...]
+
+import os
+import re
+import sys
+import json
+import time
+import shutil
+import tempfile
+import subprocess
+
+from fleet import BENCHES, ROOT
+
+# The image and size arguments each driver reconciles to
+IMAGE_ARGS = {"docker": ["--imageid=vtm/node:latest"],
+    "google": ["--imageid=vtm", "--sizeid=n1-standard-1"],
+    "vcloud": ["--imageid=template", "--sizeid=any"]}
+
+CHECKS = []
+
+
+class CheckFailed(Exception):
+    pass
+
+
+def check(*drivers):
+    # Registers a check for the drivers named, or every driver
+    def register(func):
+        func.drivers = drivers
+        CHECKS.append(func)
+        return func
+    return register
+
+
+def expect(condition, message, *args):
+    if not condition:
+        raise CheckFailed(message.format(*args))
+
+
+def execute(bench, action, *args):
+    # Returns the exit code, stdout and stderr of a driver action
+    proc = subprocess.Popen([sys.executable, os.path.join(ROOT, bench.driver), action] +
+        list(args) + bench.args(), stdout=subprocess.PIPE, stderr=subprocess.PIPE, env=bench.env)
+    out, err = proc.communicate()
+    return proc.returncode, out, err
+
+
+def run(bench, action, *args):
+    code, out, err = execute(bench, action, *args)
+    expect(code == 0, "{} exited {}: {}", action, code, err.strip())
+    return json.loads(out)
+
+
+def plan(bench, name, *args):
+    reply = run(bench, "reconcile", "--dryrun", *(IMAGE_ARGS[name] + list(args)))
+    nodes = reply["ReconcileResponse"]["nodes"]
+    return (sorted(node["name"] for node in nodes if node["action"] == "create"),
+        sorted(node["name"] for node in nodes if node["action"] == "destroy"))
+
+
+@check()
+def reconcile_pool(name, bench):
+    # Nodes outside the pool are neither counted nor destroyed
+    bench.add_node("vtm-lb")
+    create, destroy = plan(bench, name, "--count=2", "--prefix=web")
+    expect((create, destroy) == (["web0", "web1"], []),
+        "--prefix=web planned create {} destroy {}", create, destroy)
+    create, destroy = plan(bench, name, "--count=2")
+    expect(create == [] and len(destroy) == 1 and re.match("^node[0-2]$", destroy[0]),
+        "--prefix=node planned create {} destroy {}", create, destroy)
+
+
+@check()
+def cached_delta(name, bench):
+    # A --deltasince poll answered by the status cache reports the nodes
+    # destroyed since, once a background refresh has seen them go
+    stale = "--statusStale=60"
+    gone = run(bench, "status", stale)["NodeStatusResponse"]["nodes"][0]
+    run(bench, "destroynode", *bench.destroy_args(gone))
+    since = int(time.time())
+    time.sleep(1.1)
+    run(bench, "status", stale, "--deltasince={}".format(since))
+    time.sleep(1.5)
+    nodes = run(bench, "status", stale, "--deltasince={}".format(since))["NodeStatusResponse"]["nodes"]
+    expect([(node["name"], node["status"]) for node in nodes] == [(gone["name"], "destroyed")],
+        "delta poll answered {}", [(node["name"], node["status"]) for node in nodes])
+
+
+@check("vcloud")
+def daemon_output(name, bench):
+    # What run_parallel workers write reaches the reply of a request served
+    # by the daemon. Here the status of each vApp is read by its own worker,
+    # and each one fails for want of a network.
+    cell = bench.server.cell
+    with cell.lock:
+        cell.vapps.append("vapp-2")
+        cell.new_vm("node3", "vapp-2", status=4, deployed=True)
+    with open(bench.cfg, "w") as cfg:
+        cfg.write("apiHost {}\nuser bench\npass bench\norg org\nvdc vdc\n".format(cell.base))
+        cfg.write("vapps vapp,vapp2\nipMode POOL\nsizeid any\n")
+
+    devnull = open(os.devnull, "w")
+    daemon = subprocess.Popen([sys.executable, os.path.join(ROOT, bench.driver), "daemon"] +
+        bench.args(), stdout=devnull, stderr=devnull, env=bench.env)
+    try:
+        start = time.time()
+        while not os.path.exists(os.path.join(bench.workdir, "vcd.sock")):
+            expect(time.time() - start < 10, "daemon did not start")
+            time.sleep(0.1)
+        code, out, err = execute(bench, "status")
+        expect(code == 1 and "ERROR - You must provide atleast one" in err,
+            "daemon replied {} with stderr {!r}", code, err)
+    finally:
+        daemon.terminate()
+        daemon.wait()
+        devnull.close()
+
+
+@check("vcloud")
+def recompose_timeout(name, bench):
+    # A recompose which outlasts the task timeout fails each of its nodes
+    # cleanly, rather than ending the action with a traceback
+    bench.server.cell.task_time = 3.0
+    code, out, err = execute(bench, "createnode", "--name=web0,web1", "--taskTimeout=1",
+        "--taskTimeoutPerVM=0", *IMAGE_ARGS[name])
+    expect(code == 1 and "Traceback" not in err and "ERROR - Failed to create web1" in err,
+        "createnode exited {} with stderr {!r}", code, err)
+    nodes = json.loads(out)["CreateNodeResponse"]["nodes"]
+    expect([(node["name"], node["status"]) for node in nodes] == [("web0", "failed"),
+        ("web1", "failed")], "createnode answered {}", nodes)
+
+
+@check("google")
+def spot_stockout(name, bench):
+    # A spot insert whose operation fails for want of capacity is made again
+    # on standard capacity
+    zone = bench.server.zone
+    zone.spot_stockout = True
+    run(bench, "createnode", "--spot=100", "--name=web0", "--imageid=vtm",
+        "--sizeid=n1-standard-1")
+    run(bench, "reconcile", "--spot=100", "--count=3", "--prefix=web", *IMAGE_ARGS[name])
+    with zone.lock:
+        capacity = dict((key, zone.instances[key]["labels"].get("vtm-capacity"))
+            for key in zone.instances.keys() if key.startswith("web"))
+    expect(capacity == {"web0": "standard", "web1": "standard", "web2": "standard"},
+        "spot stockout left {}", capacity)
+
+
+def main():
+    drivers = ["docker", "google", "vcloud"]
+    names = []
+    for arg in sys.argv[1:]:
+        kvp = re.search("--drivers=(.*)", arg)
+        if kvp != None:
+            drivers = kvp.group(1).split(",")
+        else:
+            names.append(arg)
+
+    failed = 0
+    for func in CHECKS:
+        if len(names) > 0 and func.__name__ not in names:
+            continue
+        for name in drivers:
+            if len(func.drivers) > 0 and name not in func.drivers:
+                continue
+            workdir = tempfile.mkdtemp(prefix="driver-check-")
+            bench = BENCHES[name](workdir, 3, 0.0)
+            try:
+                func(name, bench)
+                print "PASS  {:<8} {}".format(name, func.__name__)
+            except CheckFailed as e:
+                failed += 1
+                print "FAIL  {:<8} {}: {}".format(name, func.__name__, e)
+            finally:
+                bench.stop()
+                shutil.rmtree(workdir)
+    sys.exit(1 if failed > 0 else 0)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,205 @@
+#!/usr/bin/python
+#
+# Runs the status, createnode and destroynode actions of each driver against
+# its mock API for a range of fleet sizes, and reports the latency of each
+# action and the requests it made.
+#
+# Usage: fleet.py [--drivers=docker,google,vcloud] [--sizes=10,100,1000,5000]
+#                 [--latency=SECONDS]
+
+import os
+import re
+import sys
+import json
+import time
+import shutil
+import tempfile
+import threading
+import subprocess
+
+from mockdocker import MockDocker
+from mockgce import MockGCE
+from mockvcloud import MockCell
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+
+
+class Bench(object):
+
+    # Starts a mock API with a fleet of a given size and knows how to run
+    # the driver against it. Subclasses fill in the driver specific parts.
+
+    driver = None
+
+    def __init__(self, workdir, size, latency):
+        self.workdir = workdir
+        self.env = dict(os.environ)
+        self.env.pop("ZEUSHOME", None)
+        self.server = self.start(size, latency)
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def run(self, action, args):
+        start = time.time()
+        proc = subprocess.Popen([sys.executable, os.path.join(ROOT, self.driver), action] +
+            args + self.args(), stdout=subprocess.PIPE, stderr=subprocess.PIPE, env=self.env)
+        out, err = proc.communicate()
+        elapsed = time.time() - start
+        if proc.returncode != 0:
+            raise Exception("{} {} failed: {}".format(self.driver, action, err.strip()))
+        return elapsed, json.loads(out)
+
+    def requests(self):
+        with self.stats().lock:
+            return sum(self.stats().requests.values())
+
+
+class DockerBench(Bench):
+
+    driver = "docker/dockerScaler.py"
+
+    def start(self, size, latency):
+        server = MockDocker(0, size, latency)
+        zh = os.path.join(self.workdir, "zh")
+        for sub in ("conf/cloudcredentials", "conf/extra", "internal"):
+            os.makedirs(os.path.join(zh, "zxtm", sub))
+        with open(os.path.join(zh, "zxtm/conf/cloudcredentials/bench"), "w") as cc:
+            cc.write("cred1 bench.cfg\n")
+        with open(os.path.join(zh, "zxtm/conf/extra/bench.cfg"), "w") as cfg:
+            cfg.write("apiHost {}\nHostConfig {{}}\n".format(server.engine.base))
+        self.env["ZEUSHOME"] = zh
+        return server
+
+    def stats(self):
+        return self.server.engine
+
+    def args(self):
+        return ["--cloudcreds=bench"]
+
+    def create_args(self):
+        return ["--name=bench0", "--imageid=vtm/node:latest", "--sizeid=any"]
+
+    def destroy_args(self, node):
+        return ["--id=" + node["uniq_id"]]
+
+    def add_node(self, name):
+        engine = self.server.engine
+        with engine.lock:
+            engine.containers[engine.new_container(name, "vtm/node:latest")]["running"] = True
+
+
+class GoogleBench(Bench):
+
+    driver = "google/googledriver.py"
+
+    def start(self, size, latency):
+        server = MockGCE(0, size, latency)
+        self.auth = os.path.join(self.workdir, "gce.json")
+        with open(self.auth, "w") as auth:
+            json.dump({"token_uri": server.zone.base + "/token", "refresh_token": "bench",
+                "client_id": "bench", "client_secret": "bench"}, auth)
+        return server
+
+    def stats(self):
+        return self.server.zone
+
+    def args(self):
+        return ["--cred1=" + self.auth, "--cred2=project", "--cred3=zone",
+            "--apiHost=" + self.server.zone.base,
+            "--statefile=" + os.path.join(self.workdir, "gce.state")]
+
+    def create_args(self):
+        return ["--name=bench0", "--imageid=vtm", "--sizeid=n1-standard-1"]
+
+    def destroy_args(self, node):
+        return ["--name=" + node["name"]]
+
+    def add_node(self, name):
+        zone = self.server.zone
+        with zone.lock:
+            zone.new_instance({"name": name, "machineType": "zones/zone/machineTypes/n1-standard-1",
+                "disks": [{"initializeParams": {"sourceImage": "https://www.googleapis.com/"
+                "compute/v1/projects/project/global/images/vtm"}}]})
+
+
+class VCloudBench(Bench):
+
+    driver = "vcloud/vclouddriver.py"
+
+    def start(self, size, latency):
+        server = MockCell(0, size, latency)
+        self.cfg = os.path.join(self.workdir, "vcloud.cfg")
+        with open(self.cfg, "w") as cfg:
+            cfg.write("apiHost {}\nuser bench\npass bench\norg org\nvdc vdc\n".format(
+                server.cell.base))
+            cfg.write("vapp vapp\nprivNet net\nipMode POOL\nsizeid any\n")
+        return server
+
+    def stats(self):
+        return self.server.cell
+
+    def args(self):
+        return ["--cred1=" + self.cfg, "--statefile=" + os.path.join(self.workdir, "vcd.state")]
+
+    def create_args(self):
+        return ["--name=bench0", "--imageid=template"]
+
+    def destroy_args(self, node):
+        return ["--name=" + node["name"]]
+
+    def add_node(self, name):
+        cell = self.server.cell
+        with cell.lock:
+            cell.new_vm(name, cell.vapps[0], status=4, deployed=True)
+
+
+BENCHES = {"docker": DockerBench, "google": GoogleBench, "vcloud": VCloudBench}
+
+
+def measure(bench, action, args):
+    before = bench.requests()
+    elapsed, reply = bench.run(action, args)
+    return elapsed, bench.requests() - before, reply
+
+
+def main():
+    opts = {"drivers": "docker,google,vcloud", "sizes": "10,100,1000,5000", "latency": "0.0"}
+    for arg in sys.argv[1:]:
+        kvp = re.search("--([^=]+)=(.*)", arg)
+        if kvp != None:
+            opts[kvp.group(1)] = kvp.group(2)
+
+    print "{:<8} {:>6}  {:<14} {:>9} {:>9} {:>7}".format("driver", "nodes", "action", "seconds",
+        "requests", "nodes")
+    for name in opts["drivers"].split(","):
+        for size in [int(size) for size in opts["sizes"].split(",")]:
+            workdir = tempfile.mkdtemp(prefix="fleet-bench-")
+            bench = BENCHES[name](workdir, size, float(opts["latency"]))
+            try:
+                results = []
+                elapsed, count, reply = measure(bench, "status", [])
+                results.append(("status (cold)", elapsed, count,
+                    len(reply["NodeStatusResponse"]["nodes"])))
+                elapsed, count, reply = measure(bench, "status", [])
+                results.append(("status", elapsed, count,
+                    len(reply["NodeStatusResponse"]["nodes"])))
+                elapsed, count, reply = measure(bench, "createnode", bench.create_args())
+                node = reply["CreateNodeResponse"]["nodes"][0]
+                results.append(("createnode", elapsed, count, 1))
+                elapsed, count, reply = measure(bench, "destroynode", bench.destroy_args(node))
+                results.append(("destroynode", elapsed, count,
+                    len(reply["DestroyNodeResponse"]["nodes"])))
+            finally:
+                bench.stop()
+                shutil.rmtree(workdir)
+            for action, elapsed, count, nodes in results:
+                print "{:<8} {:>6}  {:<14} {:>9.3f} {:>9} {:>7}".format(name, size, action,
+                    elapsed, count, nodes)
+
+if __name__ == "__main__":
+    main()
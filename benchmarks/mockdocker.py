@@ -0,0 +1,181 @@
+#!/usr/bin/python
+#
+# Stand-in Docker remote API (v1.19) for exercising dockerScaler.py offline.
+#
+# Serves the container list, inspect, create, start, restart, stop, delete and
+# events endpoints used by the driver, for a configurable number of labelled
+# containers. Like the real daemon only the last 64 events are kept.
+
+import sys
+import re
+import json
+import math
+import time
+import uuid
+import threading
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from SocketServer import ThreadingMixIn
+
+
+class Engine(object):
+
+    def __init__(self, base, containers=10, latency=0.0):
+        self.base = base
+        self.latency = latency
+        self.lock = threading.Lock()
+        self.requests = {}
+        self.containers = {}
+        self.events = []
+        self.addresses = 0
+        for i in xrange(containers):
+            cid = self.new_container("node{}".format(i), "vtm/node:latest")
+            self.containers[cid]["running"] = True
+        # The fleet was started long ago
+        self.events = []
+
+    def count(self, key):
+        with self.lock:
+            self.requests[key] = self.requests.get(key, 0) + 1
+
+    def new_address(self):
+        self.addresses += 1
+        return "172.17.{}.{}".format(self.addresses / 250, self.addresses % 250 + 1)
+
+    def new_container(self, name, image):
+        cid = uuid.uuid4().hex + uuid.uuid4().hex
+        self.containers[cid] = {"name": name, "image": image, "running": False,
+            "ip": self.new_address(),
+            "created": time.strftime("%Y-%m-%dT%H:%M:%S.000000000Z", time.gmtime())}
+        self.event("create", cid)
+        return cid
+
+    def event(self, status, cid):
+        self.events.append({"status": status, "id": cid,
+            "from": self.containers[cid]["image"], "time": int(time.time())})
+        del self.events[:-64]
+
+    # Documents
+
+    def summary(self, cid):
+        c = self.containers[cid]
+        status = "Up 5 minutes" if c["running"] else "Exited (0) 5 seconds ago"
+        return {"Id": cid, "Names": ["/" + c["name"]], "Image": c["image"], "Status": status,
+            "Labels": {"name": c["name"]}}
+
+    def inspect(self, cid):
+        c = self.containers[cid]
+        return {"Id": cid, "Name": "/" + c["name"], "Created": c["created"],
+            "State": {"Running": c["running"]},
+            "NetworkSettings": {"IPAddress": c["ip"] if c["running"] else ""}}
+
+
+class Handler(BaseHTTPRequestHandler):
+
+    protocol_version = "HTTP/1.1"
+    wbufsize = -1
+
+    def log_message(self, *args):
+        pass
+
+    def reply(self, code, body=None, headers=None):
+        data = "" if body is None else json.dumps(body)
+        self.send_response(code)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def handle_request(self, method):
+        engine = self.server.engine
+        path, _, query = self.path.partition("?")
+        key = method + " " + re.sub("/containers/[0-9a-f]{64}", "/containers/{id}", path)
+        engine.count(key)
+        if engine.latency > 0:
+            time.sleep(engine.latency)
+        length = int(self.headers.getheader("Content-Length") or 0)
+        body = self.rfile.read(length) if length > 0 else ""
+        wait = self.server.quota.take() if self.server.quota is not None else None
+        if wait is not None:
+            engine.count("throttled")
+            return self.reply(429, {"error": "rate limited"},
+                {"Retry-After": str(int(math.ceil(wait)))})
+        if self.server.failing:
+            return self.reply(500, {"error": "failing"})
+        with engine.lock:
+            return self.route(engine, method, path, query, body)
+
+    def route(self, engine, method, path, query, body):
+        if path == "/v1.19/containers/json" and method == "GET":
+            return self.reply(200, [engine.summary(cid) for cid in engine.containers.keys()])
+        if path == "/v1.19/events" and method == "GET":
+            since = re.search("since=(\d+)", query)
+            until = re.search("until=(\d+)", query)
+            events = [e for e in engine.events if (since is None or e["time"] >= int(since.group(1)))
+                and (until is None or e["time"] <= int(until.group(1)))]
+            data = "".join(json.dumps(e) + "\n" for e in events)
+            self.send_response(200)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(data)))
+            self.end_headers()
+            return self.wfile.write(data)
+        if path == "/v1.19/containers/create" and method == "POST":
+            name = re.search("name=([^&]*)", query).group(1)
+            config = json.loads(body)
+            return self.reply(201, {"Id": engine.new_container(name, config["Image"]),
+                "Warnings": None})
+        m = re.match("/v1.19/containers/([0-9a-f]+)(/.*)?$", path)
+        if m is None or m.group(1) not in engine.containers:
+            return self.reply(404, {"message": "no such container"})
+        cid, action = m.group(1), m.group(2) or ""
+        if action == "/json" and method == "GET":
+            return self.reply(200, engine.inspect(cid))
+        if action in ("/start", "/restart") and method == "POST":
+            if action == "/restart":
+                engine.containers[cid]["ip"] = engine.new_address()
+            engine.containers[cid]["running"] = True
+            engine.event(action[1:], cid)
+            return self.reply(204)
+        if action == "/stop" and method == "POST":
+            engine.containers[cid]["running"] = False
+            engine.event("die", cid)
+            engine.event("stop", cid)
+            return self.reply(204)
+        if action == "" and method == "DELETE":
+            engine.event("destroy", cid)
+            del engine.containers[cid]
+            return self.reply(204)
+        return self.reply(404, {"message": "page not found"})
+
+    def do_GET(self):
+        self.handle_request("GET")
+
+    def do_POST(self):
+        self.handle_request("POST")
+
+    def do_DELETE(self):
+        self.handle_request("DELETE")
+
+
+class MockDocker(ThreadingMixIn, HTTPServer):
+
+    daemon_threads = True
+    quota = None
+    failing = False
+
+    def __init__(self, port=0, containers=10, latency=0.0):
+        HTTPServer.__init__(self, ("127.0.0.1", port), Handler)
+        self.engine = Engine("http://127.0.0.1:{}".format(self.server_address[1]),
+            containers, latency)
+
+
+def main():
+    port = int(sys.argv[1]) if len(sys.argv) > 1 else 2375
+    containers = int(sys.argv[2]) if len(sys.argv) > 2 else 10
+    server = MockDocker(port, containers)
+    sys.stderr.write("Mock Docker API on {}\n".format(server.engine.base))
+    server.serve_forever()
+
+if __name__ == "__main__":
+    main()
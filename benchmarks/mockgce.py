@@ -0,0 +1,238 @@
+#!/usr/bin/python
+#
+# Stand-in Google Compute Engine API for exercising googledriver.py offline.
+#
+# Serves the OAuth2 token endpoint and the zone instances, disks and
+# operations endpoints used by the driver, for a configurable number of
+# instances. Instance lists are paged like the real API. Operations are
+# logged for the operations list, preempt() stops a spot instance as GCE
+# would, and a delete can be made to take delete_delay seconds, leaving the
+# instance listed with its delete operation running. With spot_stockout set,
+# spot and preemptible inserts are accepted but their operation fails with
+# ZONE_RESOURCE_POOL_EXHAUSTED, as GCE reports a stockout.
+
+import sys
+import re
+import json
+import math
+import time
+import random
+import urllib
+import threading
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from SocketServer import ThreadingMixIn
+
+PAGE_SIZE = 500
+
+
+class Zone(object):
+
+    def __init__(self, base, project="project", zone="zone", instances=10, latency=0.0):
+        self.base = base
+        self.project = project
+        self.zone = zone
+        self.latency = latency
+        self.lock = threading.Lock()
+        self.requests = {}
+        self.instances = {}
+        self.operations = []
+        self.deleting = {}
+        self.delete_delay = 0.0
+        self.spot_stockout = False
+        for i in xrange(instances):
+            self.new_instance({"name": "node{}".format(i), "machineType": "zones/{}/machineTypes/"
+                "n1-standard-1".format(zone), "disks": [{"initializeParams": {"sourceImage":
+                "https://www.googleapis.com/compute/v1/projects/{}/global/images/vtm".format(project)}}]})
+
+    def count(self, key):
+        with self.lock:
+            self.requests[key] = self.requests.get(key, 0) + 1
+
+    def new_instance(self, conf):
+        sched = conf.get("scheduling", {})
+        if self.spot_stockout and (sched.get("preemptible") is True or
+                sched.get("provisioningModel") == "SPOT"):
+            op = self.operation("insert", {"id": str(random.randint(10 ** 17, 10 ** 18)),
+                "name": conf["name"]}, "RUNNING")
+            op["error"] = {"errors": [{"code": "ZONE_RESOURCE_POOL_EXHAUSTED",
+                "message": "The zone does not have enough resources available"}]}
+            return dict((key, value) for key, value in op.items() if key != "error")
+        n = len(self.instances)
+        self.instances[conf["name"]] = {"kind": "compute#instance",
+            "id": str(random.randint(10 ** 17, 10 ** 18)), "name": conf["name"],
+            "status": "RUNNING", "machineType": conf["machineType"],
+            "creationTimestamp": time.strftime("%Y-%m-%dT%H:%M:%S.000-00:00", time.gmtime()),
+            "networkInterfaces": [{"networkIP": "10.1.{}.{}".format(n / 250, n % 250 + 2),
+                "accessConfigs": [{"natIP": "198.51.{}.{}".format(n / 250, n % 250 + 2)}]}],
+            "labels": conf.get("labels", {}), "scheduling": conf.get("scheduling", {}),
+            "sourceImage": conf["disks"][0]["initializeParams"]["sourceImage"]}
+        return self.operation("insert", self.instances[conf["name"]])
+
+    def operation(self, kind, instance, status="DONE"):
+        zone = "{}/compute/v1/projects/{}/zones/{}".format(self.base, self.project, self.zone)
+        name = "operation-{}".format(len(self.operations))
+        op = {"kind": "compute#operation", "name": name, "operationType": kind,
+            "status": status, "targetId": instance["id"], "selfLink": zone + "/operations/" + name,
+            "targetLink": zone + "/instances/" + instance["name"]}
+        self.operations.append(op)
+        return op
+
+    def get_operation(self, name):
+        # A failed insert's error is reported once the operation is polled
+        for op in self.operations:
+            if op["name"] == name:
+                if "error" in op:
+                    op["status"] = "DONE"
+                return op
+
+    def preempt(self, name):
+        with self.lock:
+            self.instances[name]["status"] = "TERMINATED"
+            self.operation("compute.instances.preempted", self.instances[name])
+
+    def delete(self, instance):
+        if self.delete_delay <= 0:
+            del self.instances[instance["name"]]
+            return self.operation("delete", instance)
+        op = self.operation("delete", instance, "RUNNING")
+        self.deleting[instance["name"]] = (time.time() + self.delete_delay, op)
+        return op
+
+    def expire(self):
+        for name, (until, op) in self.deleting.items():
+            if until <= time.time():
+                del self.instances[name]
+                del self.deleting[name]
+                op["status"] = "DONE"
+
+    def list_operations(self, query):
+        # Understands the operationType and status!="DONE" terms the driver sends
+        query = urllib.unquote_plus(query)
+        kind = re.search('operationType="([^"]*)"', query)
+        running = 'status!="DONE"' in query
+        return [op for op in self.operations if (kind is None or op["operationType"] ==
+            kind.group(1)) and (not running or op["status"] != "DONE")]
+
+    def page(self, token):
+        names = sorted(self.instances.keys())
+        start = int(token or 0)
+        result = {"kind": "compute#instanceList",
+            "items": [self.instances[name] for name in names[start:start + PAGE_SIZE]]}
+        if start + PAGE_SIZE < len(names):
+            result["nextPageToken"] = str(start + PAGE_SIZE)
+        return result
+
+
+class Handler(BaseHTTPRequestHandler):
+
+    protocol_version = "HTTP/1.1"
+    wbufsize = -1
+
+    def log_message(self, *args):
+        pass
+
+    def reply(self, code, body, headers=None):
+        data = json.dumps(body)
+        self.send_response(code)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def handle_request(self, method):
+        zone = self.server.zone
+        path, _, query = self.path.partition("?")
+        key = method + " " + re.sub("/(instances|disks|operations)/[^/]+", "/\\1/{name}", path)
+        zone.count(key)
+        if zone.latency > 0:
+            time.sleep(zone.latency)
+        length = int(self.headers.getheader("Content-Length") or 0)
+        body = self.rfile.read(length) if length > 0 else ""
+        wait = self.server.quota.take() if self.server.quota is not None else None
+        if wait is not None:
+            zone.count("throttled")
+            return self.reply(429, {"error": "rate limited"},
+                {"Retry-After": str(int(math.ceil(wait)))})
+        if self.server.failing:
+            return self.reply(500, {"error": "failing"})
+
+        if path == "/token" and method == "POST":
+            return self.reply(200, {"access_token": "mock-token", "expires_in": 3600,
+                "token_type": "Bearer"})
+        if self.headers.getheader("Authorization") != "Bearer mock-token":
+            return self.reply(401, {"error": {"code": 401, "message": "Invalid Credentials"}})
+        with zone.lock:
+            zone.expire()
+            return self.route(zone, method, path, query, body)
+
+    def route(self, zone, method, path, query, body):
+        prefix = "/compute/v1/projects/{}/zones/{}".format(zone.project, zone.zone)
+        if not path.startswith(prefix):
+            if path.endswith("/global/images"):
+                return self.reply(200, {"items": [{"name": "vtm", "status": "READY",
+                    "description": "Mock vTM"}]})
+            return self.reply(404, {"error": {"code": 404, "message": "Not Found"}})
+        path = path[len(prefix):]
+        if path == "/instances" and method == "GET":
+            token = re.search("pageToken=([^&]*)", query)
+            return self.reply(200, zone.page(token.group(1) if token else None))
+        if path == "/instances" and method == "POST":
+            conf = json.loads(body)
+            if conf["name"] in zone.instances:
+                return self.reply(409, {"error": {"code": 409, "message": "Already exists"}})
+            return self.reply(200, zone.new_instance(conf))
+        if path == "/operations" and method == "GET":
+            return self.reply(200, {"items": zone.list_operations(query)})
+        m = re.match("/operations/([^/]+)$", path)
+        if m is not None and method == "GET" and zone.get_operation(m.group(1)) is not None:
+            return self.reply(200, zone.get_operation(m.group(1)))
+        m = re.match("/(instances|disks)/([^/]+)(/stop)?$", path)
+        if m is None or m.group(2) not in zone.instances:
+            return self.reply(404, {"error": {"code": 404, "message": "Not Found"}})
+        instance = zone.instances[m.group(2)]
+        if m.group(1) == "disks":
+            return self.reply(200, {"name": instance["name"], "sourceImage": instance["sourceImage"]})
+        if method == "GET":
+            return self.reply(200, instance)
+        if m.group(3) == "/stop" and method == "POST":
+            instance["status"] = "TERMINATED"
+            return self.reply(200, zone.operation("stop", instance))
+        if method == "DELETE":
+            if instance["name"] in zone.deleting:
+                return self.reply(400, {"error": {"code": 400, "message": "Resource not ready"}})
+            return self.reply(200, zone.delete(instance))
+        return self.reply(404, {"error": {"code": 404, "message": "Not Found"}})
+
+    def do_GET(self):
+        self.handle_request("GET")
+
+    def do_POST(self):
+        self.handle_request("POST")
+
+    def do_DELETE(self):
+        self.handle_request("DELETE")
+
+
+class MockGCE(ThreadingMixIn, HTTPServer):
+
+    daemon_threads = True
+    quota = None
+    failing = False
+
+    def __init__(self, port=0, instances=10, latency=0.0, project="project", zone="zone"):
+        HTTPServer.__init__(self, ("127.0.0.1", port), Handler)
+        self.zone = Zone("http://127.0.0.1:{}".format(self.server_address[1]), project, zone,
+            instances, latency)
+
+
+def main():
+    port = int(sys.argv[1]) if len(sys.argv) > 1 else 8080
+    instances = int(sys.argv[2]) if len(sys.argv) > 2 else 10
+    server = MockGCE(port, instances)
+    sys.stderr.write("Mock GCE API on {}\n".format(server.zone.base))
+    server.serve_forever()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,250 @@
+#!/usr/bin/python
+#
+# Stand-in vCloud Director cell for exercising vclouddriver.py offline.
+#
+# Serves the Session, Org, VDC, vApp, VM, metadata, recompose, power and task
+# endpoints used by the driver, for one or more vApps with a configurable number
+# of VMs. The vApps are named vapp, vapp2, vapp3 and so on.
+
+import sys
+import re
+import math
+import time
+import uuid
+import threading
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from SocketServer import ThreadingMixIn
+
+NS = "http://www.vmware.com/vcloud/v1.5"
+
+
+class Cell(object):
+
+    def __init__(self, base, vms=10, latency=0.0, task_time=0.0, vapps=1):
+        self.base = base
+        self.vapps = ["vapp-{}".format(i + 1) for i in xrange(vapps)]
+        self.latency = latency
+        self.task_time = task_time
+        self.lock = threading.Lock()
+        self.requests = {}
+        self.vms = {}
+        self.metadata = {}
+        self.tasks = {}
+        self.token = None
+        for i in xrange(vms):
+            self.new_vm("node{}".format(i), self.vapps[i % vapps], status=4, deployed=True)
+
+    def count(self, key):
+        with self.lock:
+            self.requests[key] = self.requests.get(key, 0) + 1
+
+    def new_vm(self, name, vapp="vapp-1", status=8, deployed=False):
+        vid = str(uuid.uuid4())
+        ip = "10.0.{}.{}".format(len(self.vms) / 250, len(self.vms) % 250 + 1)
+        self.vms[vid] = {"name": name, "vapp": vapp, "status": status, "deployed": deployed,
+            "ip": ip}
+        self.metadata[vid] = {"created": "2016-10-25T00:00:00Z"}
+        return vid
+
+    def new_task(self, action=None):
+        tid = str(uuid.uuid4())
+        self.tasks[tid] = {"done": time.time() + self.task_time, "action": action}
+        return tid
+
+    def task_status(self, tid):
+        task = self.tasks[tid]
+        if time.time() < task["done"]:
+            return "running"
+        if task["action"] is not None:
+            task["action"]()
+            task["action"] = None
+        return "success"
+
+    # Documents
+
+    def session_xml(self):
+        return ('<Session xmlns="{0}" user="bench"><Link rel="down" type="application/' +
+            'vnd.vmware.vcloud.org+xml" name="org" href="{1}/org/1"/></Session>').format(NS, self.base)
+
+    def org_xml(self):
+        return ('<Org xmlns="{0}" name="org"><Link rel="down" type="application/' +
+            'vnd.vmware.vcloud.vdc+xml" name="vdc" href="{1}/vdc/1"/></Org>').format(NS, self.base)
+
+    def vapp_name(self, vapp):
+        return "vapp" if vapp == "vapp-1" else "vapp" + vapp[5:]
+
+    def vdc_xml(self):
+        vapps = "".join(['<ResourceEntity type="application/vnd.vmware.vcloud.vApp+xml" name="{}" '
+            'href="{}/vApp/{}"/>'.format(self.vapp_name(vapp), self.base, vapp) for vapp in self.vapps])
+        return ('<Vdc xmlns="{0}" name="vdc"><ResourceEntities>' + vapps +
+            '<ResourceEntity type="application/vnd.vmware.vcloud.vAppTemplate+xml" name="template" ' +
+            'href="{1}/vAppTemplate/vappTemplate-1"/></ResourceEntities><AvailableNetworks>' +
+            '<Network type="application/vnd.vmware.vcloud.network+xml" name="net" href="{1}/network/1"/>' +
+            '</AvailableNetworks></Vdc>').format(NS, self.base)
+
+    def vm_xml(self, vid):
+        vm = self.vms[vid]
+        return ('<Vm xmlns="{0}" name="{1}" id="urn:vcloud:vm:{2}" href="{3}/vApp/vm-{2}" status="{4}" ' +
+            'deployed="{5}" needsCustomization="false"><Link rel="up" href="{3}/vApp/{7}"/>' +
+            '<NetworkConnectionSection><NetworkConnection network="net"><NetworkConnectionIndex>0' +
+            '</NetworkConnectionIndex><IpAddress>{6}</IpAddress><IsConnected>true</IsConnected>' +
+            '</NetworkConnection></NetworkConnectionSection></Vm>').format(NS, vm["name"], vid,
+            self.base, vm["status"], str(vm["deployed"]).lower(), vm["ip"], vm["vapp"])
+
+    def vapp_xml(self, vapp):
+        vms = "".join([self.vm_xml(vid).replace(' xmlns="{}"'.format(NS), '') for vid in self.vms.keys()
+            if self.vms[vid]["vapp"] == vapp])
+        return ('<VApp xmlns="{0}" name="{3}" href="{1}/vApp/{4}" status="4"><NetworkConfigSection>' +
+            '<NetworkConfig networkName="net"><Link rel="repair" href="{1}/network/2/action/reset"/>' +
+            '</NetworkConfig></NetworkConfigSection><Children>{2}</Children></VApp>').format(NS, self.base,
+            vms, self.vapp_name(vapp), vapp)
+
+    def template_xml(self):
+        return ('<VAppTemplate xmlns="{0}" name="template" href="{1}/vAppTemplate/vappTemplate-1">' +
+            '<Children><Vm name="tvm" href="{1}/vAppTemplate/vm-t1"/></Children></VAppTemplate>').format(NS, self.base)
+
+    def metadata_xml(self, vid):
+        entries = "".join(['<MetadataEntry><Key>{}</Key><TypedValue><Value>{}</Value></TypedValue>' \
+            '</MetadataEntry>'.format(k, v) for k, v in self.metadata.get(vid, {}).items()])
+        return '<Metadata xmlns="{}">{}</Metadata>'.format(NS, entries)
+
+    def task_xml(self, tid):
+        return '<Task xmlns="{}" href="{}/task/{}" status="{}"/>'.format(NS, self.base, tid,
+            self.task_status(tid))
+
+
+class Handler(BaseHTTPRequestHandler):
+
+    protocol_version = "HTTP/1.1"
+    wbufsize = -1
+
+    def log_message(self, *args):
+        pass
+
+    def reply(self, code, body="", headers=None):
+        self.send_response(code)
+        self.send_header("Content-Type", "application/xml")
+        self.send_header("Content-Length", str(len(body)))
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def handle_request(self, method):
+        cell = self.server.cell
+        path = self.path.split("?")[0]
+        key = method + " " + re.sub("[0-9a-f]{8}-[0-9a-f-]{27}", "{id}", path)
+        cell.count(key)
+        if cell.latency > 0:
+            time.sleep(cell.latency)
+        length = int(self.headers.getheader("Content-Length") or 0)
+        body = self.rfile.read(length) if length > 0 else ""
+        wait = self.server.quota.take() if self.server.quota is not None else None
+        if wait is not None:
+            cell.count("throttled")
+            return self.reply(429, "", {"Retry-After": str(int(math.ceil(wait)))})
+        if self.server.failing:
+            return self.reply(500)
+
+        if path == "/api/sessions" and method == "POST":
+            cell.token = str(uuid.uuid4())
+            return self.reply(200, cell.session_xml(), {"x-vcloud-authorization": cell.token})
+        if self.headers.getheader("x-vcloud-authorization") != cell.token:
+            return self.reply(401)
+
+        with cell.lock:
+            return self.route(cell, method, path, body)
+
+    def route(self, cell, method, path, body):
+        if path == "/api/session":
+            return self.reply(200, cell.session_xml())
+        if path == "/api/org/1":
+            return self.reply(200, cell.org_xml())
+        if path == "/api/vdc/1":
+            return self.reply(200, cell.vdc_xml())
+        if path == "/api/vAppTemplate/vappTemplate-1":
+            return self.reply(200, cell.template_xml())
+        m = re.match("/api/vApp/(vapp-[0-9]+)(/.*)?$", path)
+        if m and m.group(1) in cell.vapps:
+            return self.vapp_action(cell, method, m.group(1), m.group(2) or "", body)
+        m = re.match("/api/task/(.*)$", path)
+        if m:
+            return self.reply(200, cell.task_xml(m.group(1)))
+        m = re.match("/api/vApp/vm-([^/]*)(/.*)?$", path)
+        if m and m.group(1) in cell.vms:
+            return self.vm_action(cell, method, m.group(1), m.group(2) or "", body)
+        return self.reply(404)
+
+    def vapp_action(self, cell, method, vapp, action, body):
+        if action == "":
+            return self.reply(200, cell.vapp_xml(vapp))
+        if action == "/metadata":
+            return self.reply(200, cell.metadata_xml(vapp) if method == "GET" else
+                cell.task_xml(cell.new_task()), {})
+        if action == "/action/recomposeVApp":
+            return self.recompose(cell, vapp, body)
+        return self.reply(404)
+
+    def recompose(self, cell, vapp, body):
+        names = re.findall('<Source [^>]*name="([^"]*)"', body)
+        deletes = re.findall('DeleteItem [^>]*href="[^"]*/vm-([^"]*)"', body)
+        power = 'powerOn="true"' in body
+
+        def action():
+            for name in names:
+                vid = cell.new_vm(name, vapp)
+                cell.metadata[vid] = {}
+                if power:
+                    cell.vms[vid].update(status=4, deployed=True)
+            for vid in deletes:
+                cell.vms.pop(vid, None)
+        return self.reply(202, cell.task_xml(cell.new_task(action)))
+
+    def vm_action(self, cell, method, vid, action, body):
+        if action == "":
+            return self.reply(200, cell.vm_xml(vid))
+        if action == "/metadata" and method == "GET":
+            return self.reply(200, cell.metadata_xml(vid))
+        if action == "/metadata":
+            for key, value in re.findall("<Key>([^<]*)</Key>.*?<Value>([^<]*)</Value>", body):
+                cell.metadata[vid][key] = value
+            return self.reply(202, cell.task_xml(cell.new_task()))
+        if action == "/power/action/powerOn":
+            vm = cell.vms[vid]
+            return self.reply(202, cell.task_xml(cell.new_task(
+                lambda: vm.update(status=4, deployed=True))))
+        if action == "/action/undeploy":
+            vm = cell.vms[vid]
+            return self.reply(202, cell.task_xml(cell.new_task(
+                lambda: vm.update(status=8, deployed=False))))
+        return self.reply(404)
+
+    def do_GET(self):
+        self.handle_request("GET")
+
+    def do_POST(self):
+        self.handle_request("POST")
+
+
+class MockCell(ThreadingMixIn, HTTPServer):
+
+    daemon_threads = True
+    quota = None
+    failing = False
+
+    def __init__(self, port=0, vms=10, latency=0.0, task_time=0.0, vapps=1):
+        HTTPServer.__init__(self, ("127.0.0.1", port), Handler)
+        self.cell = Cell("http://127.0.0.1:{}/api".format(self.server_address[1]),
+            vms, latency, task_time, vapps)
+
+
+def main():
+    port = int(sys.argv[1]) if len(sys.argv) > 1 else 8443
+    vms = int(sys.argv[2]) if len(sys.argv) > 2 else 10
+    vapps = int(sys.argv[3]) if len(sys.argv) > 3 else 1
+    server = MockCell(port, vms, vapps=vapps)
+    sys.stderr.write("Mock vCloud cell on {}\n".format(server.cell.base))
+    server.serve_forever()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,30 @@
+#
+# Request quota shared by the mock APIs, which turn away requests over it with
+# a 429 and a Retry-After header, like a throttled cloud API.
+
+import time
+import threading
+
+
+class Quota(object):
+
+    # Token bucket refilled at rate tokens a second, holding up to burst
+
+    def __init__(self, rate, burst=None):
+        self.rate = float(rate)
+        self.burst = float(burst if burst is not None else rate)
+        self.tokens = self.burst
+        self.stamp = time.time()
+        self.lock = threading.Lock()
+
+    def take(self):
+        # Returns None if the request is allowed, otherwise the seconds until
+        # it would be
+        with self.lock:
+            now = time.time()
+            self.tokens = min(self.burst, self.tokens + (now - self.stamp) * self.rate)
+            self.stamp = now
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return None
+            return (1 - self.tokens) / self.rate
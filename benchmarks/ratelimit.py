@@ -0,0 +1,69 @@
+#!/usr/bin/python
+#
+# Runs several driver processes at once against a mock API which turns away
+# requests over its quota with a 429, and reports how long the burst took and
+# how many requests were throttled, with and without the drivers' rate limit.
+#
+# Usage: ratelimit.py [--drivers=docker,google,vcloud] [--nodes=50]
+#                     [--processes=8] [--quota=100] [--limits=0,100]
+
+import os
+import re
+import sys
+import time
+import shutil
+import tempfile
+import subprocess
+
+from fleet import BENCHES, ROOT
+from quota import Quota
+
+
+def burst(bench, processes, limit):
+    # The limiter state is shared through a file, as it is under vTM
+    args = ["--rateLimit={}".format(limit), "--rateBurst={}".format(max(1, int(limit))),
+        "--ratefile=" + os.path.join(bench.workdir, "limit{}".format(limit))]
+    start = time.time()
+    procs = [subprocess.Popen([sys.executable, os.path.join(ROOT, bench.driver), "status"] +
+        args + bench.args(), stdout=subprocess.PIPE, stderr=subprocess.PIPE, env=bench.env)
+        for x in xrange(processes)]
+    failed = 0
+    for proc in procs:
+        proc.communicate()
+        failed += 1 if proc.returncode != 0 else 0
+    return time.time() - start, failed
+
+
+def main():
+    opts = {"drivers": "docker,google,vcloud", "nodes": "50", "processes": "8",
+        "quota": "100", "limits": "0,100"}
+    for arg in sys.argv[1:]:
+        kvp = re.search("--([^=]+)=(.*)", arg)
+        if kvp != None:
+            opts[kvp.group(1)] = kvp.group(2)
+
+    print "{:<8} {:>6} {:>9}  {:>9} {:>9} {:>9} {:>7}".format("driver", "limit", "processes",
+        "seconds", "requests", "throttled", "failed")
+    for name in opts["drivers"].split(","):
+        for limit in [float(limit) for limit in opts["limits"].split(",")]:
+            workdir = tempfile.mkdtemp(prefix="ratelimit-bench-")
+            bench = BENCHES[name](workdir, int(opts["nodes"]), 0.0)
+            try:
+                # Log in and fill any caches before the quota applies
+                bench.run("status", [])
+                stats = bench.stats()
+                with stats.lock:
+                    stats.requests.clear()
+                bench.server.quota = Quota(float(opts["quota"]))
+                elapsed, failed = burst(bench, int(opts["processes"]), limit)
+                with stats.lock:
+                    throttled = stats.requests.get("throttled", 0)
+                    total = sum(stats.requests.values()) - throttled
+            finally:
+                bench.stop()
+                shutil.rmtree(workdir)
+            print "{:<8} {:>6} {:>9}  {:>9.3f} {:>9} {:>9} {:>7}".format(name, limit,
+                opts["processes"], elapsed, total, throttled, failed)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,144 @@
+#!/usr/bin/python
+#
+# Measures the start-up cost of the driver scripts for each action: wall time,
+# time to the first byte of output, and the time spent importing modules.
+#
+# Usage: startup.py [--runs=N] [--vms=N]
+
+import os
+import re
+import sys
+import json
+import time
+import shutil
+import tempfile
+import threading
+import subprocess
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+ROOT = os.path.join(HERE, "..")
+DRIVERS = { "vcloud": os.path.join(ROOT, "vcloud", "vclouddriver.py"),
+    "google": os.path.join(ROOT, "google", "googledriver.py"),
+    "docker": os.path.join(ROOT, "docker", "dockerScaler.py") }
+
+
+def harness(driver, args):
+    # Runs the driver as __main__, timing every top level import it makes.
+    # The report is written to the file named by STARTUP_REPORT on exit.
+    import __builtin__
+    import runpy
+    real_import = __builtin__.__import__
+    state = { "depth": 0, "time": 0.0 }
+
+    def timed_import(*a, **kw):
+        state["depth"] += 1
+        start = time.time()
+        try:
+            return real_import(*a, **kw)
+        finally:
+            state["depth"] -= 1
+            if state["depth"] == 0:
+                state["time"] += time.time() - start
+
+    before = len(sys.modules)
+    __builtin__.__import__ = timed_import
+    sys.argv = [driver] + args
+    try:
+        runpy.run_path(driver, run_name="__main__")
+    except SystemExit:
+        pass
+    finally:
+        __builtin__.__import__ = real_import
+        with open(os.environ["STARTUP_REPORT"], "w") as report:
+            json.dump({ "imports": state["time"], "modules": len(sys.modules) - before,
+                "requests": "requests" in sys.modules }, report)
+
+
+def measure(driver, args, env):
+    report = tempfile.mktemp(prefix="startup-")
+    env = dict(env, STARTUP_REPORT=report)
+    start = time.time()
+    proc = subprocess.Popen([sys.executable, os.path.abspath(__file__), "--harness",
+        driver] + args, stdout=subprocess.PIPE, stderr=subprocess.PIPE, env=env)
+    first = proc.stdout.read(1)
+    ttfb = time.time() - start if first else None
+    proc.communicate()
+    wall = time.time() - start
+    with open(report) as fh:
+        result = json.load(fh)
+    os.remove(report)
+    result.update(wall=wall, ttfb=ttfb)
+    return result
+
+
+def median(values):
+    values = sorted(values)
+    return values[len(values) / 2]
+
+
+def write_vcloud_config(path, base):
+    with open(path, "w") as cfg:
+        cfg.write("apiHost {}\nuser bench\npass bench\norg org\nvdc vdc\nvapp vapp\n".format(base))
+        cfg.write("privNet net\nipMode POOL\nsizeid any\n")
+
+
+def main():
+    if len(sys.argv) > 2 and sys.argv[1] == "--harness":
+        return harness(sys.argv[2], sys.argv[3:])
+
+    opts = {"runs": "10", "vms": "50"}
+    for arg in sys.argv[1:]:
+        kvp = re.search("--([^=]+)=(.*)", arg)
+        if kvp != None:
+            opts[kvp.group(1)] = kvp.group(2)
+
+    sys.path.insert(0, HERE)
+    from mockvcloud import MockCell
+    server = MockCell(0, int(opts["vms"]))
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+
+    workdir = tempfile.mkdtemp(prefix="startup-bench-")
+    env = dict(os.environ)
+    env.pop("ZEUSHOME", None)
+    cfg = os.path.join(workdir, "vcloud.cfg")
+    write_vcloud_config(cfg, server.cell.base)
+    vcd = ["--cred1=" + cfg, "--statefile=" + os.path.join(workdir, "vcd.state")]
+    daemon = None
+
+    cases = [
+        ("vcloud", "help", ["help"]),
+        ("google", "help", ["help"]),
+        ("docker", "help", ["help"]),
+        ("vcloud", "status", ["status"] + vcd),
+        ("vcloud", "get-vdc-info --cached", ["get-vdc-info", "--json", "--cached"] + vcd),
+        ("vcloud", "status (daemon)", ["status"] + vcd),
+    ]
+    try:
+        print "{:<8} {:<24} {:>9} {:>9} {:>9} {:>8}  {}".format("driver", "action",
+            "wall", "ttfb", "imports", "modules", "requests")
+        for name, label, args in cases:
+            if label.endswith("(daemon)") and daemon is None:
+                daemon = subprocess.Popen([sys.executable, DRIVERS["vcloud"], "daemon"] + vcd,
+                    env=env)
+                while not os.path.exists(os.path.join(workdir, "vcd.sock")):
+                    time.sleep(0.05)
+            # The first run warms the state file and the OS caches
+            measure(DRIVERS[name], args, env)
+            results = [measure(DRIVERS[name], args, env) for run in xrange(int(opts["runs"]))]
+            ttfb = [r["ttfb"] for r in results if r["ttfb"] is not None]
+            print "{:<8} {:<24} {:>8.1f}ms {:>8} {:>8.1f}ms {:>8}  {}".format(name, label,
+                median([r["wall"] for r in results]) * 1000,
+                "{:.1f}ms".format(median(ttfb) * 1000) if ttfb else "-",
+                median([r["imports"] for r in results]) * 1000,
+                results[-1]["modules"], "yes" if results[-1]["requests"] else "no")
+    finally:
+        if daemon is not None:
+            daemon.terminate()
+            daemon.wait()
+        server.shutdown()
+        shutil.rmtree(workdir)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,85 @@
+#!/usr/bin/python
+#
+# Measures the latency of "vclouddriver.py status" against a local mock cell.
+#
+# Usage: vcloud_status.py [--vms=N] [--vapps=N] [--runs=N] [--latency=SECONDS]
+
+import os
+import re
+import sys
+import json
+import time
+import shutil
+import tempfile
+import threading
+import subprocess
+
+from mockvcloud import MockCell
+
+DRIVER = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "vcloud",
+    "vclouddriver.py")
+
+
+def percentile(values, pct):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * pct / 100.0))]
+
+
+def write_config(path, base, vapps=1):
+    names = ["vapp"] + ["vapp{}".format(i + 1) for i in xrange(1, vapps)]
+    with open(path, "w") as cfg:
+        cfg.write("apiHost {}\nuser bench\npass bench\norg org\nvdc vdc\n".format(base))
+        cfg.write("vapps {}\n".format(", ".join(names)))
+        cfg.write("privNet net\nipMode POOL\nsizeid any\n")
+
+
+def run_status(cfg, statefile):
+    start = time.time()
+    output = subprocess.check_output([sys.executable, DRIVER, "status",
+        "--cred1=" + cfg, "--statefile=" + statefile])
+    elapsed = time.time() - start
+    nodes = json.loads(output)["NodeStatusResponse"]["nodes"]
+    return elapsed, len(nodes)
+
+
+def main():
+    opts = {"vms": "50", "vapps": "1", "runs": "20", "latency": "0.0"}
+    for arg in sys.argv[1:]:
+        kvp = re.search("--([^=]+)=(.*)", arg)
+        if kvp != None:
+            opts[kvp.group(1)] = kvp.group(2)
+
+    server = MockCell(0, int(opts["vms"]), float(opts["latency"]), vapps=int(opts["vapps"]))
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+
+    workdir = tempfile.mkdtemp(prefix="vcloud-bench-")
+    try:
+        cfg = os.path.join(workdir, "vcloud.cfg")
+        statefile = os.path.join(workdir, "vcd.state")
+        write_config(cfg, server.cell.base, int(opts["vapps"]))
+
+        # The first run logs in and discovers the org, vdc and vApp hrefs.
+        cold, nodes = run_status(cfg, statefile)
+        server.cell.requests.clear()
+        times = []
+        for run in xrange(int(opts["runs"])):
+            elapsed, nodes = run_status(cfg, statefile)
+            times.append(elapsed)
+    finally:
+        server.shutdown()
+        shutil.rmtree(workdir)
+
+    print "vms: {}  vapps: {}  runs: {}  latency: {}s".format(opts["vms"], opts["vapps"],
+        opts["runs"], opts["latency"])
+    print "cold run: {:.3f}s".format(cold)
+    print "warm runs: mean {:.3f}s  p50 {:.3f}s  p95 {:.3f}s  max {:.3f}s".format(
+        sum(times) / len(times), percentile(times, 50), percentile(times, 95), max(times))
+    print "nodes reported: {}".format(nodes)
+    print "requests per warm run:"
+    for key in sorted(server.cell.requests.keys()):
+        print "   {:<40} {:.1f}".format(key, server.cell.requests[key] / float(len(times)))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,1094 @@
+# Helpers shared by the Brocade vTM autoscaling drivers
+#
+# Name:     drivercommon.py
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+#
+# The state files, node history, status streaming and cache, daemon, tracing,
+# profiling and rate limiting used by vclouddriver.py, googledriver.py and
+# dockerScaler.py. Each driver passes in the parts which differ, such as its
+# file names and how its API URLs are summarised. Nothing here imports
+# requests, so loading it costs a driver next to nothing.
+
+import sys
+import os
+import re
+import time
+import json
+import random
+import fcntl
+import socket
+import threading
+import subprocess
+import traceback
+from io import BytesIO
+
+# Drivers which report errors differently set this, eg googledriver.py uses
+# "ERR"
+ERROR_PREFIX = "ERROR"
+
+
+def error(message):
+    sys.stderr.write("{} - {}\n".format(ERROR_PREFIX, message))
+
+
+def find_zeus_home():
+    zh = os.environ.get("ZEUSHOME")
+    if zh is None:
+        for path in ("/usr/local/zeus", "/opt/zeus"):
+            if os.path.isdir(path):
+                zh = path
+                break
+    return zh
+
+
+def spawn(args):
+    # Run the driver with args in the background, detached from this process
+    devnull = open(os.devnull, "r+")
+    subprocess.Popen([sys.executable] + args, stdin=devnull, stdout=devnull, stderr=devnull,
+        close_fds=True, preexec_fn=os.setsid)
+    devnull.close()
+
+
+def run_parallel(func, items, workers=8):
+    # Call func on each item using a small pool of threads. Results come back
+    # in the order of items. The first exception raised is re-raised once all
+    # the workers have finished, SystemExit from the drivers' error paths
+    # included, with its original traceback. The workers trace into the
+    # caller's tracer and, in the daemon, write into the caller's reply.
+    items = list(items)
+    results = [None] * len(items)
+    errors = []
+    lock = threading.Lock()
+    index = [0]
+
+    def worker():
+        while True:
+            with lock:
+                if index[0] >= len(items) or len(errors) > 0:
+                    return
+                i = index[0]
+                index[0] += 1
+            try:
+                Tracer.local.tracer = tracer
+                for stream, buffer in outputs:
+                    stream.share(buffer)
+                results[i] = func(items[i])
+            except BaseException:
+                with lock:
+                    errors.append(sys.exc_info())
+
+    if len(items) <= 1 or workers <= 1:
+        return [func(item) for item in items]
+    tracer = getattr(Tracer.local, "tracer", None)
+    outputs = [(stream, stream.buffer()) for stream in (sys.stdout, sys.stderr)
+        if isinstance(stream, ThreadOutput)]
+    threads = [threading.Thread(target=worker) for x in xrange(min(workers, len(items)))]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    if len(errors) > 0:
+        raise errors[0][0], errors[0][1], errors[0][2]
+    return results
+
+
+
+def is_set(opts, key):
+    # A flag is on when given bare (--key) or as --key=true, in any case
+    return str(opts.get(key, "false")).lower() in ("", "true")
+
+
+def new_node_names(nodes, count, prefix="node"):
+    # New nodes take the lowest free numbers after the prefix
+    used = set(node["name"] for node in nodes)
+    names = []
+    i = 0
+    while len(names) < count:
+        if prefix + str(i) not in used:
+            names.append(prefix + str(i))
+        i += 1
+    return names
+
+
+def pool_member(name, prefix):
+    # Nodes made by reconcile are named <prefix><n>
+    return re.match("^" + re.escape(prefix) + "[0-9]+$", name) is not None
+
+
+def plan_reconcile(nodes, count, wanted, prefix="node", member=None):
+    # Returns the names of the nodes to create and the nodes to destroy to
+    # leave count live nodes matching wanted, a dict of node fields such as
+    # imageid. Nodes which don't match are replaced, though a node without
+    # the field at all is kept. A pool is scaled in from its newest nodes,
+    # so the longest running ones are kept.
+    #
+    # Only the nodes of the pool are counted or destroyed, those for which
+    # member is true, by default those named <prefix><n>. New names avoid
+    # every node though, as other pools may share the namespace.
+    def matches(node):
+        for key, value in wanted.items():
+            if node.get(key) not in (None, value):
+                return False
+        return True
+
+    if member is None:
+        member = lambda node: pool_member(node["name"], prefix)
+    live = [node for node in nodes if node.get("status") not in ("destroyed", "deleted") and
+        member(node)]
+    keep = sorted([node for node in live if matches(node)], key=lambda node: node.get("created"))
+    destroy = [node for node in live if not matches(node)] + keep[count:]
+    return new_node_names(nodes, max(0, count - len(keep)), prefix), destroy
+
+
+def print_plan(count, create, destroy):
+    # create holds a (name, details) pair for each new node, where details
+    # are the image, size etc to show for it
+    sys.stderr.write("PLAN - {} nodes: create {}, destroy {}\n".format(count,
+        len(create), len(destroy)))
+    for name, details in create:
+        sys.stderr.write("PLAN - create {} ({})\n".format(name, ", ".join(details)))
+    for node in destroy:
+        sys.stderr.write("PLAN - destroy {} ({})\n".format(node["name"], node["uniq_id"]))
+
+
+def planned_results(names, destroy):
+    # The results of a --dryrun reconcile
+    results = [{ "action": "create", "name": name, "status": "planned" } for name in names]
+    for node in destroy:
+        results.append({ "action": "destroy", "name": node["name"],
+            "uniq_id": node["uniq_id"], "status": "planned" })
+    return results
+
+
+class StateFile(object):
+
+    # JSON state shared between driver invocations. Writers take an exclusive
+    # lock on a sidecar lock file, merge their sections into the current
+    # contents and atomically replace the file.
+
+    def __init__(self, path):
+        self.path = path
+
+    def _lock(self, mode):
+        lock = open(self.path + ".lock", "a")
+        fcntl.flock(lock, mode)
+        return lock
+
+    def _load(self):
+        if os.path.exists(self.path) is False:
+            return {}
+        try:
+            sf = open(self.path, "r")
+            state = json.load(sf)
+            sf.close()
+        except ValueError:
+            return {}
+        return state
+
+    def read(self):
+        if self.path is None:
+            return {}
+        lock = self._lock(fcntl.LOCK_SH)
+        try:
+            return self._load()
+        finally:
+            lock.close()
+
+    def write(self, sections):
+        if self.path is None:
+            return
+        lock = self._lock(fcntl.LOCK_EX)
+        try:
+            state = self._load()
+            state.update(sections)
+            tmp = self.path + ".tmp"
+            sf = open(tmp, "w")
+            os.chmod(tmp, 0o600)
+            json.dump(state, sf)
+            sf.close()
+            os.rename(tmp, self.path)
+        finally:
+            lock.close()
+
+
+class NodeHistory(object):
+
+    # Compact record of node changes used to answer --deltasince. It holds the
+    # latest state of each node and a time ordered log of the changes seen,
+    # so a delta is just the tail of the log rather than a snapshot diff.
+    # checked is the time passed to the last update, ie when the node list
+    # held in current was read.
+
+    def __init__(self, path, retain=3600):
+        self.store = StateFile(path)
+        self.retain = retain
+        self.load(self.store.read())
+
+    def load(self, history):
+        self.current = history.get("current")
+        self.changes = history.get("changes", [])
+        self.start = history.get("start", 0)
+        self.checked = history.get("checked")
+
+    def dump(self):
+        return { "current": self.current, "changes": self.changes,
+            "start": self.start, "checked": self.checked }
+
+    def save(self):
+        self.store.write(self.dump())
+
+    def update(self, nodes, now):
+        if self.current is None:
+            self.current = {}
+            self.start = now
+        # A history which hasn't recorded when it was checked is saved once
+        changed = self.checked is None
+        self.checked = now
+        seen = set()
+        for node in nodes:
+            seen.add(node["name"])
+            if self.current.get(node["name"]) != node:
+                self.current[node["name"]] = node
+                self.changes.append([now, node["name"], node])
+                changed = True
+        for name in self.current.keys():
+            if name not in seen:
+                node = dict(self.current.pop(name))
+                node["status"] = "destroyed"
+                node["complete"] = 100
+                self.changes.append([now, name, node])
+                changed = True
+        while len(self.changes) > 0 and self.changes[0][0] < now - self.retain:
+            self.start = self.changes.pop(0)[0]
+            changed = True
+        return changed
+
+    def since(self, stamp):
+        if stamp < self.start:
+            # Older than our log, so send everything we know about
+            delta = {}
+            for entry in self.changes:
+                delta[entry[1]] = entry[2]
+            delta.update(self.current)
+            return delta.values()
+        delta = {}
+        for entry in self.changes:
+            if entry[0] > stamp:
+                delta[entry[1]] = entry[2]
+        return delta.values()
+
+
+def delta_since(opts, now):
+    # The time a --deltasince poll is answered from. Changes logged within 10
+    # seconds of deltasince were reported by the previous poll, but anything
+    # found by this poll must always be sent. With the status cache on, the
+    # background refreshes log changes which no poll has reported yet, so
+    # the log is read from deltasince itself and a node may be sent twice.
+    since = int(opts["deltasince"])
+    if "statusStale" not in opts.keys():
+        since += 10
+    return min(since, now - 1)
+
+
+class StatusWriter(object):
+
+    # Writes a status response one node at a time, so it is never built up as
+    # a single string and the reader gets nodes as soon as they are ready. The
+    # first node opens the envelope, and the response code follows the nodes:
+    # 200, or 500 if the action failed part way through. Whatever has been
+    # written is always a complete document.
+
+    def __init__(self, stream, response="NodeStatusResponse"):
+        self.stream = stream
+        self.response = response
+        self.count = None
+
+    def open(self):
+        if self.count is None:
+            self.stream.write('{{"{}": {{"version": 1, "nodes": ['.format(self.response))
+            self.count = 0
+
+    def write(self, node):
+        self.open()
+        self.stream.write((", " if self.count > 0 else "") + json.dumps(node))
+        self.count += 1
+
+    def write_all(self, nodes):
+        with Tracer.current().phase("emit"):
+            for node in nodes:
+                self.write(node)
+
+    def passing(self, nodes):
+        # Write each node out as it is read from nodes
+        for node in nodes:
+            self.write(node)
+            yield node
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, etype, value, tb):
+        if etype is None:
+            self.open()
+        elif self.count is None:
+            return False
+        self.stream.write('], "code": {}}}}}\n'.format(200 if etype is None else 500))
+        self.stream.flush()
+        return False
+
+
+
+
+class ThreadOutput(object):
+
+    # Stands in for sys.stdout and sys.stderr in the daemon, so that each
+    # request thread collects its own output. Threads working for a request
+    # share its buffer, other threads write through.
+
+    def __init__(self, stream):
+        self.stream = stream
+        self.local = threading.local()
+
+    def capture(self):
+        self.local.buffer = []
+
+    def release(self):
+        output = "".join(self.local.buffer)
+        self.local.buffer = None
+        return output
+
+    def buffer(self):
+        return getattr(self.local, "buffer", None)
+
+    def share(self, buffer):
+        self.local.buffer = buffer
+
+    def write(self, data):
+        if getattr(self.local, "buffer", None) is None:
+            self.stream.write(data)
+        else:
+            self.local.buffer.append(data)
+
+    def flush(self):
+        if getattr(self.local, "buffer", None) is None:
+            self.stream.flush()
+
+
+class DriverDaemon(object):
+
+    # Serves driver requests over a Unix socket, so that sessions and caches
+    # stay warm between polls. Each request is a JSON list of arguments, and
+    # the reply carries the stdout, stderr and exit code of running them.
+    # The daemon exits once it has been idle for idle seconds.
+
+    def __init__(self, path, run, idle=3600):
+        self.path = path
+        self.run = run
+        self.idle = idle
+        self.active = 0
+        self.last = time.time()
+        self.lock = threading.Lock()
+
+    def serve(self):
+        guard = open(self.path + ".lock", "a")
+        try:
+            fcntl.flock(guard, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except IOError:
+            error("Daemon already running: " + self.path)
+            sys.exit(1)
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+        server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        server.bind(self.path)
+        os.chmod(self.path, 0o600)
+        server.listen(16)
+        server.settimeout(1)
+        sys.stdout = ThreadOutput(sys.stdout)
+        sys.stderr = ThreadOutput(sys.stderr)
+        try:
+            while True:
+                with self.lock:
+                    if self.active == 0 and time.time() - self.last > self.idle:
+                        break
+                try:
+                    conn, addr = server.accept()
+                except socket.timeout:
+                    continue
+                with self.lock:
+                    self.active += 1
+                thread = threading.Thread(target=self.handle, args=(conn,))
+                thread.daemon = True
+                thread.start()
+        finally:
+            os.unlink(self.path)
+            server.close()
+            guard.close()
+
+    def handle(self, conn):
+        try:
+            conn.settimeout(None)
+            data = []
+            while True:
+                chunk = conn.recv(65536)
+                if not chunk:
+                    break
+                data.append(chunk)
+            argv = json.loads("".join(data))
+            conn.sendall(json.dumps(self.execute(argv)))
+        except Exception as e:
+            error("Daemon request failed: {}".format(e))
+        finally:
+            conn.close()
+            with self.lock:
+                self.active -= 1
+                self.last = time.time()
+
+    def execute(self, argv):
+        sys.stdout.capture()
+        sys.stderr.capture()
+        code = 0
+        try:
+            self.run(argv)
+        except SystemExit as e:
+            if e.code is None:
+                code = 0
+            elif isinstance(e.code, int):
+                code = e.code
+            else:
+                sys.stderr.write("{}\n".format(e.code))
+                code = 1
+        except Exception:
+            traceback.print_exc(file=sys.stderr)
+            code = 1
+        return { "stdout": sys.stdout.release(), "stderr": sys.stderr.release(),
+            "code": code }
+
+
+class Tracer(object):
+
+    # Records the HTTP requests and phases of one driver action. Events are
+    # kept in memory and, if tracing is enabled, appended to a JSONL file
+    # when the action finishes. The file is rotated once it grows past
+    # max_bytes, keeping the last few files.
+
+    local = threading.local()
+    hooked = False
+
+    def __init__(self, driver, action=None):
+        self.driver = driver
+        self.action = action
+        self.run = "{}-{}".format(os.getpid(), int(time.time() * 1000000))
+        self.start = time.time()
+        self.path = None
+        self.max_bytes = 0
+        self.backups = 0
+        self.events = []
+        self.lock = threading.Lock()
+
+    @classmethod
+    def current(cls):
+        tracer = getattr(cls.local, "tracer", None)
+        return NULL_TRACER if tracer is None else tracer
+
+    @classmethod
+    def timing(cls, name, start):
+        # Called by the connection hooks for the request in progress
+        timings = getattr(cls.local, "timings", None)
+        if timings is not None:
+            timings[name] = timings.get(name, 0) + (time.time() - start) * 1000
+
+    def enable(self, path, max_bytes=5242880, backups=3):
+        if self.action is None or path is None:
+            return
+        self.path = path
+        self.max_bytes = max_bytes
+        self.backups = backups
+
+    def event(self, record):
+        if self.action is None:
+            return
+        record["ts"] = round(time.time(), 3)
+        with self.lock:
+            self.events.append(record)
+
+    def phase(self, name):
+        return TracePhase(self, name)
+
+    def request(self, method, url, status, size, timings, retries, error=None):
+        record = { "type": "request", "method": method, "url": url,
+            "status": status, "bytes": size, "retries": retries }
+        for name in timings.keys():
+            record[name + "_ms"] = round(timings[name], 2)
+        if error is not None:
+            record["error"] = error
+        self.event(record)
+
+    def finish(self, code):
+        if self.path is None:
+            return
+        self.event({ "type": "run", "code": code,
+            "ms": round((time.time() - self.start) * 1000, 2) })
+        lines = []
+        for record in self.events:
+            record.update(driver=self.driver, action=self.action, run=self.run)
+            lines.append(json.dumps(record, separators=(',', ':')) + "\n")
+        try:
+            self.write("".join(lines))
+        except (IOError, OSError) as e:
+            error("Failed to write trace: {}".format(e))
+
+    def write(self, data):
+        lock = open(self.path + ".lock", "a")
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        try:
+            if os.path.exists(self.path) and os.path.getsize(self.path) > self.max_bytes:
+                for i in xrange(self.backups - 1, 0, -1):
+                    if os.path.exists("{}.{}".format(self.path, i)):
+                        os.rename("{}.{}".format(self.path, i), "{}.{}".format(self.path, i + 1))
+                os.rename(self.path, self.path + ".1")
+            tf = open(self.path, "a")
+            os.chmod(self.path, 0o600)
+            tf.write(data)
+            tf.close()
+        finally:
+            lock.close()
+
+
+class TracePhase(object):
+
+    # Context manager timing one phase of an action
+    def __init__(self, tracer, name):
+        self.tracer = tracer
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.time()
+        return self
+
+    def __exit__(self, etype, value, tb):
+        self.tracer.event({ "type": "phase", "name": self.name,
+            "ms": round((time.time() - self.start) * 1000, 2) })
+        return False
+
+
+NULL_TRACER = Tracer(None)
+
+
+def trace_session(session, template):
+    # Record every request made through the session with the tracer of the
+    # calling thread. template turns a URL into the form it is summarised
+    # under. Retries made by urllib3 are counted, not listed.
+    send = session.send
+
+    def traced_send(request, **kwargs):
+        tracer = Tracer.current()
+        if tracer.action is None:
+            return send(request, **kwargs)
+        if not Tracer.hooked:
+            install_trace_hooks()
+        timings = {}
+        Tracer.local.timings = timings
+        start = time.time()
+        try:
+            response = send(request, **kwargs)
+        except Exception as e:
+            timings["total"] = (time.time() - start) * 1000
+            tracer.request(request.method, template(request.url), None, 0,
+                timings, None, str(e))
+            raise
+        finally:
+            Tracer.local.timings = None
+        timings["total"] = (time.time() - start) * 1000
+        setup = sum(timings.get(name, 0) for name in ("dns", "connect", "tls"))
+        timings["ttfb"] = max(0, response.elapsed.total_seconds() * 1000 - setup)
+        retries = getattr(response.raw, "retries", None)
+        retries = len(retries.history) if retries is not None else 0
+        tracer.request(request.method, template(request.url), response.status_code,
+            len(response.content), timings, retries)
+        return response
+
+    session.send = traced_send
+    return session
+
+
+class TimedSocketModule(object):
+
+    # Stands in for the socket module in urllib3's connection code, timing
+    # the name lookups made when a new connection is opened
+    def __getattr__(self, name):
+        return getattr(socket, name)
+
+    def getaddrinfo(self, *args, **kwargs):
+        start = time.time()
+        try:
+            return socket.getaddrinfo(*args, **kwargs)
+        finally:
+            Tracer.timing("dns", start)
+
+
+def install_trace_hooks():
+    # requests doesn't report connection timings, so time the urllib3 calls
+    # which open connections. Connect time includes the DNS lookup, which is
+    # taken out again below.
+    if Tracer.hooked:
+        return
+    Tracer.hooked = True
+    from requests.packages.urllib3 import connection
+    from requests.packages.urllib3.util import connection as util_connection
+    util_connection.socket = TimedSocketModule()
+    new_conn = connection.HTTPConnection._new_conn
+    https_connect = connection.HTTPSConnection.connect
+
+    def timed_new_conn(self):
+        start = time.time()
+        timings = getattr(Tracer.local, "timings", None)
+        dns = timings.get("dns", 0) if timings is not None else 0
+        try:
+            return new_conn(self)
+        finally:
+            Tracer.timing("connect", start)
+            if timings is not None:
+                timings["connect"] -= timings.get("dns", 0) - dns
+
+    def timed_https_connect(self):
+        start = time.time()
+        timings = getattr(Tracer.local, "timings", None)
+        before = sum(timings.get(name, 0) for name in ("dns", "connect")) if timings is not None else 0
+        try:
+            return https_connect(self)
+        finally:
+            Tracer.timing("tls", start)
+            if timings is not None:
+                timings["tls"] -= sum(timings.get(name, 0) for name in ("dns", "connect")) - before
+
+    connection.HTTPConnection._new_conn = timed_new_conn
+    connection.HTTPSConnection.connect = timed_https_connect
+
+
+def get_trace_path(opts, base):
+    # --trace or "trace true" in the config turns tracing on. The trace is
+    # written to base.trace.jsonl unless --tracefile says otherwise.
+    if not is_set(opts, "trace"):
+        return None
+    if "tracefile" in opts.keys():
+        return opts["tracefile"]
+    if base is None:
+        return None
+    return base + ".trace.jsonl"
+
+
+class Profiler(object):
+
+    # Captures a cProfile of one action and the memory it allocated. Memory
+    # is traced with tracemalloc where the interpreter has it, otherwise the
+    # growth in live objects by type and the peak RSS are reported instead.
+
+    def __init__(self, top=20):
+        import cProfile
+        try:
+            import tracemalloc
+        except ImportError:
+            tracemalloc = None
+        self.top = top
+        self.profile = cProfile.Profile()
+        self.tracemalloc = tracemalloc
+        self.objects = None
+        self.snapshot = None
+
+    def start(self):
+        if self.tracemalloc is not None:
+            self.tracemalloc.start(10)
+        else:
+            self.objects = self.count_objects()
+        self.profile.enable()
+
+    def stop(self):
+        self.profile.disable()
+        if self.tracemalloc is not None:
+            self.snapshot = self.tracemalloc.take_snapshot()
+            self.tracemalloc.stop()
+
+    def count_objects(self):
+        import gc
+        counts = {}
+        for obj in gc.get_objects():
+            name = type(obj).__name__
+            counts[name] = counts.get(name, 0) + 1
+        return counts
+
+    def memory_report(self, base):
+        lines = []
+        if self.snapshot is not None:
+            if base is not None:
+                self.snapshot.dump(base + ".tracemalloc")
+            lines.append("Top {} allocations by line:".format(self.top))
+            for stat in self.snapshot.statistics("lineno")[:self.top]:
+                lines.append("    {}".format(stat))
+        else:
+            import resource
+            objects = self.count_objects()
+            growth = [(objects[name] - self.objects.get(name, 0), name)
+                for name in objects.keys()]
+            growth.sort(reverse=True)
+            lines.append("tracemalloc is not available, peak RSS {} KB".format(
+                resource.getrusage(resource.RUSAGE_SELF).ru_maxrss))
+            lines.append("Top {} types by growth in live objects tracked by gc:".format(self.top))
+            for count, name in growth[:self.top]:
+                lines.append("    {:>8}  {}".format(count, name))
+        return "\n".join(lines) + "\n"
+
+    def report(self, base=None):
+        # Saves the profile as base.prof, which pstats can load, and the
+        # report as base.profile.txt, and returns the report
+        import pstats
+        stream = BytesIO()
+        stats = pstats.Stats(self.profile, stream=stream)
+        stats.sort_stats("cumulative").print_stats(self.top)
+        stats.sort_stats("time").print_stats(self.top)
+        stream.write(self.memory_report(base))
+        if base is not None:
+            self.profile.dump_stats(base + ".prof")
+            rf = open(base + ".profile.txt", "w")
+            os.chmod(base + ".profile.txt", 0o600)
+            rf.write(stream.getvalue())
+            rf.close()
+        return stream.getvalue()
+
+
+def get_profiler(opts):
+    # --profile[=<top>] profiles the action, reporting the top 20 entries
+    # unless told otherwise
+    if "profile" not in opts.keys() or opts["profile"].lower() == "false":
+        return None
+    return Profiler(int(opts["profile"]) if opts["profile"].isdigit() else 20)
+
+
+def get_profile_base(opts, base):
+    return opts.get("profilefile", base)
+
+
+class RateLimiter(object):
+
+    # Paces the requests made to each API endpoint by every driver process.
+    # Each endpoint has a "theoretical arrival time" (GCRA, the token bucket
+    # as a single timestamp) kept in a JSON file under an exclusive lock, or
+    # in memory if there is no file. Callers reserve a slot and sleep outside
+    # the lock. A rate limited response closes the endpoint to everyone until
+    # its Retry-After has passed, after which requests resume at the rate.
+    # Without a rate the file is only read when a backoff has been written
+    # to it since it was last read.
+
+    def __init__(self, path=None, rate=0.0, burst=1):
+        self.path = path
+        self.rate = rate
+        self.burst = burst
+        self.buckets = {}
+        self.mtime = None
+        self.lock = threading.Lock()
+
+    def _update(self, key, func, write=True):
+        with self.lock:
+            lock = None
+            if self.path is not None:
+                lock = open(self.path + ".lock", "a")
+                fcntl.flock(lock, fcntl.LOCK_EX if write else fcntl.LOCK_SH)
+            try:
+                if lock is not None:
+                    self.buckets = self._load()
+                now = time.time()
+                bucket = self.buckets.setdefault(key, { "tat": now, "until": 0 })
+                result = func(bucket, now)
+                for name in self.buckets.keys():
+                    if max(self.buckets[name]["tat"], self.buckets[name]["until"]) < now - 60:
+                        del self.buckets[name]
+                self.buckets[key] = bucket
+                if lock is not None and write:
+                    self._save()
+                return result
+            finally:
+                if lock is not None:
+                    lock.close()
+
+    def _load(self):
+        if os.path.exists(self.path) is False:
+            return {}
+        self.mtime = os.stat(self.path).st_mtime
+        try:
+            rf = open(self.path, "r")
+            buckets = json.load(rf)
+            rf.close()
+        except ValueError:
+            return {}
+        return buckets
+
+    def _save(self):
+        tmp = self.path + ".tmp"
+        rf = open(tmp, "w")
+        os.chmod(tmp, 0o600)
+        json.dump(self.buckets, rf)
+        rf.close()
+        os.rename(tmp, self.path)
+        self.mtime = os.stat(self.path).st_mtime
+
+    def _changed(self):
+        # Whether the file may hold a backoff we haven't read yet
+        if self.path is None:
+            return False
+        try:
+            return os.stat(self.path).st_mtime != self.mtime
+        except OSError:
+            return False
+
+    def acquire(self, key):
+        # Wait for a slot to send a request to the endpoint
+        def reserve(bucket, now):
+            if self.rate <= 0:
+                return max(0, bucket["until"] - now)
+            interval = 1.0 / self.rate
+            send = max(now, bucket["until"], bucket["tat"] - (self.burst - 1) * interval)
+            bucket["tat"] = max(bucket["tat"], send) + interval
+            return send - now
+        # Without a rate there is nothing to reserve, only a backoff to honour
+        if self.rate <= 0 and not self._changed():
+            bucket = self.buckets.get(key)
+            wait = max(0, bucket["until"] - time.time()) if bucket is not None else 0
+        else:
+            wait = self._update(key, reserve, self.rate > 0)
+        if wait > 0:
+            time.sleep(wait)
+        return wait
+
+    def backoff(self, key, delay):
+        # Hold every request to the endpoint for delay seconds
+        def close(bucket, now):
+            bucket["until"] = max(bucket["until"], now + delay)
+            if self.rate > 0:
+                bucket["tat"] = max(bucket["tat"], bucket["until"] +
+                    (self.burst - 1) / float(self.rate))
+        self._update(key, close)
+
+
+def get_retry_after(response):
+    # Retry-After is either a number of seconds or an HTTP date
+    value = response.headers.get("Retry-After")
+    if value is None:
+        return None
+    if value.strip().isdigit():
+        return float(value.strip())
+    import email.utils
+    date = email.utils.parsedate_tz(value)
+    if date is None:
+        return None
+    return max(0, email.utils.mktime_tz(date) - time.time())
+
+
+def endpoint_key(url):
+    # Requests are paced per host unless the driver says otherwise
+    return re.sub("^(\w+://[^/]+).*", "\\1", url)
+
+
+def limit_session(session, limiter, key=endpoint_key, retries=4):
+    # Send every request through the rate limiter, and resend requests the
+    # API turned away with a 429 (or a 503 for anything but a POST) once
+    # the endpoint opens again. key maps a URL to the endpoint it counts
+    # against.
+    send = session.send
+
+    def limited_send(request, **kwargs):
+        endpoint = key(request.url)
+        for attempt in xrange(retries + 1):
+            limiter.acquire(endpoint)
+            response = send(request, **kwargs)
+            if response.status_code != 429 and \
+                (response.status_code != 503 or request.method == "POST"):
+                return response
+            if attempt == retries:
+                return response
+            delay = get_retry_after(response)
+            if delay is None:
+                delay = min(60, 2 ** attempt) * random.uniform(0.5, 1.0)
+            limiter.backoff(endpoint, min(delay, 300))
+        return response
+
+    session.send = limited_send
+    return session
+
+
+RATE_LIMITERS = {}
+RATE_LIMITER_LOCK = threading.Lock()
+
+
+def get_rate_limiter(opts, path):
+    # One limiter per file, so threads in a daemon share it as well. The
+    # limiter state is kept in path unless --ratefile says otherwise.
+    rate = float(opts["rateLimit"]) if "rateLimit" in opts.keys() else 0.0
+    burst = int(opts["rateBurst"]) if "rateBurst" in opts.keys() else max(1, int(rate))
+    path = opts.get("ratefile", path)
+    with RATE_LIMITER_LOCK:
+        key = (path, rate, burst)
+        if key not in RATE_LIMITERS:
+            RATE_LIMITERS[key] = RateLimiter(path, rate, burst)
+        return RATE_LIMITERS[key]
+
+
+class StatusCache(object):
+
+    # The last good node list for a cloud credential, and a circuit breaker
+    # for the API behind it. A list younger than stale seconds is answered
+    # straight away while a background process fetches a new one. An older
+    # list, up to max_stale seconds, is only used when the API fails or the
+    # breaker is open. The breaker opens for reset seconds after failures
+    # consecutive failed fetches, and the next fetch after that tries again.
+
+    def __init__(self, path, script, api, stale, max_stale=600, failures=3, reset=30):
+        self.store = StateFile(path)
+        self.path = path
+        self.script = script
+        self.api = api
+        self.stale = stale
+        self.max_stale = max_stale
+        self.failures = failures
+        self.reset = reset
+
+    def age(self, state):
+        return time.time() - state.get("stamp", 0)
+
+    def is_open(self, state):
+        return state.get("open_until", 0) > time.time()
+
+    def usable(self, state, window):
+        return state.get("nodes") is not None and self.age(state) <= window
+
+    def success(self, nodes):
+        self.store.write({ "stamp": time.time(), "nodes": nodes, "failures": 0,
+            "open_until": 0 })
+
+    def failure(self):
+        state = self.store.read()
+        failures = state.get("failures", 0) + 1
+        update = { "failures": failures }
+        if failures >= self.failures:
+            update["open_until"] = time.time() + self.reset
+        self.store.write(update)
+
+    def revalidate(self, argv):
+        # Start a background fetch unless one is already running
+        guard = open(self.path + ".refresh", "a")
+        try:
+            fcntl.flock(guard, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except IOError:
+            return
+        finally:
+            guard.close()
+        spawn([self.script] + argv[1:] + ["--refresh=true"])
+
+    def status(self, argv, fetch, refresh=False):
+        # Returns the node list, and whether it was fetched from the API
+        state = self.store.read()
+        if refresh:
+            guard = open(self.path + ".refresh", "a")
+            try:
+                fcntl.flock(guard, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except IOError:
+                guard.close()
+                sys.exit(0)
+        elif self.usable(state, self.stale):
+            if not self.is_open(state):
+                self.revalidate(argv)
+            return state["nodes"], False
+        elif self.is_open(state):
+            if self.usable(state, self.max_stale):
+                return state["nodes"], False
+            error("{} failing, not retrying for {} seconds".format(self.api,
+                int(state["open_until"] - time.time())))
+            sys.exit(1)
+        try:
+            try:
+                nodes = fetch()
+            except (Exception, SystemExit) as e:
+                self.failure()
+                if not refresh and self.usable(state, self.max_stale):
+                    # A SystemExit has already reported its error
+                    reason = "" if isinstance(e, SystemExit) else ": {}".format(e)
+                    error("Status failed, using nodes from {} seconds ago{}".format(
+                        int(self.age(state)), reason))
+                    return state["nodes"], False
+                raise
+            self.success(nodes)
+            return nodes, True
+        finally:
+            if refresh:
+                guard.close()
+
+
+def write_cached(opts, history, nodes, out):
+    # Writes a node list answered by the status cache. The fetch behind it
+    # logged its changes in the history, so a --deltasince poll is answered
+    # from there, and reports the nodes destroyed since as well.
+    if "deltasince" in opts.keys() and history.current is not None:
+        out.write_all(history.since(delta_since(opts, int(time.time()))))
+    else:
+        out.write_all(nodes)
+
+
+def get_status_cache(opts, base, script, api):
+    # statusStale turns the cache on, keeping the node list in base.status.
+    # script is run with --refresh=true to fetch a new list in the background.
+    if "statusStale" not in opts.keys() or base is None:
+        return None
+    stale = int(opts["statusStale"])
+    max_stale = int(opts["statusMaxStale"]) if "statusMaxStale" in opts.keys() else 600
+    failures = int(opts["breakerFailures"]) if "breakerFailures" in opts.keys() else 3
+    reset = int(opts["breakerReset"]) if "breakerReset" in opts.keys() else 30
+    return StatusCache(base + ".status", script, api, stale, max(max_stale, stale), failures, reset)
+
+
+
+
+def forward_request(path, argv):
+    # Hand the request to a running daemon. Returns None if there isn't one.
+    if path is None or not os.path.exists(path):
+        return None
+    client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        client.connect(path)
+    except socket.error:
+        client.close()
+        return None
+    try:
+        client.sendall(json.dumps(argv))
+        client.shutdown(socket.SHUT_WR)
+        data = []
+        while True:
+            chunk = client.recv(65536)
+            if not chunk:
+                break
+            data.append(chunk)
+    finally:
+        client.close()
+    if len(data) == 0:
+        error("Daemon closed the connection: " + path)
+        return 1
+    reply = json.loads("".join(data))
+    sys.stdout.write(reply["stdout"])
+    sys.stderr.write(reply["stderr"])
+    return reply["code"]
+
+
+def start_daemon(path, script, args):
+    # Start a daemon listening on path in the background to serve the next
+    # request, unless one is already running
+    if path is None or os.path.exists(path):
+        return
+    spawn([script, "daemon"] + args)
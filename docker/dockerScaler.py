@@ -8,8 +8,16 @@ import sys
 import os
 import time
 import re
-import requests
 import json
+import threading
+
+# drivercommon.py is uploaded alongside the driver, or found in the common
+# directory of a checkout
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "common"))
+from drivercommon import (run_parallel, find_zeus_home, forward_request, start_daemon,
+    NodeHistory, StatusWriter, DriverDaemon, Tracer, trace_session, get_trace_path,
+    get_profiler, get_profile_base, get_rate_limiter, limit_session, get_status_cache,
+    is_set, delta_since, write_cached, plan_reconcile, print_plan, planned_results)
 
 def debug(msg):
     if opts["verbose"] == "1":
@@ -66,8 +74,30 @@ def getCCopts(opts):
             sys.stderr.write("ERROR - 'keys' must be specified when using https in config file: " + opts["cred1"] + "\n")
             sys.exit(1)
 
+def urlTemplate(url):
+    # Drop the host and query, and replace the container ids in the path, so
+    # requests for different containers are summarised together
+    path = re.sub("^\w+://[^/]+", "", url).split("?")[0]
+    return re.sub("/containers/(?!json$|create$)[^/]+", "/containers/{id}", path)
+
+def getStateBase(opts):
+    # Traces, profiles, the history and the status cache are kept in
+    # zxtm/internal, named after the cloud credential
+    if "cloudcreds" not in opts.keys():
+        return None
+    return opts["ZH"] + "/zxtm/internal/docker." + opts["cloudcreds"]
+
 def newSession():
-    client = requests.Session()
+    # Sessions are kept for the life of the process, so a daemon reuses its
+    # connections to the Docker API between requests. requests is imported
+    # where it is used, so that help and forwarded requests start quickly.
+    import requests
+    key = (opts["url"], opts.get("ca"), opts.get("keys"), opts.get("rateLimit"),
+        opts.get("rateBurst"), opts.get("ratefile"))
+    if key in sessions:
+        return sessions[key]
+    limiter = get_rate_limiter(opts, opts["ZH"] + "/zxtm/internal/docker.ratelimit")
+    client = limit_session(trace_session(requests.Session(), urlTemplate), limiter)
     if opts["url"].startswith("https://"):
         cas =  opts["ZH"] + "/zxtm/conf/ssl/cas/" + opts["ca"]
         clientCert = opts["ZH"] + "/zxtm/conf/ssl/client_keys/" + opts["keys"] + ".public"
@@ -76,20 +106,67 @@ def newSession():
         debug("Using Keys: " + clientCert + ", " + clientKey)
         client.verify=cas   
         client.cert=(clientCert, clientKey)
+    sessions[key] = client
     return client
         
-def getNodeStatus(filter, value):
-
+def getNodeStatus(filter, value, history=None):
+    return list(iterNodeStatus(filter, value, history))
+
+def getStarted(client, since):
+    # Returns the ids of the containers started since since, or None if we
+    # can't tell. The daemon only keeps its last few events, so if there are
+    # many we assume some were lost.
+    import requests
+    if since is None:
+        return None
+    params = { "since": int(since) - 1, "until": int(time.time()) }
+    try:
+        with Tracer.current().phase("events"):
+            response = client.get( opts["url"] + "/events", params=params )
+    except requests.RequestException as err:
+        debug("Failed to read events: " + str(err))
+        return None
+    if response.status_code != 200:
+        debug("Failed to read events: " + str(response.status_code))
+        return None
+
+    # The events are a stream of JSON objects, not a list
+    events = []
+    decoder = json.JSONDecoder()
+    text = response.text.strip()
+    index = 0
+    while index < len(text):
+        event, index = decoder.raw_decode(text, index)
+        events.append(event)
+        while index < len(text) and text[index].isspace():
+            index += 1
+    if len(events) >= 64:
+        return None
+    return set(event.get("id") for event in events if event.get("status") in ("start", "restart"))
+
+def iterNodeStatus(filter, value, history=None):
+    import requests
+
+    tracer = Tracer.current()
     client = newSession()
     try:
-        response = client.get( opts["url"] + "/containers/json?all=1" )
+        with tracer.phase("list"):
+            response = client.get( opts["url"] + "/containers/json?all=1" )
     except requests.RequestException as err:
-        print "Error: Request Failed: " + str(err)
+        sys.stderr.write("ERROR - Request Failed: " + str(err) + "\n")
         sys.exit(1)
 
     debug ( response.text )
+    if response.status_code != 200:
+        sys.stderr.write("ERROR - Failed to list containers: " + str(response.status_code) + "\n")
+        sys.exit(1)
+
+    # A container restarted since the history was checked may have a new
+    # address, so it is inspected again, as is every container if we can't
+    # tell which were restarted
+    known = history.current if history is not None else None
+    started = getStarted(client, history.checked) if known is not None else None
 
-    nodes = []
     dHash = response.json()
     for server in dHash:
     
@@ -107,16 +184,8 @@ def getNodeStatus(filter, value):
             if name != value:
                 continue
 
-        config = client.get( opts["url"] + "/containers/" + id +"/json?all=1" )
-        if config is None:
-            continue
-        config = config.json()
-
         imageID = server["Image"]
         state = server["Status"]
-        created = config["Created"]
-        privateIP = config["NetworkSettings"]["IPAddress"]
-        publicIP = config["NetworkSettings"]["IPAddress"]
 
         status = "pending"
         complete = 50
@@ -129,26 +198,85 @@ def getNodeStatus(filter, value):
         else:
             status = "pending"
 
-        node = { "uniq_id": id, "name": name, "status": status, "private_ip": privateIP, 
-            "public_ip": publicIP, "imageid": imageID, "complete": complete, "created": created }
-        nodes.append( node );
+        # A container keeps its address until it is stopped, so a node we have
+        # seen in the same state before, and which hasn't been restarted since,
+        # is not inspected again
+        seen = known.get(name) if started is not None else None
+        if seen is not None and seen["uniq_id"] == id and seen["status"] == status and \
+            status != "pending" and id not in started:
+            node = dict(seen)
+            node["imageid"] = imageID
+            yield node
+            continue
 
-    return nodes
+        with tracer.phase("enrich"):
+            config = client.get( opts["url"] + "/containers/" + id +"/json?all=1" )
+        if config is None:
+            continue
+        config = config.json()
 
+        created = config["Created"]
+        privateIP = config["NetworkSettings"]["IPAddress"]
+        publicIP = config["NetworkSettings"]["IPAddress"]
 
-def getStatus():
-    nodes = getNodeStatus("","")
-    returnData = { "NodeStatusResponse": { "version": 1, "code": 200, "nodes": nodes } } 
-    json.dump(returnData, sys.stdout )
+        node = { "uniq_id": id, "name": name, "status": status, "private_ip": privateIP, 
+            "public_ip": publicIP, "imageid": imageID, "complete": complete, "created": created }
+        yield node
+
+def getHistory():
+    retain = int(opts["historyTTL"]) if "historyTTL" in opts.keys() else 3600
+    path = opts.get("historyfile", getStateBase(opts) + ".history")
+    return NodeHistory(path, retain)
+
+def writeDelta(history, nodes, out, now):
+    # Every node is written out as the history reads it, unless only the
+    # changes since deltasince are wanted. now is when the containers were
+    # listed.
+    delta = history.current is not None and "deltasince" in opts.keys()
+    checked = history.checked
+    changed = history.update(nodes if delta else out.passing(nodes), now)
+    with Tracer.current().phase("history"):
+        # Saving when nothing has changed keeps the window of events read by
+        # the next poll short
+        if changed or now - checked > 60:
+            history.save()
+
+    if delta:
+        out.write_all(history.since(delta_since(opts, now)))
+
+def getStatus(argv):
+    # The history is read before the API is polled, or after an answer from
+    # the status cache to answer --deltasince
+    cache = get_status_cache(opts, getStateBase(opts), os.path.abspath(__file__), "Docker API")
+    history = []
+
+    now = []
+
+    def fetch():
+        history.append(getHistory())
+        now.append(int(time.time()))
+        return getNodeStatus("", "", history[0])
+
+    with StatusWriter(sys.stdout) as out:
+        if cache is None:
+            history.append(getHistory())
+            writeDelta(history[0], iterNodeStatus("", "", history[0]), out, int(time.time()))
+        else:
+            nodes, live = cache.status(argv, fetch, "refresh" in opts.keys())
+            if live:
+                writeDelta(history[0], nodes, out, now[0])
+            else:
+                write_cached(opts, getHistory(), nodes, out)
 
-def createNode():
+def createNode(name):
+    import requests
 
     client = newSession()
     headers = { "Content-Type": "application/json" }
 
     payload = { "HostConfig": json.loads(opts["HostConfig"]), 
                 "Image": opts["imageid"],
-                "Labels": {"name": opts["name"]},
+                "Labels": {"name": name},
                 "Env": [] }
 
     for env in opts.keys():
@@ -158,9 +286,9 @@ def createNode():
     debug( "SENDING -> " + json.dumps(payload) )
 
     try:
-        response = client.post( opts["url"] + "/containers/create?name=" + opts["name"], data=json.dumps(payload), headers=headers )
+        response = client.post( opts["url"] + "/containers/create?name=" + name, data=json.dumps(payload), headers=headers )
     except requests.RequestException as err:
-        print "Error: Request Failed: " + str(err)
+        sys.stderr.write("ERROR - Request Failed: " + str(err) + "\n")
         sys.exit(1)
 
     if ( response.status_code != 201 ):
@@ -171,7 +299,7 @@ def createNode():
     try:
         response = client.post( opts["url"] + "/containers/" + created["Id"] + "/start" )
     except requests.RequestException as err:
-        print "Error: Request Failed: " + str(err)
+        sys.stderr.write("ERROR - Request Failed: " + str(err) + "\n")
         sys.exit(1)
     
     if ( response.status_code != 204 ):
@@ -182,7 +310,7 @@ def createNode():
 
 def addNode():
 
-    created = createNode()
+    created = createNode(opts["name"])
     if created is not None:
         myNode = None
         loop = 0
@@ -204,15 +332,19 @@ def addNode():
     json.dump(returnData, sys.stdout )
 
 
-def delNode():
-    
+def removeContainer(id):
     client = newSession()
+    response = client.post( opts["url"] + "/containers/" + id + "/stop?t=5" )
+    debug("Stop Container: " + response.text)
+    response = client.delete( opts["url"] + "/containers/" + id + "?v=1&force=1" )
+    debug("Delete Container: " + response.text)
+    return response
+
+def delNode():
+    import requests
 
     try:
-        response = client.post( opts["url"] + "/containers/" + opts["id"] + "/stop?t=5" )
-        debug("Stop Container: " + response.text)
-        response = client.delete( opts["url"] + "/containers/" + opts["id"] + "?v=1&force=1" )
-        debug("Delete Container: " + response.text)
+        response = removeContainer(opts["id"])
 
         if ( response.status_code != 204 ):
             debug("Failed to Delete Container: " + response.content)
@@ -221,7 +353,7 @@ def delNode():
             sys.exit(1)
 
     except requests.RequestException as err:
-        print "Error: Request Failed: " + str(err)
+        sys.stderr.write("ERROR - Request Failed: " + str(err) + "\n")
         sys.exit(1)
 
     returnData = { "DestroyNodeResponse": { "version": 1, "code": 202, "nodes": 
@@ -230,64 +362,279 @@ def delNode():
     json.dump(returnData, sys.stdout )
 
 
+def reconcileNode(job):
+    action, node = job
+    name = node if action == "create" else node["name"]
+    try:
+        if action == "create":
+            created = createNode(name)
+            if created is None:
+                raise Exception("Failed to create container")
+            return { "action": action, "uniq_id": created["Id"], "name": name,
+                "status": "pending", "complete": 50, "imageid": opts["imageid"],
+                "private_ip": "", "public_ip": "",
+                "created": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()) }
+        response = removeContainer(node["uniq_id"])
+        if response.status_code != 204:
+            raise Exception("Failed to delete container: " + str(response.status_code))
+    except (Exception, SystemExit) as e:
+        return { "action": action, "name": name, "status": "failed", "error": str(e) }
+    return { "action": action, "uniq_id": node["uniq_id"], "name": name,
+        "status": "destroyed", "complete": 100 }
+
+def reconcile():
+    # Returns the number of nodes which failed
+    if "count" not in opts.keys() or "imageid" not in opts.keys():
+        sys.stderr.write("ERROR - You must provide --count and --imageid to reconcile\n")
+        sys.exit(1)
+
+    history = getHistory()
+    now = int(time.time())
+    nodes = getNodeStatus("", "", history)
+    with Tracer.current().phase("history"):
+        if history.update(nodes, now):
+            history.save()
+    create, destroy = plan_reconcile(nodes, int(opts["count"]), { "imageid": opts["imageid"] },
+        opts["prefix"] if "prefix" in opts.keys() else "node")
+    print_plan(opts["count"], [(name, (opts["imageid"],)) for name in create], destroy)
+
+    results = []
+    dryrun = is_set(opts, "dryrun")
+    if dryrun:
+        results = planned_results(create, destroy)
+    else:
+        jobs = [("destroy", node) for node in destroy] + [("create", name) for name in create]
+        parallel = int(opts["parallel"]) if "parallel" in opts.keys() else 8
+        # The workers act on this request's options
+        current = opts.current()
+        def job(item):
+            opts.use(current)
+            return reconcileNode(item)
+        results = run_parallel(job, jobs, parallel)
+
+    failed = len([result for result in results if result["status"] == "failed"])
+    code = 500 if failed > 0 else 202 if len(results) > 0 and not dryrun else 200
+    json.dump({ "ReconcileResponse": { "version": 1, "code": code, "nodes": results }}, sys.stdout)
+    return failed
+
+
 def help():
     sys.stderr.write("Usage: dockerScaler.py [--help] action options\n\n")
-    sys.stderr.write("   action: [status|createnode|destroynode]\n\n")
+    sys.stderr.write("   action: [status|createnode|destroynode|reconcile|daemon]\n\n")
     sys.stderr.write("   common options:\n")
     sys.stderr.write("      --verbose=1          Print verbose logging messages to the CLI\n")
-    sys.stderr.write("      --cloudcreds=NAME    File in \$ZEUSHOME/zxtm/conf/cloudcredentials which stores the credentials\n\n")
+    sys.stderr.write("      --cloudcreds=NAME    File in \$ZEUSHOME/zxtm/conf/cloudcredentials which stores the credentials\n")
+    sys.stderr.write("      --trace=true         Append a trace of the HTTP requests and phases to zxtm/internal\n")
+    sys.stderr.write("      --tracefile=FILE     Write the trace to FILE instead\n")
+    sys.stderr.write("      --traceMaxKB=KB      Rotate the trace file at this size (default 5120)\n")
+    sys.stderr.write("      --profile=TOP        Profile the action and report the TOP functions and allocations\n")
+    sys.stderr.write("      --profilefile=BASE   Write BASE.prof and BASE.profile.txt (default zxtm/internal/docker.NAME)\n")
+    sys.stderr.write("      --rateLimit=RPS      Pace requests to the Docker API from every process (default 0, no limit)\n")
+    sys.stderr.write("      --rateBurst=N        Allow bursts of up to N requests (default RPS)\n")
+    sys.stderr.write("      --ratefile=FILE      Shared limiter state (default zxtm/internal/docker.ratelimit)\n\n")
+    sys.stderr.write("   status:\n")
+    sys.stderr.write("      --deltasince=TIME    Only report nodes changed since this time\n")
+    sys.stderr.write("      --historyTTL=S       Keep node changes for deltasince for S seconds (default 3600)\n")
+    sys.stderr.write("      --historyfile=FILE   Node history (default zxtm/internal/docker.NAME.history)\n")
+    sys.stderr.write("      --statusStale=S      Answer from the last node list if younger than S seconds, refreshing it\n")
+    sys.stderr.write("                           in the background\n")
+    sys.stderr.write("      --statusMaxStale=S   Report a list up to S seconds old if the API fails (default 600)\n")
+    sys.stderr.write("      --breakerFailures=N  Stop polling a failing API after N errors in a row (default 3)\n")
+    sys.stderr.write("      --breakerReset=S     ...for S seconds (default 30)\n\n")
     sys.stderr.write("   action-specific options (required):\n")
     sys.stderr.write("   createnode:\n")
     sys.stderr.write("      --name=NODENAME      Name to give newly created node\n")
     sys.stderr.write("      --imageid=IMAGEID    ID of the image to create a new instance of\n")
     sys.stderr.write("      --sizeid=SIZEID      ID of the server size/flavour to use\n")
     sys.stderr.write("   destroynode:\n")
-    sys.stderr.write("      --id=SERVERID        ID of the server to destroy\n\n")
+    sys.stderr.write("      --id=SERVERID        ID of the server to destroy\n")
+    sys.stderr.write("   reconcile:\n")
+    sys.stderr.write("      --count=N            Number of nodes wanted\n")
+    sys.stderr.write("      --imageid=IMAGE      Image the nodes should run\n")
+    sys.stderr.write("      --prefix=NAME        Name prefix for new nodes, and only count or destroy\n")
+    sys.stderr.write("                           containers named NAME<n> (default node)\n")
+    sys.stderr.write("      --parallel=N         Creates and deletes sent at once (default 8)\n")
+    sys.stderr.write("      --dryrun[=true]      Print the plan without applying it\n")
+    sys.stderr.write("   daemon:\n")
+    sys.stderr.write("      --idle=SECONDS       Exit after this long without a request (default 3600)\n\n")
     sys.exit(1)
 
-# Main block begin
+def getSocketPath(argv):
+    # One daemon per cloud credential
+    kvp = None
+    for arg in argv:
+        kvp = re.search("--cloudcreds=(.*)", arg) or kvp
+    if kvp is None:
+        return None
+    zh = find_zeus_home()
+    if zh is None:
+        return None
+    return zh + "/zxtm/internal/docker." + kvp.group(1) + ".sock"
+
+def startDaemon(argv):
+    # Start a daemon in the background to serve the next request
+    if len(argv) < 2 or argv[1].lower() == "daemon":
+        return
+    start_daemon(getSocketPath(argv), os.path.abspath(__file__),
+        [arg for arg in argv[2:] if re.match("--(cloudcreds|idle)=", arg)])
+
+def runDaemon(argv):
+    path = getSocketPath(argv)
+    if path is None:
+        sys.stderr.write("ERROR - You must provide a cloudcreds argument to run a daemon\n")
+        sys.exit(1)
+    idle = int(opts["idle"]) if "idle" in opts.keys() else 3600
+    DriverDaemon(path, runLocked, idle).serve()
 
-# Check for ZEUSHOME and set up default options
-opts = {"verbose": 0 }
-opts["ZH"] = os.environ.get("ZEUSHOME")
-if opts["ZH"] == None:
-    if os.path.isdir("/usr/local/zeus"):
-        opts["ZH"] = "/usr/local/zeus";
-    elif os.path.isdir("/opt/zeus"):
-        opts["ZH"] = "/opt/zeus";
+def getOpts(argv):
+    args = {}
+    for arg in argv:
+        kvp = re.search("--([^=]+)=*(.*)", arg)
+        if kvp != None:
+            args[kvp.group(1)] = kvp.group(2)
+    return args
+
+def runLocked(argv):
+    # Status polls run side by side, but containers are created and deleted
+    # one request at a time, so two requests never pick the same name
+    if len(argv) > 1 and argv[1].lower() in ("createnode", "destroynode", "reconcile"):
+        with requestLock:
+            run(argv)
     else:
-        sys.stderr.write("ERROR - Can not find ZEUSHOME\n")
-        sys.exit(1)
+        run(argv)
+
+def run(argv):
+    # Every action is traced in memory, and the trace written out if trace is
+    # set in the config or on the command line
+    tracer = Tracer("docker", argv[1].lower() if len(argv) > 1 else None)
+    Tracer.local.tracer = tracer
+    profiler = get_profiler(getOpts(argv))
+    code = 1
+    try:
+        if profiler is not None:
+            profiler.start()
+        runAction(argv)
+        code = 0
+    except SystemExit as e:
+        code = e.code if isinstance(e.code, int) or e.code is None else 1
+        raise
+    finally:
+        Tracer.local.tracer = None
+        tracer.finish(code or 0)
+        if profiler is not None:
+            profiler.stop()
+            try:
+                sys.stderr.write(profiler.report(get_profile_base(opts, getStateBase(opts))))
+            except (IOError, OSError) as e:
+                sys.stderr.write("ERROR - Failed to write profile: {}\n".format(e))
+
+def runAction(argv):
+
+    # Check for ZEUSHOME and set up default options
+    opts.use({"verbose": 0 })
+    opts["ZH"] = os.environ.get("ZEUSHOME")
+    if opts["ZH"] == None:
+        if os.path.isdir("/usr/local/zeus"):
+            opts["ZH"] = "/usr/local/zeus";
+        elif os.path.isdir("/opt/zeus"):
+            opts["ZH"] = "/opt/zeus";
+        else:
+            sys.stderr.write("ERROR - Can not find ZEUSHOME\n")
+            sys.exit(1)
+
+    # Read in the first argument or display the help
+    if len(argv) < 2:
+        help()
+    else:
+        action = argv[1]
+
+    # Process additional arguments
+    opts.update(getOpts(argv))
+
+    # We always need a cloudcreds... Check it here
+    if "cloudcreds" in opts.keys():
+        with Tracer.current().phase("config"):
+            getCCopts(opts)
+        maxBytes = int(opts["traceMaxKB"]) * 1024 if "traceMaxKB" in opts.keys() else 5242880
+        Tracer.current().enable(get_trace_path(opts, getStateBase(opts)), maxBytes)
+        debug("CC options parsed. Connecting to " + opts["url"] )
+    else:
+        sys.stderr.write("ERROR - You must provide a cloudcreds argument!")
+        help()
+
+    # Check the action and call the appropriate function
+    if action.lower() == "help":
+        help()
+    elif action.lower() == "status":
+        getStatus(argv)
+    elif action.lower() == "createnode":
+        addNode()
+    elif action.lower() == "destroynode":
+        delNode()
+    elif action.lower() == "reconcile":
+        if reconcile() > 0:
+            sys.exit(1)
+    elif action.lower() == "daemon":
+        runDaemon(argv)
+    else:
+        help()
+
+def main(argv=None):
+    argv = sys.argv if argv is None else argv
+
+    # Requests are served by the daemon for this cloud credential if one is
+    # running, otherwise we do the work here. Profiled requests always run
+    # here, so the profile covers just this action, as do background status
+    # refreshes.
+    if len(argv) > 1 and argv[1].lower() not in ("daemon", "help") and \
+        get_profiler(getOpts(argv)) is None and "refresh" not in getOpts(argv).keys():
+        code = forward_request(getSocketPath(argv), argv)
+        if code is not None:
+            sys.exit(code)
+    try:
+        run(argv)
+    finally:
+        if str(opts.get("daemon", "")).lower() == "true":
+            startDaemon(argv)
+
+class RequestOptions:
+
+    # The options of the action being run. The daemon runs each request in
+    # its own thread, so each thread sees the options of its own request.
+    # Threads which haven't been given any see the defaults.
+
+    def __init__(self, defaults):
+        self.defaults = defaults
+        self.local = threading.local()
+
+    def use(self, options):
+        self.local.options = options
+
+    def current(self):
+        return getattr(self.local, "options", self.defaults)
+
+    def __getitem__(self, key):
+        return self.current()[key]
+
+    def __setitem__(self, key, value):
+        self.current()[key] = value
+
+    def __contains__(self, key):
+        return key in self.current()
+
+    def keys(self):
+        return self.current().keys()
+
+    def get(self, key, default=None):
+        return self.current().get(key, default)
+
+    def update(self, options):
+        self.current().update(options)
 
-# Read in the first argument or display the help
-if len(sys.argv) < 2:
-    help()
-else:
-    action = sys.argv[1]
-
-# Process additional arguments
-for arg in sys.argv:
-    kvp = re.search("--([^=]+)=(.*)", arg)
-    if kvp != None:
-        opts[kvp.group(1)] = kvp.group(2)
-
-# We always need a cloudcreds... Check it here
-if "cloudcreds" in opts.keys():
-    getCCopts(opts)
-    debug("CC options parsed. Connecting to " + opts["url"] )
-else:
-    sys.stderr.write("ERROR - You must provide a cloudcreds argument!")
-    help()
-
-# Check the action and call the appropriate function
-if action.lower() == "help":
-    help()
-elif action.lower() == "status":
-    getStatus()
-elif action.lower() == "createnode":
-    addNode()
-elif action.lower() == "destroynode":
-    delNode()
-else:
-    help()
+# Connections and the lock used when running as a daemon
+opts = RequestOptions({"verbose": 0 })
+sessions = {}
+requestLock = threading.Lock()
 
+if __name__ == "__main__":
+    main()
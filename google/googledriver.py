@@ -26,8 +26,22 @@ import sys
 import os
 import re
 import json
-import requests
 import time
+import copy
+import threading
+
+# drivercommon.py is uploaded alongside the driver, or found in the common
+# directory of a checkout
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "common"))
+import drivercommon
+from drivercommon import (run_parallel, find_zeus_home, forward_request, start_daemon,
+    NodeHistory, StatusWriter, DriverDaemon, Tracer, trace_session, get_trace_path,
+    get_profiler, get_profile_base, get_rate_limiter, limit_session, get_status_cache,
+    is_set, delta_since, write_cached, pool_member, plan_reconcile, print_plan, planned_results)
+
+# The shared code reports its errors the way this driver does
+drivercommon.ERROR_PREFIX = "ERR"
+
 
 class GoogleComputeManager:
 
@@ -35,19 +49,22 @@ class GoogleComputeManager:
     authUri = "http://metadata/computeMetadata/v1/instance/service-accounts" + \
               "/default/token"
     localAuth = True
-    instances = {}
+    instances = None
     instUri = None
     project = None
     zone = None
     authState = None
     creds = None
+    session = None
+    lock = None
 
     BROCADE_PROJECT = 'brocade-public-1063'
     BROCADE_VTM = 'vtm-103r1-stm-dev-64'
     BROCADE_TYPE = 'n1-standard-1'
     BROCADE_DISK = 16
 
-    def __init__(self, project, zone, authFile=None, authState=None):
+    def __init__(self, project, zone, authFile=None, authState=None, api=None,
+        limiter=None):
 
         if authFile is not None:
             self.localAuth = False
@@ -63,9 +80,21 @@ class GoogleComputeManager:
             sf.close()
             self.creds.update(update)
 
+        # Imported here so that help and requests handed to a daemon don't
+        # pay for it
+        import requests
         self.authState = authState
+        self.session = trace_session(requests.Session(), urlTemplate)
+        if limiter is not None:
+            limit_session(self.session, limiter, endpointKey)
+        self.lock = threading.Lock()
+        # The instances being started. The manager outlives a request in the
+        # daemon, so each one is dropped once it has been started.
+        self.instances = {}
         self.project = project
         self.zone = zone
+        if api is not None:
+            self.api = api.rstrip("/") + "/compute/v1/projects/"
         self.instUri = self.api + project + "/zones/" + zone + "/instances" 
         
     def newInst(self, name, image, machineType=None, diskSizeGb=None,
@@ -109,6 +138,7 @@ class GoogleComputeManager:
             self.instances[name].addNatIP(natIP)
 
         status = self.start(name)
+        del self.instances[name]
         print status
 
     def auth(self):
@@ -128,7 +158,7 @@ class GoogleComputeManager:
     def refreshToken(self):
         if self.localAuth == True:
             headers = { 'Metadata-Flavor': 'Google' }
-            response = requests.get( self.authUri, headers=headers)
+            response = self.session.get( self.authUri, headers=headers)
             update = json.loads(response.text)
         else:
             data = {
@@ -137,7 +167,7 @@ class GoogleComputeManager:
                 'refresh_token': self.creds['refresh_token'],
                 'grant_type': 'refresh_token'
             }
-            response = requests.post(self.creds['token_uri'], data=data)
+            response = self.session.post(self.creds['token_uri'], data=data)
             update = response.json()
 
         self.creds['access_token'] = update['access_token']
@@ -151,7 +181,7 @@ class GoogleComputeManager:
         inst = self.instances[name]
         headers = { 'Authorization': 'Bearer ' + self.creds['access_token'], \
             "Content-Type": "application/json" }
-        response = requests.post( self.instUri, data = json.dumps(inst.conf),\
+        response = self.session.post( self.instUri, data = json.dumps(inst.conf),\
             headers = headers )
         return response.json()
 
@@ -161,35 +191,93 @@ class GoogleComputeManager:
         else:
             uri = self.instUri + "/" + name
         headers = { 'Authorization': 'Bearer ' + self.creds['access_token'] }
-        response = requests.get( uri, headers=headers )
+        response = self.session.get( uri, headers=headers )
         if response.status_code != 200:
             ret = { "FAILED": True, "Code": response.status_code, 
                     "Error": response.text}
             return ret
-        return response.json()
+        result = response.json()
+
+        # Instance lists come back in pages of up to 500
+        while name is None and "nextPageToken" in result.keys():
+            params = { "pageToken": result.pop("nextPageToken") }
+            response = self.session.get( uri, headers=headers, params=params )
+            if response.status_code != 200:
+                ret = { "FAILED": True, "Code": response.status_code, 
+                        "Error": response.text}
+                return ret
+            page = response.json()
+            result["items"] = result.get("items", []) + page.get("items", [])
+            if "nextPageToken" in page.keys():
+                result["nextPageToken"] = page["nextPageToken"]
+        return result
 
     def stop(self, name):
         headers = { 'Authorization': 'Bearer ' + self.creds['access_token'] }
         print "Stopping -> " + self.instUri + "/" + name + "/stop"
-        response = requests.post( self.instUri + "/" + name + "/stop", \
+        response = self.session.post( self.instUri + "/" + name + "/stop", \
             headers = headers )
         return response.json()
 
+    def wait(self, op, timeout=120):
+        # Poll a zone operation until it is DONE, or timeout seconds pass.
+        # A failed operation comes back with its "error".
+        headers = { 'Authorization': 'Bearer ' + self.creds['access_token'] }
+        start = time.time()
+        delay = 1
+        while op.get("status") != "DONE" and "selfLink" in op.keys():
+            if time.time() - start > timeout:
+                break
+            time.sleep(delay)
+            delay = min(delay * 2, 10)
+            response = self.session.get( op["selfLink"], headers=headers )
+            if response.status_code != 200:
+                break
+            op = response.json()
+        return op
+
     def delete(self, name):
         headers = { 'Authorization': 'Bearer ' + self.creds['access_token'] }
-        response = requests.delete( self.instUri + "/" + name, headers=headers)
+        response = self.session.delete( self.instUri + "/" + name, headers=headers)
         return response.json()
 
+    def preemptions(self):
+        # Names of instances which GCE has preempted, from the operation log
+        return self.operationTargets('operationType="compute.instances.preempted"')
+
+    def deleting(self):
+        # Names of instances with a delete still in progress
+        return self.operationTargets('(operationType="delete") AND (status!="DONE")')
+
+    def operationTargets(self, filter):
+        headers = { 'Authorization': 'Bearer ' + self.creds['access_token'] }
+        opsUri = self.instUri.rsplit('/',1)[0] + "/operations"
+        params = { "filter": filter }
+        response = self.session.get( opsUri, headers=headers, params=params)
+        if response.status_code != 200:
+            return []
+        ops = response.json()
+        names = []
+        if "items" in ops.keys():
+            for op in ops["items"]:
+                names.append(op["targetLink"].rsplit('/',1)[1])
+        return names
+
+    def isPreemptible(self, item):
+        sched = item.get("scheduling", {})
+        return sched.get("preemptible", False) is True or \
+            sched.get("provisioningModel") == "SPOT"
+
     def getDiskInfo(self, disk):
         headers = { 'Authorization': 'Bearer ' + self.creds['access_token'] }
         diskUri = self.instUri.rsplit('/',1)[0] + "/disks/" + disk
-        response = requests.get( diskUri, headers=headers)
+        response = self.session.get( diskUri, headers=headers)
         return response.json()
 
     def listVTMs(self):
         headers = { 'Authorization': 'Bearer ' + self.creds['access_token'] }
         imageURI = self.api + "brocade-public-1063/global/images"
-        response = requests.get( imageURI, headers=headers)
+        response = self.session.get( imageURI, headers=headers)
         list = response.json()
         if "items" in list.keys():
             for item in list["items"]:
@@ -197,6 +285,23 @@ class GoogleComputeManager:
                     print "{}\t\t{}".format(item['description'],item['name'])
 	
 
+def urlTemplate(url):
+    # Drop the host and query, and replace the names in the path, so requests
+    # for different instances are summarised together
+    path = re.sub("^\w+://[^/]+", "", url).split("?")[0]
+    return re.sub("/(instances|disks|operations)/[^/]+", "/\\1/{name}", path)
+
+def endpointKey(url):
+    # Compute Engine quotas are per project
+    return re.sub("^(\w+://[^/]+)(/compute/v1/projects/[^/]+|).*", "\\1\\2", url)
+
+def getStateBase(opts):
+    # Traces, profiles and the status cache are kept next to the state file
+    if opts.get("statefile") is None:
+        return None
+    return os.path.splitext(opts["statefile"])[0]
+
+
 class GoogleComputeInstance:
 
     deployed = False
@@ -252,6 +357,8 @@ class GoogleComputeInstance:
     }
 
     def __init__( self, name, project, zone, image, machineType=None, diskSizeGb=None ):
+        # conf is a template, take a private copy so instances don't share it
+        self.conf = copy.deepcopy(self.conf)
         self.name = name
         self.project = project
         self.zone = zone
@@ -277,6 +384,26 @@ class GoogleComputeInstance:
         self.conf["networkInterfaces"][0]["network"] = "projects/" + project \
             + "/global/networks/default",
 
+    def setCapacity(self, model=None, pool=None):
+        # model is None for standard capacity, or one of "spot"/"preemptible".
+        # Spot nodes are stopped rather than deleted on preemption, so that
+        # the driver can see them and start a replacement. The pool label
+        # scopes the spot share to the nodes of one pool.
+        if model == "spot":
+            self.conf["scheduling"] = { "provisioningModel": "SPOT",
+                "instanceTerminationAction": "STOP",
+                "onHostMaintenance": "TERMINATE", "automaticRestart": False }
+        elif model == "preemptible":
+            self.conf["scheduling"] = { "preemptible": True,
+                "onHostMaintenance": "TERMINATE", "automaticRestart": False }
+        else:
+            model = "standard"
+            self.conf["scheduling"] = { "preemptible": False,
+                "onHostMaintenance": "MIGRATE", "automaticRestart": True }
+        self.conf["labels"] = { "vtm-capacity": model }
+        if pool is not None:
+            self.conf["labels"]["vtm-pool"] = pool
+
     def allowIpForward(self, fwd=True):
         self.conf["canIpForward"] = fwd
 
@@ -310,7 +437,7 @@ def help():
     text="""
     Usage: googledriver.py [--help] action options
 
-        action: [status|createnode|destroynode]
+        action: [status|createnode|destroynode|reconcile|daemon]
 
         common options:
             --verbose=1          Print verbose logging messages to the CLI
@@ -321,6 +448,24 @@ def help():
             --cred2=<project>
             --cred3=<region>
 
+            --apiHost=<url>      Use another Compute API endpoint, eg a test
+                                 server (default https://www.googleapis.com)
+
+            --trace              Append a trace of the HTTP requests and the
+                                 time spent in each phase to a JSONL file
+            --tracefile=<file>   Trace file (default <statefile>.trace.jsonl)
+            --traceMaxKB=<kb>    Rotate the trace file at this size (5120)
+            --profile[=<top>]    Profile the action with cProfile and report
+                                 the top functions and allocations (20) to
+                                 stderr and <statefile>.profile.txt
+            --profilefile=<base> Write <base>.prof etc instead
+
+            --rateLimit=<rps>    Pace requests to the project from every
+                                 driver process (default 0, no limit)
+            --rateBurst=<n>      Allow bursts of up to n requests (rateLimit)
+            --ratefile=<file>    Shared limiter state (default gce.ratelimit
+                                 next to the statefile)
+
         action-specific options:
         ------------------------
 
@@ -329,6 +474,12 @@ def help():
             --name=<nodename>   Name to give the new node
             --imageid=<imageid> The disk image [<project>:]<image>
             --sizeid=<size>     The machine type to use
+            --spot=<percent>    Share of nodes to run on spot capacity (0)
+            --spotmodel=<model> Use "spot" (default) or "preemptible" VMs
+            --pool=<pool>       Pool the spot share is counted over
+                                (default the name without its number)
+            --spotTimeout=<s>   Wait this long for a spot insert before
+                                keeping it as pending (120)
 
         destroynode         Remove a node from the cloud
 
@@ -339,6 +490,37 @@ def help():
 
             --name=<nodename>   Display the status of the named node only.
             --google            Show Google API version, not the vTM version.
+            --deltasince=<time> Only report nodes changed since this time
+            --historyTTL=<s>    Keep node changes for deltasince this long
+                                (3600)
+            --historyfile=<file> Node history (default <statefile>.history)
+            --statusStale=<s>   Answer from the last node list if it is this
+                                young, refreshing it in the background
+            --statusMaxStale=<s> Report a list up to this old if the API
+                                fails (600)
+            --breakerFailures=<n> Stop polling a failing API after n errors
+                                in a row (3)
+            --breakerReset=<s>  ...for this many seconds (30)
+
+            --pool=<pool>       Only replace preempted nodes of this pool
+
+            Preempted spot nodes are deleted and replaced when seen by status,
+            falling back to standard capacity if no spot capacity is available.
+
+        reconcile           Create and destroy nodes to leave count nodes of
+                            the given image and size, printing the plan to
+                            stderr and each node's result
+
+            --count=<nodes>     Number of nodes wanted
+            --imageid=<imageid> The disk image [<project>:]<image>
+            --sizeid=<size>     The machine type to use
+            --prefix=<name>     Name new nodes <name><n> (default node),
+                                and only count or destroy nodes so named
+            --parallel=<n>      Send at most n creates or deletes at once (8)
+            --dryrun[=true]     Print the plan without applying it
+            --spot=<percent>    Share of nodes to run on spot capacity (0)
+            --pool=<pool>       Pool the spot share is counted over (prefix)
+            --spotTimeout=<s>   Wait this long for a spot insert (120)
 
         authclient          Generate AUTH2 Configuration
 
@@ -355,11 +537,17 @@ def help():
             --sizeid=<size>     The machine type to use
             --natip=<address>   Use a reserved NAT IP address
 
+        daemon              Serve requests for a cloud credential over a
+                            Unix socket, keeping tokens and connections open
+
+            --idle=<seconds>    Exit after this long without a request (3600)
+            --daemon=true       (any action) start a daemon for later polls
+
 """
     sys.stderr.write(text)
     sys.exit(1)
 
-def convertNodeData(opts,gcm,item):
+def convertNodeData(opts,gcm,item,known=None):
     node = { "uniq_id": item['id'], "name": item["name"], \
         "status": item["status"], \
         "created": item["creationTimestamp"], \
@@ -367,12 +555,12 @@ def convertNodeData(opts,gcm,item):
         "public_ip": \
             item["networkInterfaces"][0]["accessConfigs"][0]["natIP"] \
     }
-    disk = gcm.getDiskInfo(item["name"])
-    si = disk["sourceImage"].split("/projects/")[1].split("/global/images/")
-    if si[0] == opts["cred2"]:
-        node["imageid"] = si[1]
+    # The boot disk of an instance never changes, so the image of a node we
+    # have seen before is taken from the history rather than fetched again
+    if known is not None and known.get("uniq_id") == item["id"] and "imageid" in known:
+        node["imageid"] = known["imageid"]
     else:
-        node["imageid"] = ':'.join(si)
+        node["imageid"] = getImageId(opts, gcm.getDiskInfo(item["name"]))
 
     node['sizeid'] = item['machineType'].rsplit('/',1)[1]
 
@@ -393,8 +581,137 @@ def convertNodeData(opts,gcm,item):
         node["complete"] = 50
     return node
 
+def getImageId(opts, disk):
+    si = disk["sourceImage"].split("/projects/")[1].split("/global/images/")
+    if si[0] == opts["cred2"]:
+        return si[1]
+    else:
+        return ':'.join(si)
+
+def getSpotShare(opts):
+    share = opts["spot"] if "spot" in opts.keys() else "0"
+    if not re.match("^[0-9]+$", str(share)) or int(share) > 100:
+        sys.stderr.write("ERR - spot must be a percentage from 0 to 100\n")
+        sys.exit(1)
+    return int(share)
+
+def getPool(opts, name=None):
+    # The pool a new node belongs to, for its spot share. Set --pool in the
+    # pool's extra arguments, otherwise the name prefix stands in for it.
+    if "pool" in opts.keys():
+        pool = opts["pool"]
+    elif "prefix" in opts.keys():
+        pool = opts["prefix"]
+    elif name is not None:
+        pool = re.sub("[0-9]+$", "", re.sub("-r[0-9]+$", "", name))
+    else:
+        pool = "node"
+    # Label values are limited to lowercase letters, digits, - and _
+    return re.sub("[^a-z0-9_-]", "-", pool.lower())[:63]
+
+def getCapacity(opts, gcm, pool, items=None):
+    # Pick the capacity model for a new node, so that the configured share
+    # of the nodes in its pool are running on spot/preemptible capacity.
+    share = getSpotShare(opts)
+    if share == 0:
+        return None
+    model = opts["spotmodel"].lower() if "spotmodel" in opts.keys() else "spot"
+    if model not in ( "spot", "preemptible" ):
+        sys.stderr.write("ERR - spotmodel must be one of spot or preemptible\n")
+        sys.exit(1)
+    if share >= 100:
+        return model
+
+    if items is None:
+        status = gcm.status()
+        items = status["items"] if "items" in status.keys() else []
+    total = 0
+    spot = 0
+    for item in items:
+        labels = item.get("labels", {})
+        if "vtm-capacity" not in labels or labels.get("vtm-pool") != pool:
+            continue
+        total += 1
+        if gcm.isPreemptible(item):
+            spot += 1
+    if spot * 100 < share * (total + 1):
+        return model
+    return None
+
+def startNode(opts, gcm, name, image, size, capacity, pool):
+    # A spot insert is accepted straight away, but a stockout such as
+    # ZONE_RESOURCE_POOL_EXHAUSTED is only reported on the insert operation,
+    # so we wait for that before falling back to standard capacity
+    gcm.newInst(name, image, size)
+    try:
+        gcm.instances[name].setCapacity(capacity, pool)
+        result = gcm.start(name)
+        if capacity is not None and "error" not in result.keys():
+            timeout = int(opts["spotTimeout"]) if "spotTimeout" in opts.keys() else 120
+            result = gcm.wait(result, timeout)
+        if capacity is not None and "error" in result.keys():
+            sys.stderr.write("WARN - Failed to start {} on {} capacity: {}\n".format(
+                name, capacity, json.dumps(result["error"])))
+            gcm.instances[name].setCapacity(None, pool)
+            result = gcm.start(name)
+    finally:
+        del gcm.instances[name]
+    return result
+
+def replacementName(name):
+    suffix = "-r{}".format(int(time.time()) % 100000)
+    base = re.sub("-r[0-9]+$", "", name)
+    return base[:63 - len(suffix)] + suffix
+
+def replacePreempted(opts, gcm, items):
+    # Spot nodes which have been preempted sit in TERMINATED until deleted.
+    # Confirm against the operation log, delete them, and start replacements
+    # straight away rather than waiting for vTM to notice the lost capacity.
+    # A node stays listed while its delete runs, so nodes with a delete in
+    # progress have already been replaced by an earlier poll.
+    candidates = [ item for item in items if gcm.isPreemptible(item) and \
+        item.get("labels", {}).get("vtm-capacity") is not None and \
+        item["status"] in ( "STOPPING", "TERMINATED" ) and \
+        ( "pool" not in opts.keys() or \
+          item["labels"].get("vtm-pool") == getPool(opts) ) ]
+    if len(candidates) == 0:
+        return []
+
+    preempted = gcm.preemptions()
+    deleting = gcm.deleting()
+    replaced = []
+    for item in candidates:
+        if item["name"] not in preempted:
+            continue
+        destroyed = { "uniq_id": item["id"], "name": item["name"],
+            "status": "destroyed", "complete": 100,
+            "created": item["creationTimestamp"] }
+        if item["name"] in deleting:
+            replaced.append(destroyed)
+            continue
+        image = getImageId(opts, gcm.getDiskInfo(item["name"]))
+        size = item['machineType'].rsplit('/',1)[1]
+        capacity = item["labels"]["vtm-capacity"]
+        pool = item["labels"].get("vtm-pool")
+        result = gcm.delete(item["name"])
+        if "error" in result.keys():
+            sys.stderr.write("ERR - Failed to delete preempted node {}: {}\n"
+                .format(item["name"], json.dumps(result["error"])))
+            continue
+        replaced.append(destroyed)
+        name = replacementName(item["name"])
+        result = startNode(opts, gcm, name, image, size, capacity, pool)
+        if "error" in result.keys():
+            sys.stderr.write("ERR - Failed to replace preempted node {}: {}\n"
+                .format(item["name"], json.dumps(result["error"])))
+            continue
+        replaced.append({ "uniq_id": result.get("targetId"), "name": name,
+            "status": "pending", "complete": 33, "imageid": image,
+            "sizeid": size, "private_ip": "", "public_ip": "",
+            "created": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()) })
+    return replaced
+
 def getStatus(opts, gcm):
-    nodes = []
     if "name" in opts.keys():
         nodeStatus = gcm.status(opts["name"])
         if "FAILED" in nodeStatus.keys():
@@ -402,26 +719,89 @@ def getStatus(opts, gcm):
         else:
             status = { "items": [ nodeStatus ] }
     else:
-        status = gcm.status()
+        with Tracer.current().phase("list"):
+            status = gcm.status()
 
     if ( "FAILED" in status.keys() ):
-            sys.stderr.write("Failed to get Status for project: " + \
-                opts["cred2"])
-            sys.stderr.write(", zone: " + opts["cred3"] + "\n")
-            sys.stderr.write("API Response: {}, {}\n".format( status["Code"], \
-                status["Error"] ) )
-            sys.exit(1)
+            statusFailed(opts, status)
     
     if "google" in opts.keys():
         print json.dumps(status)
         return
 
-    if "items" in status.keys():
-        for item in status["items"]:
-            node = convertNodeData(opts, gcm, item)
-            nodes.append(node)
-    ret = { "NodeStatusResponse":{ "version": 1, "code": 200, "nodes": nodes }}
-    print json.dumps(ret)
+    items = status["items"] if "items" in status.keys() else []
+    with StatusWriter(sys.stdout) as out:
+        if "name" in opts.keys():
+            out.write_all(list(iterNodes(opts, gcm, items)))
+        else:
+            history = getHistory(opts)
+            writeDelta(opts, history, iterNodes(opts, gcm, items, history.current), out)
+
+def statusFailed(opts, status):
+    sys.stderr.write("Failed to get Status for project: " + \
+        opts["cred2"])
+    sys.stderr.write(", zone: " + opts["cred3"] + "\n")
+    sys.stderr.write("API Response: {}, {}\n".format( status["Code"], \
+        status["Error"] ) )
+    sys.exit(1)
+
+def iterNodes(opts, gcm, items, known=None):
+    tracer = Tracer.current()
+    replaced = {}
+    if "name" not in opts.keys():
+        with tracer.phase("replace"):
+            for node in replacePreempted(opts, gcm, items):
+                replaced[node["name"]] = node
+
+    with tracer.phase("enrich"):
+        for item in items:
+            if item["name"] in replaced.keys():
+                continue
+            yield convertNodeData(opts, gcm, item,
+                known.get(item["name"]) if known is not None else None)
+    for node in replaced.values():
+        yield node
+
+def getHistory(opts):
+    retain = int(opts["historyTTL"]) if "historyTTL" in opts.keys() else 3600
+    return NodeHistory(opts["historyfile"], retain)
+
+def writeDelta(opts, history, nodes, out):
+    # Every node is written out as the history reads it, unless only the
+    # changes since deltasince are wanted
+    delta = history.current is not None and "deltasince" in opts.keys()
+    now = int(time.time())
+    changed = history.update(nodes if delta else out.passing(nodes), now)
+    with Tracer.current().phase("history"):
+        if changed:
+            history.save()
+
+    if delta:
+        out.write_all(history.since(delta_since(opts, now)))
+
+def getCachedStatus(opts, argv, cache):
+    # The manager and history are only set up when the API is polled, so an
+    # answer from the cache needs no token
+    history = []
+
+    def fetch():
+        tracer = Tracer.current()
+        with tracer.phase("auth"):
+            gcm = getManager(opts)
+        with tracer.phase("list"):
+            status = gcm.status()
+        if "FAILED" in status.keys():
+            statusFailed(opts, status)
+        history.append(getHistory(opts))
+        return list(iterNodes(opts, gcm, status["items"] if "items" in status.keys() else [],
+            history[0].current))
+
+    nodes, live = cache.status(argv, fetch, "refresh" in opts.keys())
+    with StatusWriter(sys.stdout) as out:
+        if live:
+            writeDelta(opts, history[0], nodes, out)
+        else:
+            write_cached(opts, getHistory(opts), nodes, out)
 
 def addNode(opts, gcm):
     if "name" not in opts.keys() or "imageid" not in opts.keys() or \
@@ -432,8 +812,10 @@ def addNode(opts, gcm):
     timeout = opts['timeout'] if 'timeout' in opts.keys() else 30
     loop = timeout / 5
 
-    gcm.newInst(opts["name"], opts["imageid"], opts["sizeid"])
-    result = gcm.start(opts["name"])
+    pool = getPool(opts, opts["name"])
+    capacity = getCapacity(opts, gcm, pool)
+    result = startNode(opts, gcm, opts["name"], opts["imageid"], opts["sizeid"],
+        capacity, pool)
     for x in xrange(loop):
         myNode = gcm.status(opts["name"])
         if "status" in myNode.keys() and myNode["status"] == "RUNNING":
@@ -475,6 +857,84 @@ def delNode(opts, gcm):
 
     print json.dumps(ret)
 
+def reconcileNode(opts, gcm, job):
+    action, node = job
+    try:
+        if action == "create":
+            name, capacity = node
+            result = startNode(opts, gcm, name, opts["imageid"], opts["sizeid"], capacity,
+                getPool(opts))
+        else:
+            name = node["name"]
+            result = gcm.delete(name)
+        if "error" in result.keys():
+            raise Exception(json.dumps(result["error"]))
+    except (Exception, SystemExit) as e:
+        return { "action": action, "name": name, "status": "failed", "error": str(e) }
+    if action == "create":
+        return { "action": action, "uniq_id": result.get("targetId"), "name": name,
+            "status": "pending", "complete": 33, "imageid": opts["imageid"],
+            "sizeid": opts["sizeid"], "private_ip": "", "public_ip": "",
+            "created": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()) }
+    return { "action": action, "uniq_id": node["uniq_id"], "name": name,
+        "status": "destroyed", "complete": 80 }
+
+def reconcile(opts, gcm):
+    # Returns the number of nodes which failed
+    for key in ("count", "imageid", "sizeid"):
+        if key not in opts.keys():
+            sys.stderr.write("ERR - You must provide --count, --imageid and --sizeid to reconcile\n")
+            sys.exit(1)
+    pool = getPool(opts)
+    getSpotShare(opts)
+
+    with Tracer.current().phase("list"):
+        status = gcm.status()
+    if "FAILED" in status.keys():
+        statusFailed(opts, status)
+    items = status["items"] if "items" in status.keys() else []
+    history = getHistory(opts)
+    nodes = list(iterNodes(opts, gcm, items, history.current))
+    with Tracer.current().phase("history"):
+        if history.update(nodes, int(time.time())):
+            history.save()
+    # A node belongs to the pool if it carries the pool's label, or if it has
+    # no pool label and is named <prefix><n>, or is a replacement of one
+    prefix = opts["prefix"] if "prefix" in opts.keys() else "node"
+    labels = dict((item["name"], item.get("labels", {})) for item in items)
+    def member(node):
+        label = labels.get(node["name"], {}).get("vtm-pool")
+        if label is not None:
+            return label == pool
+        return pool_member(re.sub("-r[0-9]+$", "", node["name"]), prefix)
+    names, destroy = plan_reconcile(nodes, int(opts["count"]), { "imageid": opts["imageid"],
+        "sizeid": opts["sizeid"] }, prefix, member)
+
+    # Each new node's capacity counts towards the spot share of the next
+    create = []
+    plan = []
+    for name in names:
+        capacity = getCapacity(opts, gcm, pool, items)
+        create.append((name, capacity))
+        plan.append((name, (opts["imageid"], opts["sizeid"], capacity or "standard")))
+        items = items + [{ "labels": { "vtm-capacity": capacity or "standard", "vtm-pool": pool },
+            "scheduling": { "provisioningModel": "SPOT" } if capacity == "spot" else
+                { "preemptible": capacity == "preemptible" } }]
+    print_plan(opts["count"], plan, destroy)
+
+    dryrun = is_set(opts, "dryrun")
+    if dryrun:
+        results = planned_results(names, destroy)
+    else:
+        jobs = [("destroy", node) for node in destroy] + [("create", node) for node in create]
+        parallel = int(opts["parallel"]) if "parallel" in opts.keys() else 8
+        results = run_parallel(lambda job: reconcileNode(opts, gcm, job), jobs, parallel)
+
+    failed = len([result for result in results if result["status"] == "failed"])
+    code = 500 if failed > 0 else 202 if len(results) > 0 and not dryrun else 200
+    print json.dumps({ "ReconcileResponse": { "version": 1, "code": code, "nodes": results }})
+    return failed
+
 def newVTM(opts,gcm):
     if "name" not in opts.keys():
         sys.stderr.write("ERR - You must provide a --name for the vTM\n")
@@ -536,25 +996,123 @@ def getCCopts(opts):
             opts[kvp.group(1)] = kvp.group(2)
     ccFH.close()
 
-def main():
-    opts = {"verbose": 0 }
+def getSocketPath(opts):
+    # One daemon per cloud credential, listening next to the state file
+    if "statefile" in opts.keys():
+        return os.path.splitext(opts["statefile"])[0] + ".sock"
+    if "cloudcreds" not in opts.keys():
+        return None
+    zh = find_zeus_home()
+    if zh is None:
+        return None
+    return zh + "/zxtm/internal/gce." + opts["cloudcreds"] + ".sock"
+
+def startDaemon(opts, argv):
+    # Start a daemon in the background to serve the next request
+    if len(argv) < 2 or argv[1].lower() == "daemon":
+        return
+    start_daemon(getSocketPath(opts), os.path.abspath(__file__),
+        [arg for arg in argv[2:] if re.match("--(cloudcreds|statefile|idle)=", arg)])
 
-    # Read in the first argument or display the help
-    if len(sys.argv) < 2:
-        help()
-    else:
-        action = sys.argv[1]
+def runDaemon(opts):
+    path = getSocketPath(opts)
+    if path is None:
+        sys.stderr.write("ERR - You must provide --cloudcreds or --statefile to run a daemon\n")
+        sys.exit(1)
+    idle = int(opts["idle"]) if "idle" in opts.keys() else 3600
+    DriverDaemon(path, run, idle).serve()
+
+def getManager(opts):
+    # Managers are kept between requests when running as a daemon, so the
+    # access token and HTTP connections are reused.
+    key = (opts["cred2"], opts["cred3"], opts["cred1"], opts["statefile"],
+        opts.get("apiHost"), opts.get("rateLimit"), opts.get("rateBurst"), opts.get("ratefile"))
+    # Every credential shares one limiter, next to the state file
+    ratefile = None
+    if opts.get("statefile") is not None:
+        ratefile = os.path.join(os.path.dirname(opts["statefile"]), "gce.ratelimit")
+    limiter = get_rate_limiter(opts, ratefile)
+    with managerLock:
+        if key not in managers:
+            managers[key] = GoogleComputeManager(opts["cred2"], opts["cred3"],
+                opts["cred1"], opts["statefile"], opts.get("apiHost"), limiter)
+        gcm = managers[key]
+    with gcm.lock:
+        gcm.auth()
+    return gcm
 
-    # Process additional arguments
-    for arg in sys.argv:
+def getOpts(argv):
+    opts = {"verbose": 0 }
+    for arg in argv:
         kvp = re.search("--([^=]+)=*(.*)", arg)
         if kvp != None:
             opts[kvp.group(1)] = kvp.group(2)
+    return opts
+
+def main(argv=None):
+    argv = sys.argv if argv is None else argv
+
+    # Requests are served by the daemon for this cloud credential if one is
+    # running, otherwise we do the work here. Profiled requests always run
+    # here, so the profile covers just this action, as do background status
+    # refreshes.
+    opts = getOpts(argv)
+    if len(argv) > 1 and argv[1].lower() not in ("daemon", "help", "authclient") and \
+        get_profiler(opts) is None and "refresh" not in opts.keys():
+        code = forward_request(getSocketPath(opts), argv)
+        if code is not None:
+            sys.exit(code)
+    try:
+        run(argv, opts)
+    finally:
+        if str(opts.get("daemon", "")).lower() == "true":
+            startDaemon(opts, argv)
+
+def run(argv, opts=None):
+
+    # Process additional arguments
+    if opts is None:
+        opts = getOpts(argv)
+
+    # Every action is traced in memory, and the trace written out if --trace
+    # was given
+    tracer = Tracer("gce", argv[1].lower() if len(argv) > 1 else None)
+    Tracer.local.tracer = tracer
+    profiler = get_profiler(opts)
+    code = 1
+    try:
+        if profiler is not None:
+            profiler.start()
+        runAction(argv, opts)
+        code = 0
+    except SystemExit as e:
+        code = e.code if isinstance(e.code, int) or e.code is None else 1
+        raise
+    finally:
+        Tracer.local.tracer = None
+        tracer.finish(code or 0)
+        if profiler is not None:
+            profiler.stop()
+            try:
+                sys.stderr.write(profiler.report(get_profile_base(opts, getStateBase(opts))))
+            except (IOError, OSError) as e:
+                sys.stderr.write("ERR - Failed to write profile: {}\n".format(e))
+
+def runAction(argv, opts):
 
-    if action.lower() in ('status','createnode','destroynode','getvtmimgs','createvtm'):
+    # Read in the first argument or display the help
+    if len(argv) < 2:
+        help()
+    else:
+        action = argv[1]
+
+    tracer = Tracer.current()
+    if action.lower() in ('status','createnode','destroynode','reconcile','getvtmimgs',
+        'createvtm'):
         # We need cloud credentials... 
         if "cloudcreds" in opts.keys():
-            getCCopts(opts)
+            with tracer.phase("config"):
+                getCCopts(opts)
 
         # Credential 1 should be "local" if running in GCE, in which case we,
         # use the metadata server. Or it should be an OATH2 config file.
@@ -586,6 +1144,13 @@ def main():
                     opts["cloudcreds"] + ".state"
             else:
                 opts["statefile"] = None
+        if "historyfile" not in opts.keys():
+            if opts["statefile"] is not None:
+                opts["historyfile"] = os.path.splitext(opts["statefile"])[0] + ".history"
+            else:
+                opts["historyfile"] = None
+        maxBytes = int(opts["traceMaxKB"]) * 1024 if "traceMaxKB" in opts.keys() else 5242880
+        tracer.enable(get_trace_path(opts, getStateBase(opts)), maxBytes)
 
         # Credential 2 should be our project
         if "cred2" not in opts.keys():
@@ -597,29 +1162,45 @@ def main():
             sys.stderr.write("ERR - You must supply your Region in cred3\n")
             sys.exit(1)
 
-        # Set up the GCM
-        gcm = GoogleComputeManager(opts["cred2"], opts["cred3"], 
-              opts["cred1"], opts["statefile"])
-        gcm.auth()
+        # Set up the GCM, unless a status poll may be answered from the cache
+        cache = None
+        if action.lower() == "status" and "name" not in opts.keys() and "google" not in opts.keys():
+            cache = get_status_cache(opts, getStateBase(opts), os.path.abspath(__file__),
+                "Compute API")
+        if cache is None:
+            with tracer.phase("auth"):
+                gcm = getManager(opts)
 
     # Check the action and call the appropriate function
     if action.lower() == "help":
         help()
     elif action.lower() == "status":
-        getStatus(opts, gcm)
+        if cache is None:
+            getStatus(opts, gcm)
+        else:
+            getCachedStatus(opts, argv, cache)
     elif action.lower() == "createnode":
         addNode(opts, gcm)
     elif action.lower() == "destroynode":
         delNode(opts, gcm)
+    elif action.lower() == "reconcile":
+        if reconcile(opts, gcm) > 0:
+            sys.exit(1)
     elif action.lower() == "authclient":
         authMe(opts)
     elif action.lower() == "getvtmimgs":
         listVTMs(opts,gcm)
     elif action.lower() == "createvtm":
         newVTM(opts,gcm)
+    elif action.lower() == "daemon":
+        runDaemon(opts)
     else:
         help()
    
 
+# Managers kept between requests when running as a daemon
+managers = {}
+managerLock = threading.Lock()
+
 if __name__ == "__main__":
     main()
@@ -0,0 +1,152 @@
+#!/usr/bin/python
+#
+# Summarises the JSONL traces written by the drivers when tracing is enabled,
+# with percentile tables of the run times, phases and requests of each action.
+#
+# Usage: tracesummary.py [--driver=NAME] [--action=NAME] [--since=SECONDS]
+#                        [tracefile ...]
+#
+# With no files, every trace under $ZEUSHOME/zxtm/internal is read, including
+# the rotated copies.
+
+import os
+import re
+import sys
+import glob
+import json
+import time
+
+PERCENTILES = (50, 90, 99)
+
+
+def percentile(values, pct):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * pct / 100.0))]
+
+
+def find_traces():
+    zh = os.environ.get("ZEUSHOME")
+    if zh is None:
+        for path in ("/usr/local/zeus", "/opt/zeus"):
+            if os.path.isdir(path):
+                zh = path
+                break
+    if zh is None:
+        sys.stderr.write("ERROR - Can not find ZEUSHOME, give the trace files to read\n")
+        sys.exit(1)
+    return sorted(glob.glob(zh + "/zxtm/internal/*.trace.jsonl") +
+        glob.glob(zh + "/zxtm/internal/*.trace.jsonl.[0-9]*"))
+
+
+def read_traces(paths, opts):
+    since = time.time() - float(opts["since"]) if "since" in opts.keys() else 0
+    records = []
+    for path in paths:
+        tf = open(path, "r")
+        for line in tf:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                continue
+            if record.get("ts", 0) < since:
+                continue
+            if "driver" in opts.keys() and record.get("driver") != opts["driver"]:
+                continue
+            if "action" in opts.keys() and record.get("action") != opts["action"]:
+                continue
+            records.append(record)
+        tf.close()
+    return records
+
+
+def print_table(title, columns, rows, labels=1):
+    if len(rows) == 0:
+        return
+    widths = [len(column) for column in columns]
+    for row in rows:
+        widths = [max(width, len(str(cell))) for width, cell in zip(widths, row)]
+    print "\n" + title
+    print "  ".join(column.ljust(width) for column, width in zip(columns, widths))
+    print "  ".join("-" * width for width in widths)
+    for row in rows:
+        cells = [str(cell).rjust(width) for cell, width in zip(row, widths)]
+        for i in xrange(labels):
+            cells[i] = str(row[i]).ljust(widths[i])
+        print "  ".join(cells)
+
+
+def stats(values):
+    return [len(values)] + ["{:.1f}".format(percentile(values, pct)) for pct in PERCENTILES] + \
+        ["{:.1f}".format(max(values))]
+
+
+def summarise(records):
+    runs = {}
+    phases = {}
+    requests = {}
+    for record in records:
+        action = "{}/{}".format(record.get("driver"), record.get("action"))
+        if record.get("type") == "run":
+            runs.setdefault(action, []).append(record)
+        elif record.get("type") == "phase":
+            # A phase may be entered many times in one run, eg once per node
+            key = (action, record["name"])
+            phases.setdefault(key, {})
+            phases[key][record["run"]] = phases[key].get(record["run"], 0) + record["ms"]
+        elif record.get("type") == "request":
+            key = (action, record["method"] + " " + record["url"])
+            requests.setdefault(key, []).append(record)
+
+    columns = ["action", "runs"] + ["p{}".format(pct) for pct in PERCENTILES] + ["max", "errors"]
+    rows = []
+    for action in sorted(runs.keys()):
+        times = [run["ms"] for run in runs[action]]
+        errors = len([run for run in runs[action] if run.get("code") not in (0, None)])
+        rows.append([action] + stats(times) + [errors])
+    print_table("Run time (ms)", columns, rows)
+
+    columns = ["action", "phase", "runs"] + ["p{}".format(pct) for pct in PERCENTILES] + ["max"]
+    rows = []
+    for action, name in sorted(phases.keys()):
+        rows.append([action, name] + stats(phases[(action, name)].values()))
+    print_table("Phase time per run (ms)", columns, rows, 2)
+
+    columns = ["action", "request", "count"] + ["p{}".format(pct) for pct in PERCENTILES] + \
+        ["max", "ttfb p50", "connect", "avg bytes", "retries", "errors"]
+    rows = []
+    for action, request in sorted(requests.keys()):
+        made = requests[(action, request)]
+        ttfb = [record.get("ttfb_ms", 0) for record in made]
+        connects = len([record for record in made if "connect_ms" in record])
+        errors = len([record for record in made if record.get("status") is None or
+            record["status"] >= 400])
+        retries = sum(record.get("retries") or 0 for record in made)
+        size = sum(record.get("bytes", 0) for record in made) / len(made)
+        rows.append([action, request] + stats([record["total_ms"] for record in made]) +
+            ["{:.1f}".format(percentile(ttfb, 50)), connects, size, retries, errors])
+    print_table("Requests (ms)", columns, rows, 2)
+
+
+def main():
+    opts = {}
+    paths = []
+    for arg in sys.argv[1:]:
+        kvp = re.search("--([^=]+)=*(.*)", arg)
+        if kvp != None:
+            opts[kvp.group(1)] = kvp.group(2)
+        else:
+            paths.append(arg)
+    if "help" in opts.keys():
+        sys.stderr.write("Usage: tracesummary.py [--driver=NAME] [--action=NAME] " +
+            "[--since=SECONDS] [tracefile ...]\n")
+        sys.exit(1)
+
+    records = read_traces(paths if len(paths) > 0 else find_traces(), opts)
+    if len(records) == 0:
+        sys.stderr.write("ERROR - No trace records found\n")
+        sys.exit(1)
+    summarise(records)
+
+
+if __name__ == "__main__":
+    main()
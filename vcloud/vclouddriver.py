@@ -25,20 +25,177 @@
 import sys
 import os
 import re
-import requests
 import time
-import requests
 import json
-from requests.auth import HTTPBasicAuth
-import xml.etree.ElementTree as ET
-from xml.etree.ElementTree import Element
-from xml.etree.ElementTree import ElementTree
+import threading
+from io import BytesIO
+from collections import OrderedDict
+
+# drivercommon.py is uploaded alongside the driver, or found in the common
+# directory of a checkout
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "common"))
+from drivercommon import (run_parallel, find_zeus_home, forward_request, start_daemon,
+    StateFile, NodeHistory, StatusWriter, DriverDaemon, Tracer, trace_session, get_trace_path,
+    get_profiler, get_profile_base, get_rate_limiter, limit_session, get_status_cache,
+    is_set, delta_since, write_cached, plan_reconcile, print_plan, planned_results)
+
+# requests and xml.etree are imported by load_modules() when first needed
+requests = None
+HTTPBasicAuth = None
+HTTPAdapter = None
+Retry = None
+ET = None
+Element = None
+
+
+def load_modules():
+    # Only actions which talk to the cell pay for these imports, so help,
+    # configuration errors and requests handed to a daemon start quickly.
+    global requests, HTTPBasicAuth, HTTPAdapter, Retry, ET, Element
+    if requests is not None:
+        return
+    import xml.etree.ElementTree as ET
+    from xml.etree.ElementTree import Element
+    from requests.auth import HTTPBasicAuth
+    from requests.adapters import HTTPAdapter
+    from requests.packages.urllib3.util.retry import Retry
+    import requests
+
+
+def url_template(url):
+    # Drop the host and query, and replace the ids in the path, so requests
+    # for different objects of the same type are summarised together
+    path = re.sub("^\w+://[^/]+", "", url).split("?")[0]
+    path = re.sub("[0-9a-fA-F]{8}-[0-9a-fA-F]{4}-[0-9a-fA-F]{4}-[0-9a-fA-F]{4}-[0-9a-fA-F]{12}",
+        "{id}", path)
+    return re.sub("(?<=[/-])\d+(?=/|$)", "{id}", path)
+
+
+def get_state_base(opts):
+    # Traces, profiles and the status cache are kept next to the state file
+    if opts.get("statefile") is None:
+        return None
+    return os.path.splitext(opts["statefile"])[0]
+
+
+class HTTPRequestFailed(Exception):
+
+    def __init__(self, code, text=None):
+        Exception.__init__(self, "HTTP Request Failed: {}".format(code))
+        self.code = code
+        self.text = text
+
+
+class ConfigCache(object):
+
+    # Size bounded LRU of parsed documents. An entry stops being "in" the
+    # cache once its time to live has passed, so callers fetch it again, but
+    # a lookup of an entry they have just checked never fails. Every access
+    # reorders the entries, so they all take the lock, since the cache is
+    # shared by the run_parallel workers of a request.
+
+    def __init__(self, size=256, ttl=300):
+        self.size = size
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self._items = OrderedDict()
+
+    def __contains__(self, name):
+        with self.lock:
+            return self._fresh(name, time.time())
+
+    def _fresh(self, name, now):
+        item = self._items.get(name)
+        if item is None:
+            return False
+        if item[0] < now:
+            del self._items[name]
+            return False
+        return True
+
+    def __getitem__(self, name):
+        with self.lock:
+            item = self._items.pop(name)
+            self._items[name] = item
+            return item[1]
+
+    def __setitem__(self, name, value):
+        with self.lock:
+            self._items.pop(name, None)
+            self._items[name] = (time.time() + self.ttl, value)
+            while len(self._items) > self.size:
+                self._items.popitem(last=False)
+
+    def __len__(self):
+        with self.lock:
+            return len(self._items)
+
+    def keys(self):
+        with self.lock:
+            now = time.time()
+            return [name for name in list(self._items.keys()) if self._fresh(name, now)]
+
+    def pop(self, name, default=None):
+        with self.lock:
+            item = self._items.pop(name, None)
+        return default if item is None else item[1]
+
+    def clear(self):
+        with self.lock:
+            self._items.clear()
+
+
+class VmRecord(object):
+
+    # The parts of a Vm document we use, kept instead of the parsed tree
+    __slots__ = ("name", "href", "id", "status", "deployed", "needsCustomization", "nets")
+
+    def __init__(self, attrib):
+        self.name = attrib.get("name")
+        self.href = attrib.get("href")
+        self.id = attrib.get("id")
+        self.status = attrib.get("status")
+        self.deployed = attrib.get("deployed")
+        self.needsCustomization = attrib.get("needsCustomization")
+        self.nets = {}
+
+
+class VAppRecord(object):
+
+    # The parts of a vApp or vApp Template document we use
+    __slots__ = ("name", "href", "networks", "vms")
+
+    def __init__(self, attrib):
+        self.name = attrib.get("name")
+        self.href = attrib.get("href")
+        self.networks = {}
+        self.vms = []
+
+
+class VdcRecord(object):
+
+    # The vApps, templates and networks listed in a VDC document
+    __slots__ = ("vapps", "templates", "networks")
+
+    def __init__(self):
+        self.vapps = {}
+        self.templates = {}
+        self.networks = {}
 
 
 class VCloudManager(object):
 
-    def __init__(self, api, org=None, vdc=None, verbose=False, timeout=60):
+    TASK_PENDING = ("queued", "preRunning", "running")
+
+    # Seconds each type of document is trusted for before it is fetched again
+    CACHE_TTL = { "ORG": 3600, "VDC": 300, "TMPL": 3600, "NET": 300,
+        "VAPP": 30, "VMS": 30, "META": 300 }
+
+    def __init__(self, api, org=None, vdc=None, verbose=False, timeout=60, vm_timeout=30,
+        session_ttl=1500, poll_min=0.5, poll_max=5.0, cache_size=256,
+        http_timeout=(10, 60), retries=3, pool_size=8, limiter=None):
 
+        load_modules()
         NAME_SPACE = "http://www.vmware.com/vcloud/v1.5"
         XML_VERSION = "application/*+xml;version=5.1"
 
@@ -61,10 +218,26 @@ class VCloudManager(object):
         self.vapp_networks = {}
         self.task = None
         self.timeout = timeout
+        self.vm_timeout = vm_timeout
         self.verbose = verbose
         self.customize = False
         self.terminate_on_shutdown = True
+        self.power_on_deploy = True
+        self.delete_running = False
+        self.cached_hrefs = False
+        self.creation_times = {}
+        self.credentials = None
+        self.session_ttl = session_ttl
+        self.session_expires = 0
+        self.poll_min = poll_min
+        self.poll_max = poll_max
+        self.cache_size = cache_size
+        self.http_timeout = http_timeout
+        self.session = self._new_http_session(retries, pool_size, limiter)
+        self.inflight = {}
+        self.inflight_lock = threading.Lock()
         self._setup_name_space()
+        self._setup_tags()
 
     def _debug(self, msg):
         if self.verbose:
@@ -83,40 +256,98 @@ class VCloudManager(object):
         ET.register_namespace("vmw", "http://www.vmware.com/schema/ovf")
         ET.register_namespace("xsi", "http://www.w3.org/2001/XMLSchema-instance")
 
+    def _setup_tags(self):
+        # Qualified tag names, built once rather than for every lookup
+        self.tag = {}
+        for name in ( "Link", "ResourceEntity", "Network", "NetworkConfig", "Vm",
+            "NetworkConnection", "IpAddress", "MetadataEntry", "Key", "Value",
+            "VApp", "VAppTemplate" ):
+            self.tag[name] = "{" + self.ns + "}" + name
+
+    def _iterparse(self, content):
+        return ET.iterparse(BytesIO(content), events=("start", "end"))
+
+    def _parse_links(self, content):
+        # Session and Org documents: the Links they hold, by type then name
+        links = {}
+        for event, elem in self._iterparse(content):
+            if event == "end" and elem.tag == self.tag["Link"]:
+                links.setdefault(elem.get("type"), {})[elem.get("name")] = elem.get("href")
+        return links
+
+    def _parse_vdc(self, content):
+        vdc = VdcRecord()
+        for event, elem in self._iterparse(content):
+            if event != "end":
+                continue
+            if elem.tag == self.tag["ResourceEntity"]:
+                appType = elem.get("type")
+                if appType == 'application/vnd.vmware.vcloud.vApp+xml':
+                    vdc.vapps[elem.get("name")] = elem.get("href")
+                elif appType == 'application/vnd.vmware.vcloud.vAppTemplate+xml':
+                    vdc.templates[elem.get("name")] = elem.get("href")
+            elif elem.tag == self.tag["Network"] and \
+                elem.get("type") == 'application/vnd.vmware.vcloud.network+xml':
+                vdc.networks[elem.get("name")] = elem.get("href")
+        return vdc
+
+    def _parse_vapp(self, content):
+        # vApp, vApp Template and Vm documents. Each Vm subtree is cleared as
+        # soon as we have read it, so the whole tree is never held in memory.
+        vapp = None
+        vm = None
+        for event, elem in self._iterparse(content):
+            if event == "start":
+                if elem.tag == self.tag["Vm"]:
+                    vm = VmRecord(elem.attrib)
+                elif vapp is None:
+                    vapp = VAppRecord(elem.attrib)
+                continue
+            if elem.tag == self.tag["Vm"]:
+                vapp.vms.append(vm)
+                vm = None
+                elem.clear()
+            elif elem.tag == self.tag["NetworkConnection"] and vm is not None:
+                ip = elem.find(self.tag["IpAddress"])
+                vm.nets[elem.get("network")] = "" if ip is None else ip.text
+            elif elem.tag == self.tag["NetworkConfig"]:
+                link = elem.find(self.tag["Link"]).get("href")
+                vapp.networks[elem.get("networkName")] = link[:-13]
+        return vapp
+
+    def _parse_vm(self, content):
+        return self._parse_vapp(content).vms[0]
+
+    def _parse_metadata(self, content):
+        metadata = {}
+        for event, elem in self._iterparse(content):
+            if event == "end" and elem.tag == self.tag["MetadataEntry"]:
+                key = elem.find(self.tag["Key"])
+                value = elem.find(".//" + self.tag["Value"])
+                if key is not None and value is not None:
+                    metadata[key.text] = value.text
+        return metadata
+
     def _get_orgs(self):
-        self.orgs = {}
-        for org in self.config["Session"].findall(".//{" + self.ns + "}Link[@type=" +
-            "'application/vnd.vmware.vcloud.org+xml']"):
-            self.orgs[org.attrib.get("name")] = org.attrib.get("href")
+        self._get_session_config()
+        self.orgs = dict(self.config["Session"].get("application/vnd.vmware.vcloud.org+xml", {}))
 
     def _get_vdcs(self, org):
-        self.vdcs = {}
-        for vdc in self.config["ORG"][org].findall(".//{"+ self.ns + "}Link[@type=" +
-            "'application/vnd.vmware.vcloud.vdc+xml']"):
-            self.vdcs[vdc.attrib.get("name")] = vdc.attrib.get("href")
+        self.vdcs = dict(self.config["ORG"][org].get("application/vnd.vmware.vcloud.vdc+xml", {}))
 
     def _get_vapps(self, vdc):
-        for vapp in self.config["VDC"][vdc].findall(".//{"+ self.ns + "}ResourceEntity"):
-            appType = vapp.attrib.get("type")
-            if appType == 'application/vnd.vmware.vcloud.vApp+xml':
-                self.vapps[vapp.attrib.get("name")] = vapp.attrib.get("href")
-            elif appType == 'application/vnd.vmware.vcloud.vAppTemplate+xml':
-                self.templates[vapp.attrib.get("name")] = vapp.attrib.get("href")
+        self.vapps.update(self.config["VDC"][vdc].vapps)
+        self.templates.update(self.config["VDC"][vdc].templates)
 
     def _get_networks(self, vdc):
-        for net in self.config["VDC"][vdc].findall(".//{"+ self.ns + "}Network" +
-            "[@type='application/vnd.vmware.vcloud.network+xml']"):
-            self.dc_networks[net.attrib.get("name")] = net.attrib.get("href")
+        self.dc_networks.update(self.config["VDC"][vdc].networks)
 
     def _get_vapp_networks(self, vapp):
-        for net in self.config["VAPP"][vapp].findall(".//{" + self.ns + "}NetworkConfig"):
-            link = net.find("./{" + self.ns +"}Link").attrib.get("href")
-            link = link[:-13]
-            self.vapp_networks[net.attrib.get("networkName")] = link
+        self.vapp_networks.update(self.config["VAPP"][vapp].networks)
 
     def _get_virtual_machines(self, vapp):
-        for v in self.config["VAPP"][vapp].findall(".//{"+ self.ns +"}Vm"):
-            self.vms[v.attrib.get("name")] = v.attrib.get("href")
+        for v in self.config["VAPP"][vapp].vms:
+            self.vms[v.name] = v.href
 
     def _check_args(self, org, vdc):
         if self.config is None:
@@ -133,32 +364,180 @@ class VCloudManager(object):
                 vdc = self.vdc
         return [ org, vdc ]
 
-    def _do_get_config(self, name, dictionary, append=""):
+    def _do_get_config(self, name, dictionary, append="", parser=None):
         if name not in dictionary:
             raise Exception("ERROR: Could not locate configuration for: {}.".format(name))
         self._debug("HTTP GET for: {}, Calling: {}\n".format(name, dictionary[name] + append))
-        response = requests.get(dictionary[name] + append, headers=self.headers)
-        if response.status_code != 200:
-            raise Exception("HTTP Request Failed: {}".format(response.status_code))
-        return ET.fromstring(response.text)
-
-    def setup_session(self, user, password):
+        return self._get_document(dictionary[name] + append, parser)
+
+    def _get_document(self, href, parser=None):
+        # Threads asking for a document which is already being fetched wait
+        # for that request to finish and share its result.
+        with self.inflight_lock:
+            call = self.inflight.get(href)
+            owner = call is None
+            if owner:
+                call = self.inflight[href] = { "done": threading.Event() }
+        if owner:
+            try:
+                response = self._request("GET", href)
+                if response.status_code != 200:
+                    raise HTTPRequestFailed(response.status_code, response.text)
+                if parser is None:
+                    call["result"] = ET.fromstring(response.text)
+                else:
+                    call["result"] = parser(response.content)
+            except Exception as e:
+                call["error"] = e
+            finally:
+                with self.inflight_lock:
+                    del self.inflight[href]
+                call["done"].set()
+        else:
+            self._debug("Waiting for in-flight GET: {}\n".format(href))
+            call["done"].wait()
+        if "error" in call:
+            raise call["error"]
+        return call["result"]
+
+    def _invalidate(self, uri):
+        # Forget the cached documents of an object a task is changing. The
+        # vApp document embeds its VMs, so any VM change drops those too.
+        meta = uri.endswith("/metadata")
+        for name, href in self.vms.items():
+            if uri.startswith(href + "/"):
+                self.config["META"].pop(name)
+                if not meta:
+                    self.config["VMS"].pop(name)
+                    self.config["VAPP"].clear()
+        for name, href in self.vapps.items():
+            if uri.startswith(href + "/"):
+                self.config["META"].pop(name)
+                if not meta:
+                    self.config["VAPP"].pop(name)
+
+    def _stale_href(self, error):
+        # A cached href which now returns 403/404 means the hierarchy has
+        # changed. Drop the cache so that the caller can walk it again.
+        if self.cached_hrefs is False or error.code not in (403, 404):
+            return False
+        self._debug("Cached href is stale ({}), walking hierarchy\n".format(error.code))
+        self.clear_hrefs()
+        return True
+
+    def get_hrefs(self):
+        return { "api": self.api, "org": self.org, "vdc": self.vdc,
+            "orgs": self.orgs, "vdcs": self.vdcs, "vapps": self.vapps,
+            "templates": self.templates, "networks": self.dc_networks }
+
+    def set_hrefs(self, hrefs):
+        if hrefs is None or hrefs.get("api") != self.api or \
+            hrefs.get("org") != self.org or hrefs.get("vdc") != self.vdc:
+            return False
+        self.orgs = hrefs["orgs"]
+        self.vdcs = hrefs["vdcs"]
+        self.vapps = hrefs["vapps"]
+        self.templates = hrefs["templates"]
+        self.dc_networks = hrefs["networks"]
+        self.cached_hrefs = True
+        return True
+
+    def clear_hrefs(self):
+        self.orgs = None
+        self.vdcs = None
+        self.vapps = {}
+        self.templates = {}
+        self.dc_networks = {}
+        self.cached_hrefs = False
+
+    def _new_http_session(self, retries, pool_size, limiter=None):
+        # One keep-alive connection pool for every request this manager makes.
+        # Only idempotent requests are retried; task submissions are not.
+        # Throttling (429 and 503) is left to the rate limiter, which holds
+        # back every process talking to the cell.
+        session = requests.Session()
+        retry = Retry(total=retries, connect=retries, read=retries,
+            backoff_factor=0.5, status_forcelist=(502, 504),
+            raise_on_status=False, respect_retry_after_header=False)
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size,
+            max_retries=retry)
+        session.mount("http://", adapter)
+        session.mount("https://", adapter)
+        trace_session(session, url_template)
+        if limiter is not None:
+            limit_session(session, limiter)
+        return session
+
+    def _request(self, method, uri, headers=None, data=None):
+        # Requests made with a reused session token are retried once after
+        # logging in again if the cell has expired the session.
+        headers = dict(self.headers if headers is None else headers)
+        response = self.session.request(method, uri, headers=headers, data=data,
+            timeout=self.http_timeout)
+        if response.status_code == 401 and self.credentials is not None:
+            self._debug("Session rejected by the cell, logging in again\n")
+            self._login()
+            headers['x-vcloud-authorization'] = self.headers['x-vcloud-authorization']
+            response = self.session.request(method, uri, headers=headers, data=data,
+                timeout=self.http_timeout)
+        return response
+
+    def _login(self):
         url = self.api + "sessions"
-        auth = HTTPBasicAuth(user, password)
-        self.headers = {"Accept": self.xmlVer}
-        response = requests.post(url, headers=self.headers, auth=auth)
+        auth = HTTPBasicAuth(self.credentials[0], self.credentials[1])
+        headers = {"Accept": self.xmlVer, "Accept-Encoding": "gzip"}
+        response = self.session.post(url, headers=headers, auth=auth,
+            timeout=self.http_timeout)
         if response.status_code != 200:
             raise Exception("Authentication Failed: {}".format(response.status_code))
         self.headers['x-vcloud-authorization'] = response.headers['x-vcloud-authorization']
-        self.config = { "Session": ET.fromstring(response.text), "ORG": {}, "NET": {},
-            "VDC": {}, "VAPP": {}, "TMPL": {}, "VMS": {}, "META": {} }
+        self.config["Session"] = self._parse_links(response.content)
+        self.session_expires = time.time() + self.session_ttl
+
+    def _get_session_config(self):
+        # Only fetched when needed if we are reusing an earlier session
+        if self.config["Session"] is None:
+            response = self._request("GET", self.api + "session")
+            if response.status_code != 200:
+                raise HTTPRequestFailed(response.status_code, response.text)
+            self.config["Session"] = self._parse_links(response.content)
+        return self.config["Session"]
+
+    def setup_session(self, user, password, session=None):
+        self.credentials = (user, password)
+        self.headers = {"Accept": self.xmlVer, "Accept-Encoding": "gzip"}
+        self.config = { "Session": None }
+        for doc in self.CACHE_TTL.keys():
+            self.config[doc] = ConfigCache(self.cache_size, self.CACHE_TTL[doc])
+        if session is not None and session.get("api") == self.api and \
+            session.get("user") == user and session.get("expires", 0) > time.time():
+            self._debug("Reusing vCloud session\n")
+            self.headers['x-vcloud-authorization'] = session["token"]
+            self.session_expires = time.time() + self.session_ttl
+        else:
+            self._login()
+
+    def get_session(self):
+        if self.headers is None or self.credentials is None:
+            return None
+        return { "api": self.api, "user": self.credentials[0],
+            "token": self.headers['x-vcloud-authorization'],
+            "expires": self.session_expires }
 
     def enable_customization(self, customize):
         self.customize = customize
 
+    def enable_power_on_deploy(self, power_on):
+        self.power_on_deploy = power_on
+
+    def enable_delete_running(self, delete_running):
+        self.delete_running = delete_running
+
     def close_session(self):
         self.headers = None
         self.config = None
+        self.credentials = None
+        self.session.close()
 
     def list_orgs(self):
         self._check_args("", "")
@@ -168,27 +547,27 @@ class VCloudManager(object):
     def get_org_config(self, org=None):
         org, vdc = self._check_args(org, "")
         self._get_orgs()
-        self.config["ORG"][org] = self._do_get_config(org, self.orgs)
+        self.config["ORG"][org] = self._do_get_config(org, self.orgs, parser=self._parse_links)
         return self.config["ORG"][org]
 
     def list_vdcs(self, org=None):
         org, vdc = self._check_args(org, "")
-        if org not in self.config["ORG"].keys():
+        if org not in self.config["ORG"]:
             self.get_org_config(org)
         self._get_vdcs(org)
         return self.vdcs
 
     def get_vdc_config(self, org=None, vdc=None):
         org, vdc = self._check_args(org, vdc)
-        if org not in self.config["ORG"].keys():
+        if org not in self.config["ORG"]:
             self.get_org_config(org)
         self._get_vdcs(org)
-        self.config["VDC"][vdc] = self._do_get_config(vdc, self.vdcs)
+        self.config["VDC"][vdc] = self._do_get_config(vdc, self.vdcs, parser=self._parse_vdc)
         return self.config["VDC"][vdc]
 
     def list_vapps(self, org=None, vdc=None):
         org, vdc = self._check_args(org, vdc)
-        if vdc not in self.config["VDC"].keys():
+        if vdc not in self.config["VDC"]:
             self.get_vdc_config(org, vdc)
         self._get_vapps(vdc)
         return self.vapps
@@ -198,55 +577,78 @@ class VCloudManager(object):
         return self.templates
 
     def get_vapp_config(self, vapp, org=None, vdc=None):
-        self.list_vapps(org, vdc)
-        self.config["VAPP"][vapp] = self._do_get_config(vapp, self.vapps)
+        if vapp not in self.vapps:
+            self.list_vapps(org, vdc)
+        try:
+            self.config["VAPP"][vapp] = self._do_get_config(vapp, self.vapps,
+                parser=self._parse_vapp)
+        except HTTPRequestFailed as e:
+            if self._stale_href(e) is False:
+                raise e
+            return self.get_vapp_config(vapp, org, vdc)
         return self.config["VAPP"][vapp]
 
     def get_vapp_metadata(self, vapp, key=None, org=None, vdc=None):
-        self.list_vapps(org, vdc)
-        self.config["META"][vapp] = self._do_get_config(vapp, self.vapps, "/metadata")
+        if vapp not in self.vapps:
+            self.list_vapps(org, vdc)
+        try:
+            self.config["META"][vapp] = self._do_get_config(vapp, self.vapps, "/metadata",
+                self._parse_metadata)
+        except HTTPRequestFailed as e:
+            if self._stale_href(e) is False:
+                raise e
+            return self.get_vapp_metadata(vapp, key, org, vdc)
         if key is None:
             return self.config["META"][vapp]
         else:
             return self._get_metadata_entry(self.config["META"][vapp], key)
 
-    def add_vapp_metadata(self, vapp, dictionary, org=None, vdc=None):
-        self.list_vapps(org, vdc)
+    def add_vapp_metadata(self, vapp, dictionary, org=None, vdc=None, wait=True):
+        if vapp not in self.vapps:
+            self.list_vapps(org, vdc)
         if vapp not in self.vapps:
             raise Exception("Error: No such VApp: {}".format(vapp))
         uri = self.vapps[vapp] + "/metadata"
         metadata = self._build_metadata(dictionary)
         success = self.submit_task(uri, name="Set Metadata", 
             ct="application/vnd.vmware.vcloud.metadata+xml",
-            data=ET.tostring(metadata))
+            data=ET.tostring(metadata), wait=wait)
         return success
 
     def get_vapp_template_config(self, vapp, org=None, vdc=None):
-        self.list_vapps(org, vdc)
-        self.config["TMPL"][vapp] = self._do_get_config(vapp, self.templates)
+        if vapp not in self.templates:
+            self.list_vapps(org, vdc)
+        try:
+            self.config["TMPL"][vapp] = self._do_get_config(vapp, self.templates,
+                parser=self._parse_vapp)
+        except HTTPRequestFailed as e:
+            if self._stale_href(e) is False:
+                raise e
+            return self.get_vapp_template_config(vapp, org, vdc)
         return self.config["TMPL"][vapp]
 
     def list_vapp_vms(self, vapp, org=None, vdc=None):
         org, vdc = self._check_args(org, vdc)
-        if vapp not in self.config["VAPP"].keys():
+        if vapp not in self.config["VAPP"]:
             self.get_vapp_config(vapp, org, vdc)
         self._get_virtual_machines(vapp)
         return self.vms
 
     def get_vapp_vm_config(self, vapp, vm, org=None, vdc=None):
         self.list_vapp_vms(vapp, org, vdc)
-        self.config["VMS"][vm] = self._do_get_config(vm,self.vms)
+        self.config["VMS"][vm] = self._do_get_config(vm, self.vms, parser=self._parse_vm)
         return self.config["VMS"][vm]
 
     def get_vapp_vm_metadata(self, vapp, vm, key=None, org=None, vdc=None):
         self.list_vapp_vms(vapp, org, vdc)
-        self.config["META"][vm] = self._do_get_config(vm, self.vms, "/metadata")
+        self.config["META"][vm] = self._do_get_config(vm, self.vms, "/metadata",
+            self._parse_metadata)
         if key is None:
             return self.config["META"][vm]
         else:
             return self._get_metadata_entry(self.config["META"][vm], key)
 
-    def add_vapp_vm_metadata(self, vapp, vm, dictionary, org=None, vdc=None):
+    def add_vapp_vm_metadata(self, vapp, vm, dictionary, org=None, vdc=None, wait=True):
         self.list_vapp_vms(vapp, org, vdc)
         if vm not in self.vms:
             raise Exception("Error: No such VM: {}".format(vm))
@@ -254,7 +656,7 @@ class VCloudManager(object):
         metadata = self._build_metadata(dictionary)
         success = self.submit_task(uri, name="Set Metadata", 
             ct="application/vnd.vmware.vcloud.metadata+xml",
-            data=ET.tostring(metadata))
+            data=ET.tostring(metadata), wait=wait)
         return success
 
     def _build_metadata(self, dictionary):
@@ -286,30 +688,44 @@ class VCloudManager(object):
         md.append(mde)
 
     def _get_metadata_entry(self, md, key):
-        kvps = md.findall("{" + self.ns + "}MetadataEntry")
-        for kvp in kvps:
-            entry = kvp.find("{" + self.ns + "}Key")
-            if entry is not None and entry.text == key:
-                value = kvp.find(".//{" + self.ns + "}Value")
-                if value is not None:
-                    return value.text
-        return None
-
-    def set_vapp_vm_creation_time(self, vapp, vm, org=None, vdc=None):
-        stamp = time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime())
-        status = self.add_vapp_vm_metadata(vapp, vm, "created", stamp, "MetadataDateTimeValue")
+        return md.get(key)
+
+    def set_vapp_vm_creation_time(self, vapp, vm, stamp=None, org=None, vdc=None,
+        wait=True):
+        if stamp is None:
+            stamp = time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime())
+        metadata = { "created": { "value": stamp, "type": "MetadataDateTimeValue" }}
+        status = self.add_vapp_vm_metadata(vapp, vm, metadata, org, vdc, wait)
+        self.creation_times[self.vms[vm]] = stamp
         return status
 
     def get_vapp_vm_creation_time(self, vapp, vm, org=None, vdc=None):
-        md = self.get_vapp_vm_metadata(vapp, vm, org, vdc)
-        epoc = time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime(0))
+        # Creation times never change, so they are kept per VM href and only
+        # VMs we have not seen before cost a metadata request.
+        if vm not in self.vms:
+            self.list_vapp_vms(vapp, org, vdc)
+        if self.vms.get(vm) in self.creation_times:
+            return self.creation_times[self.vms[vm]]
+        md = self.get_vapp_vm_metadata(vapp, vm, org=org, vdc=vdc)
         value = self._get_metadata_entry(md, "created")
-        value = epoc if value is None else value
+        if value is None:
+            return time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime(0))
+        self.creation_times[self.vms[vm]] = value
         return value 
 
+    def get_creation_times(self):
+        if len(self.vms) == 0:
+            return self.creation_times
+        known = set(self.vms.values())
+        return {href: stamp for href, stamp in self.creation_times.items() if href in known}
+
+    def set_creation_times(self, times):
+        if times is not None:
+            self.creation_times.update(times)
+
     def list_networks(self, org=None, vdc=None):
         org, vdc = self._check_args(org, vdc)
-        if vdc not in self.config["VDC"].keys():
+        if vdc not in self.config["VDC"]:
             self.get_vdc_config(org,vdc)
         self._get_networks(vdc)
         return self.dc_networks
@@ -321,7 +737,7 @@ class VCloudManager(object):
 
     def list_vapp_networks(self, vapp, org=None, vdc=None):
         org, vdc = self._check_args(org, vdc)
-        if vapp not in self.config["VAPP"].keys():
+        if vapp not in self.config["VAPP"]:
             self.get_vapp_config(vapp, org, vdc)
         self._get_vapp_networks(vapp)
         return self.vapp_networks 
@@ -331,30 +747,73 @@ class VCloudManager(object):
         self.config["NET"][network] = self._do_get_config(network, self.vapp_networks)
         return self.config["NET"][network]
 
-    def get_vm_status(self, vapp, vm=None):
-        vms = self.list_vapp_vms(vapp) if vm is None else [ vm ]
+    def discover(self, vdcs=None, org=None):
+        # Walk the org, fetching every VDC and then every vApp concurrently.
+        # Returns plain dicts of names and hrefs, suitable for JSON.
+        org, vdc = self._check_args(org, "")
+        inventory = { "api": self.api, "org": org, "orgs": dict(self.list_orgs()),
+            "vdcs": {} }
+        self.list_vdcs(org)
+        if vdcs is None:
+            vdcs = self.vdcs.keys()
+        for name in vdcs:
+            if name not in self.vdcs:
+                raise Exception("ERROR: Could not locate configuration for: {}.".format(name))
+
+        # Documents already cached by this manager are not fetched again
+        def get_vdc(name):
+            if name not in self.config["VDC"]:
+                self.config["VDC"][name] = self._get_document(self.vdcs[name], self._parse_vdc)
+            return self.config["VDC"][name]
+
+        def get_vapp(href):
+            for name in self.config["VAPP"].keys():
+                if name in self.config["VAPP"] and self.config["VAPP"][name].href == href:
+                    return self.config["VAPP"][name]
+            return self._get_document(href, self._parse_vapp)
+
+        vapps = []
+        for name, record in zip(vdcs, run_parallel(get_vdc, vdcs)):
+            inventory["vdcs"][name] = { "href": self.vdcs[name],
+                "networks": dict(record.networks), "templates": dict(record.templates),
+                "vapps": {} }
+            vapps += [(name, vapp, href) for vapp, href in record.vapps.items()]
+
+        for (name, vapp, href), record in zip(vapps,
+            run_parallel(get_vapp, [item[2] for item in vapps])):
+            inventory["vdcs"][name]["vapps"][vapp] = { "href": href,
+                "networks": dict(record.networks), "vms": len(record.vms) }
+        return inventory
+
+    def _get_vm_status(self, vm):
+        return {"status": vm.status,
+                "id": vm.id,
+                "name": vm.name,
+                "needsCustomization": vm.needsCustomization,
+                "deployed": vm.deployed,
+                "nets": dict(vm.nets)}
+
+    def get_vm_status(self, vapp, vm=None, refresh=False):
         status = {}
-        for vm in vms:
+        if vm is not None:
             config = self.get_vapp_vm_config(vapp, vm)
-            status[vm] = {"status": config.attrib.get("status"),
-                          "id": config.attrib.get("id"),
-                          "name": config.attrib.get("name"),
-                          "needsCustomization": config.attrib.get("needsCustomization"),
-                          "deployed": config.attrib.get("deployed"),
-                          "nets": {}}
-            net_conns = config.findall('.//{' + self.ns + '}NetworkConnection')
-            for net in net_conns:
-                network = net.attrib.get("network")
-                ip = net.find('.//{' + self.ns + '}IpAddress')
-                if ip is None:
-                    status[vm]["nets"][network] = ""
-                else:
-                    status[vm]["nets"][network] = ip.text
+            status[vm] = self._get_vm_status(config)
+            return status
+
+        # The vApp document already carries the full Vm element for every VM
+        # in the vApp, so build the status from it rather than fetching each
+        # VM in turn. The per network IPs we need are not available from the
+        # query service, which only reports the primary address.
+        if refresh or vapp not in self.config["VAPP"]:
+            self.get_vapp_config(vapp)
+        self._get_virtual_machines(vapp)
+        for vm in self.config["VAPP"][vapp].vms:
+            status[vm.name] = self._get_vm_status(vm)
         return status
 
     def get_task_status(self, task):
         uri = task.get("href")
-        response = requests.get(uri, headers=self.headers)
+        response = self._request("GET", uri)
         if response.status_code != 200:
             self._debug("CODE: {}\n".format(response.status_code))
             self._debug("DATA: {}\n".format(response.text))
@@ -362,23 +821,43 @@ class VCloudManager(object):
                 " Data: {}".format(response.text))
         return ET.fromstring(response.text)
 
-    def wait_for_task(self, task):
-        start = time.time()
-        status = task.get("status")
-        while status == "running":
-            self._debug("waiting for task: {:0>2.2f}\n".format(time.time() - start))
-            if time.time() - start > self.timeout:
-                return "running"
-            time.sleep(5)
-            task = self.get_task_status(task)
-            status = task.get("status")
-        return status
+    def wait_for_task(self, task, timeout=None):
+        return self.wait_for_tasks([task], timeout)[0]
 
-    def submit_task(self, uri, name="Task", ct=None, data=None):
-        headers = self.headers
+    def wait_for_tasks(self, tasks, timeout=None):
+        # Poll all of the outstanding tasks together, starting with short
+        # intervals and backing off towards poll_max for long running tasks.
+        # Tasks still pending after the timeout are returned as they are.
+        if timeout is None:
+            timeout = self.timeout
+        start = time.time()
+        delay = self.poll_min
+        status = {}
+        for task in tasks:
+            status[task.get("href")] = task.get("status")
+        pending = [task for task in tasks if task.get("status") in self.TASK_PENDING]
+        while len(pending) > 0:
+            self._debug("waiting for {} task(s): {:0>2.2f}\n".format(len(pending),
+                time.time() - start))
+            if time.time() - start > timeout:
+                break
+            time.sleep(delay)
+            delay = min(delay * 1.5, self.poll_max)
+            pending = run_parallel(self.get_task_status, pending)
+            for task in pending:
+                status[task.get("href")] = task.get("status")
+            pending = [task for task in pending if task.get("status") in self.TASK_PENDING]
+        return [status[task.get("href")] for task in tasks]
+
+    def recompose_timeout(self, count):
+        # A recompose deploys and powers on each VM it adds or removes
+        return self.timeout + self.vm_timeout * count
+
+    def submit_task(self, uri, name="Task", ct=None, data=None, wait=True, timeout=None):
+        headers = dict(self.headers)
         if ct is not None:
             headers["Content-Type"] = ct
-        response = requests.post(uri, headers=headers, data=data)
+        response = self._request("POST", uri, headers=headers, data=data)
         self._debug("POST: {}\n".format(uri))
         self._debug("Headers: {}\n".format(headers))
         self._debug("DATA: {}\n".format(data))
@@ -387,48 +866,91 @@ class VCloudManager(object):
             raise Exception("ERROR: Task submission failed. Code: {},".format(response.status_code) +
                 " Data: {}".format(response.text))
         self._debug("{} Running.\n".format(name))
+        self._invalidate(uri)
         task = ET.fromstring(response.text)
-        status = self.wait_for_task(task)
+        if wait is False:
+            # The caller will collect the task with wait_for_tasks()
+            return task
+        status = self.wait_for_task(task, timeout)
         self._debug("{} Task Complete. Status: {}\n".format(name, status))
         return status
 
     def add_vm_to_vapp(self, vapp, template, networks, ipMode, vm):
+        return self.add_vms_to_vapp(vapp, template, networks, ipMode, [ vm ])
+
+    def add_vms_to_vapp(self, vapp, template, networks, ipMode, vms):
+        # All of the VMs are added by a single recompose task
         if template not in self.templates.keys():
             raise Exception("Template has not been discovered: {}".format(template))
         for network in networks:
             if network not in self.vapp_networks.keys():
                 raise Exception("Network has not been discovered: {}".format(network))
-        rvo = RecomposeVAppObject(self.ns, self.customize)
-        rvo.add_vm_to_vapp(networks, self.vapp_networks, ipMode, vm, template, self.config)
+        rvo = RecomposeVAppObject(self.ns, self.customize, power_on=self.power_on_deploy)
+        for vm in vms:
+            rvo.add_vm_to_vapp(networks, self.vapp_networks, ipMode, vm, template, self.config)
         xml = rvo.to_string()
         uri = self.vapps[vapp] + "/action/recomposeVApp"
         ct = "application/vnd.vmware.vcloud.recomposeVAppParams+xml"
-        status = self.submit_task(uri, "Recompose VAPP", ct, xml)
+        status = self.submit_task(uri, "Recompose VAPP", ct, xml,
+            timeout=self.recompose_timeout(len(vms)))
         if status == "success":
             self.get_vapp_config(vapp)
             self.list_vapp_vms(vapp)
         return status
 
     def del_vm_from_vapp(self, vapp, vm):
-        if self.vms is None or vm not in self.vms:
-            self.get_vapp_vm_config(vapp, vm)
-        if vm not in self.vms:
-            raise Exception("Unknown VM: {}".format(vm))
+        return self.del_vms_from_vapp(vapp, [ vm ])
+
+    def del_vms_from_vapp(self, vapp, vms):
+        for vm in vms:
+            if self.vms is None or vm not in self.vms:
+                self.get_vapp_vm_config(vapp, vm)
+            if vm not in self.vms:
+                raise Exception("Unknown VM: {}".format(vm))
+
+        # VMs which are already powered off don't need undeploying, and if the
+        # cell can delete running VMs we try the recompose on its own first.
+        running = [vm for vm in vms if self._is_deployed(vapp, vm)]
+        if self.delete_running is False:
+            run_parallel(self.shutdown, running)
+            return self._recompose_delete(vapp, vms)
+
+        try:
+            status = self._recompose_delete(vapp, vms)
+        except Exception as e:
+            if len(running) == 0:
+                raise e
+            self._debug("Recompose failed: {}\n".format(e))
+            status = "error"
+        if status != "success" and len(running) > 0:
+            self._debug("Undeploying running VMs before deleting them\n")
+            run_parallel(self.shutdown, running)
+            status = self._recompose_delete(vapp, vms)
+        return status
 
-        self.shutdown(vm)
+    def _recompose_delete(self, vapp, vms):
         rvo = RecomposeVAppObject(self.ns)
-        rvo.del_vm_from_vapp(self.vms[vm])
+        for vm in vms:
+            rvo.del_vm_from_vapp(self.vms[vm])
         xml = rvo.to_string()
         uri = self.vapps[vapp] + "/action/recomposeVApp"
         ct = "application/vnd.vmware.vcloud.recomposeVAppParams+xml"
-        status = self.submit_task(uri, "Recompose VAPP", ct, xml)
-        return status
-        
-    def poweron(self, vm):
+        return self.submit_task(uri, "Recompose VAPP", ct, xml,
+            timeout=self.recompose_timeout(len(vms)))
+
+    def _is_deployed(self, vapp, vm):
+        if vapp not in self.config["VAPP"]:
+            self.get_vapp_config(vapp)
+        for record in self.config["VAPP"][vapp].vms:
+            if record.name == vm:
+                return record.deployed == "true" or record.status == "4"
+        return True
+
+    def poweron(self, vm, wait=True):
         if vm not in self.vms:
             raise Exception("ERROR: Unknown VM: {}".format(vm))
         uri = self.vms[vm] + "/power/action/powerOn"
-        status = self.submit_task(uri, "Power On")
+        status = self.submit_task(uri, "Power On", wait=wait)
         return status
 
     def shutdown(self, vm):
@@ -455,11 +977,21 @@ class VCloudManager(object):
         return status
 
 
+# Managers kept between requests when running as a daemon
+MANAGER_POOL = {}
+MANAGER_LOCK = threading.Lock()
+
+
 class RecomposeVAppObject(object):
 
-    def __init__(self, ns, customize=False, text="Recompose VApp"):
+    def __init__(self, ns, customize=False, text="Recompose VApp", power_on=False):
 
+        load_modules()
         self._root = Element("RecomposeVAppParams")
+        if power_on:
+            # Ask the recompose task to deploy and power on the new VMs
+            self._root.set("deploy", "true")
+            self._root.set("powerOn", "true")
         self.ns = ns
         self.ovf = "http://schemas.dmtf.org/ovf/envelope/1"
         self.customize = customize
@@ -476,8 +1008,8 @@ class RecomposeVAppObject(object):
 
         # Configure the Template
         sourcedItem = Element("{" + self.ns + "}SourcedItem")
-        vm = config["TMPL"][template].find(".//{" + self.ns + "}Vm")
-        source = Element("Source", href=vm.attrib.get("href"), name=vmName)
+        vm = config["TMPL"][template].vms[0]
+        source = Element("Source", href=vm.href, name=vmName)
         instParams = Element("InstantiationParams")
         netConnSec = Element("NetworkConnectionSection")
         netConnInf = Element("{" + self.ovf + "}Info")
@@ -523,7 +1055,7 @@ def help():
     text="""
     Usage: vclouddriver.py [--help] action options
 
-        action: [status|createnode|destroynode|get-vdc-info]
+        action: [status|createnode|destroynode|reconcile|get-vdc-info|daemon]
 
         common options:
             --verbose          Print verbose logging messages to the CLI
@@ -543,12 +1075,51 @@ def help():
         and network. You may also override these by passing them on the
         command line. Eg: --apiHost, --vdc, --vapp, etc
 
+        The optional sessionTTL sets how long, in seconds, the vCloud session
+        token is reused between runs (default 1500). historyTTL sets how long
+        node changes are kept for --deltasince (default 3600), and setting
+        historyBackup to true also copies that history into vApp metadata.
+        httpTimeout (default 60) and httpRetries (default 3) control the read
+        timeout and retries of requests to the vCloud API. A task is waited
+        on for taskTimeout seconds (default 60), and a recompose for another
+        taskTimeoutPerVM seconds (default 30) for each VM it adds or removes.
+        A node whose recompose is not done by then is reported as failed,
+        though the cell may still go on to add it. Setting rateLimit
+        paces the requests to the cell from every driver process to that
+        many a second, with bursts of up to rateBurst (default rateLimit).
+        They share the file vcd.ratelimit next to the state file (or
+        ratefile). A 429 or 503 holds back every process for the time given
+        by Retry-After, or an increasing backoff, before retrying.
+
+        Setting statusStale answers a full status poll from the last good
+        node list if it is younger than that many seconds, while a fresh
+        list is fetched in the background. If the cell fails, a list of up
+        to statusMaxStale seconds (default 600) is reported instead. After
+        breakerFailures (default 3) failures in a row the cell is left alone
+        for breakerReset seconds (default 30).
+
+        A pool can span several vApps by listing them in vapps instead of
+        vapp, as a comma separated list of "vapp" or "vdc/vapp" entries.
+        New nodes go to the vApp with the most room left below shardMax
+        (default 128 VMs per vApp), which is only enforced when it is set.
+
+        Setting trace to true, or passing --trace, appends a record of each
+        HTTP request and the time spent in each phase of the action to
+        <statefile>.trace.jsonl, or to tracefile if set. The file is rotated
+        once it reaches traceMaxKB (default 5120).
+
+        --profile[=<top>] profiles the action with cProfile, and traces its
+        memory allocations, writing <statefile>.prof and a report of the top
+        functions and allocations (default 20) to <statefile>.profile.txt and
+        stderr. --profilefile=<base> writes <base>.prof etc instead.
+
         action-specific options:
         ------------------------
 
         createnode                Add a node to the cloud
 
-            --name=<nodename>     Name to give the new node
+            --name=<nodename>     Name to give the new node. A comma separated
+                                  list creates several nodes in one recompose
             --imageid=<template>  The template to use 
             --sizeid=<size>       Not used
 
@@ -556,14 +1127,44 @@ def help():
 
             --id=<uniqueid>       ID of the node to delete
             --name=<nodename>     Name of the node to delete
+                                  Both accept a comma separated list
 
         status                    Get current node status 
 
             --name=<nodename>     Display the status of the named node only
+            --deltasince=<time>   Only report nodes changed since this time
+
+        reconcile                 Create and destroy nodes to leave count
+                                  nodes, printing the plan to stderr and
+                                  each node's result. New nodes use the
+                                  given template; existing nodes are not
+                                  checked against it
+
+            --count=<nodes>       Number of nodes wanted
+            --imageid=<template>  The template to use
+            --sizeid=<size>       Not used
+            --prefix=<name>       Name new nodes <name><n> (default node),
+                                  and only count or destroy VMs so named
+            --parallel=<vapps>    Recompose at most this many vApps at once
+                                  (default 8)
+            --dryrun[=true]       Print the plan without applying it
 
         get-vdc-info              Display a list of resource in your VDC
 
             --wrap                Wrap output to match the console width
+            --all                 Include every VDC in the org, not just
+                                  the VDCs used by the pool
+            --json                Print the inventory as JSON
+            --cached[=<seconds>]  Reuse the last inventory if it is younger
+                                  than this (default 300)
+
+        daemon                    Serve requests for this cloud credential
+                                  over a Unix socket, keeping the session and
+                                  caches warm. Set daemon to true in the
+                                  config file to start one automatically.
+
+            --idle=<seconds>      Exit after this long without a request
+                                  (default 3600)
 
 """
     sys.stderr.write(text)
@@ -612,59 +1213,91 @@ def convertNodeData(opts,vcm,item):
             node["complete"] = 100
     return node
 
-def get_delta(vcm, opts, nodes):
+def write_delta(vcm, opts, nodes, out):
 
-    now = int(time.time())
-    history = vcm.get_vapp_metadata(opts["vapp"], "vtm_history")
-
-    if history is None:
-        history = { now: nodes }
-        metadata = { "vtm_history": { "value": json.dumps(history), "type": "MetadataStringValue" } }
-        vcm.add_vapp_metadata(opts["vapp"], metadata)
-        return nodes
-
-    history = json.loads(history)
-    deltasince = int( opts["deltasince"] ) + 10
-    entries = sorted(history.keys())
-    entry = max([entry for entry in entries if int(entry) <= deltasince or entry == entries[0]])
-    oldNodes = {node["name"]:node for node in history[entry]}
-    current = {node["name"]:node for node in nodes}
-
-    delta = []
-    for node in oldNodes.keys():
-        if node in current.keys():
-            if current[node] != oldNodes[node]:
-                delta.append(current[node])
-        else:
-            oldNodes[node]["status"] = "destroyed"
-            oldNodes[node]["complete"] = 100
-            delta.append(oldNodes[node])
+    # The history lives in a local file. It can optionally be backed up into
+    # the vApp metadata, which is written without waiting for the task.
+    backup = "historyBackup" in opts.keys() and opts["historyBackup"].lower() == "true"
+    retain = int(opts["historyTTL"]) if "historyTTL" in opts.keys() else 3600
+    history = NodeHistory(opts["historyfile"], retain)
 
-    while len(entries) >= 2:
-        del history[entries.pop(0)]
+    if history.current is None and backup:
+        saved = vcm.get_vapp_metadata(opts["vapp"], "vtm_history")
+        if saved is not None:
+            saved = json.loads(saved)
+            if "current" in saved.keys():
+                history.load(saved)
 
-    history[now] = nodes
-    metadata = { "vtm_history": { "value": json.dumps(history), "type": "MetadataStringValue" } }
-    vcm.add_vapp_metadata(opts["vapp"], metadata)
-    return delta
+    # Every node is written out as the history reads it, unless only the
+    # changes since deltasince are wanted
+    delta = history.current is not None and "deltasince" in opts.keys()
+    now = int(time.time())
+    changed = history.update(nodes if delta else out.passing(nodes), now)
+    with Tracer.current().phase("history"):
+        if changed:
+            history.save()
+            if backup:
+                value = json.dumps(history.dump(), separators=(',', ':'))
+                if len(value) < 120 * 1024:
+                    metadata = { "vtm_history": { "value": value, "type": "MetadataStringValue" } }
+                    vcm.add_vapp_metadata(opts["vapp"], metadata, wait=False)
+                else:
+                    vcm._debug("History too large for vApp metadata, not backed up\n")
 
-def get_status(opts, vcm):
-    nodes = []
-    if "name" in opts.keys():
-        status = vcm.get_vm_status(opts["vapp"], opts["name"])
+    if delta:
+        out.write_all(history.since(delta_since(opts, now)))
+
+def iter_shard_status(shard, name=None):
+    shardOpts, vcm = shard
+    if name is not None:
+        status = vcm.get_vm_status(shardOpts["vapp"], name)
     else:
-        status = vcm.get_vm_status(opts["vapp"])
+        status = vcm.get_vm_status(shardOpts["vapp"])
 
     for vm in status.keys():
         node = status[vm]
-        node = convertNodeData(opts,vcm,node)
-        node["created"] = vcm.get_vapp_vm_creation_time(opts["vapp"], vm)
-        nodes.append(node)
+        node = convertNodeData(shardOpts,vcm,node)
+        node["created"] = vcm.get_vapp_vm_creation_time(shardOpts["vapp"], vm)
+        yield node
 
-    if "deltasince" in opts.keys():
-        nodes = get_delta(vcm, opts, nodes)
+def get_shard_status(shard, name=None):
+    return list(iter_shard_status(shard, name))
 
-    return nodes
+def write_status(opts, shards, out):
+    if "name" in opts.keys():
+        shard = find_shard(shards, opts["name"])
+        if shard is not None:
+            out.write_all(get_shard_status(shard, opts["name"]))
+        return
+
+    write_delta(shards[0][1], opts, get_nodes(shards), out)
+
+def get_nodes(shards):
+    # Each vApp is polled by its own manager, so the shards run concurrently.
+    # The nodes of a single vApp are passed on as each one is converted.
+    with Tracer.current().phase("enrich"):
+        if len(shards) == 1:
+            for node in iter_shard_status(shards[0]):
+                yield node
+        else:
+            for shardNodes in run_parallel(get_shard_status, shards):
+                for node in shardNodes:
+                    yield node
+
+def write_cached_status(opts, argv, cache, out):
+    # Returns the shards set up to fetch the nodes, if any
+    shards = []
+
+    def fetch():
+        shards.extend(setup(opts))
+        return list(get_nodes(shards))
+
+    nodes, live = cache.status(argv, fetch, "refresh" in opts.keys())
+    if live:
+        write_delta(shards[0][1], opts, nodes, out)
+    else:
+        write_cached(opts, NodeHistory(opts["historyfile"]), nodes, out)
+    return shards
 
 def get_net_list(opts):
     networks = []
@@ -680,54 +1313,218 @@ def get_net_list(opts):
         sys.exit(1)
     return [net.strip() for net in networks]
 
-def add_node(opts, vcm):
+def get_name_list(opts, key):
+    return [name.strip() for name in opts[key].split(",") if name.strip() != ""]
+
+def get_shard_list(opts):
+    # A pool may span several vApps, listed in "vapps" as either "vapp" or
+    # "vdc/vapp". Without it the pool is the single "vapp" in "vdc".
+    if "vapps" not in opts.keys():
+        return [(opts["vdc"], opts["vapp"])]
+    shards = []
+    for name in get_name_list(opts, "vapps"):
+        if "/" in name:
+            vdc, vapp = name.split("/", 1)
+            shards.append((vdc.strip(), vapp.strip()))
+        else:
+            shards.append((opts["vdc"], name))
+    return shards
+
+def find_shard(shards, name):
+    for shard in shards:
+        shardOpts, vcm = shard
+        if name in vcm.get_vm_status(shardOpts["vapp"]):
+            return shard
+    return None
+
+def get_headroom(opts, shard):
+    shardOpts, vcm = shard
+    limit = int(opts["shardMax"]) if "shardMax" in opts.keys() else 128
+    return limit - len(vcm.get_vm_status(shardOpts["vapp"]))
+
+def place_nodes(opts, shards, names):
+    # Give each new node to the shard with the most headroom left
+    headroom = [get_headroom(opts, shard) for shard in shards]
+    placed = [[] for shard in shards]
+    for name in names:
+        best = headroom.index(max(headroom))
+        if headroom[best] <= 0 and "shardMax" in opts.keys():
+            raise Exception("ERROR: No vApp has room for node: {}".format(name))
+        placed[best].append(name)
+        headroom[best] -= 1
+    return [(shards[i], placed[i]) for i in range(len(shards)) if len(placed[i]) > 0]
+
+def add_shard_nodes(placement):
+    (shardOpts, vcm), names = placement
+    vcm.get_vapp_template_config(shardOpts["imageid"])
+    networks = get_net_list(shardOpts)
+    vcm.list_vapp_networks(shardOpts['vapp'])
+    stamp = time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime())
+    status = vcm.add_vms_to_vapp(shardOpts["vapp"], shardOpts["imageid"], networks,
+        shardOpts["ipMode"], names)
+    if status in vcm.TASK_PENDING:
+        raise Exception("ERROR: Gave up on the recompose adding VMs to vApp after " +
+            "{}s. The VMs may still appear.".format(vcm.recompose_timeout(len(names))))
+    if status != "success":
+        raise Exception("ERROR: Failed to add VMs to vApp. Task status: {}".format(status))
+
+    # The recompose task deploys and powers on the VMs, and leaves us with a
+    # fresh copy of the vApp to take their status from. The creation times
+    # are written in the background, we don't need to wait for them.
+    tasks = []
+    for name in names:
+        tasks.append(vcm.set_vapp_vm_creation_time(shardOpts["vapp"], name, stamp, wait=False))
+    nodeStatus = vcm.get_vm_status(shardOpts["vapp"])
+
+    # Fall back to powering on any VMs the cell didn't start for us
+    off = [name for name in names if nodeStatus[name]["status"] != "4"]
+    if len(off) > 0:
+        vcm._debug("Powering on VMs not started by recompose: {}\n".format(off))
+        vcm.wait_for_tasks(tasks + [vcm.poweron(name, wait=False) for name in off])
+        nodeStatus = vcm.get_vm_status(shardOpts["vapp"], refresh=True)
+
+    nodes = []
+    for name in names:
+        myNode = convertNodeData(shardOpts, vcm, nodeStatus[name])
+        myNode["created"] = stamp
+        nodes.append(myNode)
+    return nodes
+
+def create_shard_nodes(placement):
+    # As add_shard_nodes, but a failure is reported against each node
+    shard, names = placement
+    try:
+        return add_shard_nodes(placement)
+    except (Exception, SystemExit) as e:
+        return [{ "name": name, "status": "failed", "error": str(e) } for name in names]
+
+def add_node(opts, shards):
+    # Returns the number of nodes which failed, so the state is still saved
     if "name" not in opts.keys() or "imageid" not in opts.keys():
         sys.stderr.write("ERROR - You must provide --name, and --imageid to create a node\n")
         sys.exit(1)
 
-    vcm.get_vapp_template_config(opts["imageid"])
-    networks = get_net_list(opts)
-    vcm.list_vapp_networks(opts['vapp'])
-    status = vcm.add_vm_to_vapp(opts["vapp"], opts["imageid"], networks, opts["ipMode"], opts["name"])
-    stamp = time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime())
-    metadata = { "created": { "value": stamp, "type": "MetadataDateTimeValue" }}
-    status = vcm.add_vapp_vm_metadata(opts["vapp"], opts["name"], metadata)
-    status = vcm.poweron(opts["name"])
-    nodeStatus = vcm.get_vm_status(opts["vapp"], opts["name"])
-    myNode = convertNodeData(opts, vcm, nodeStatus[opts["name"]])
-    myNode["created"] = stamp
-    ret = { "CreateNodeResponse":{"version":1, "code":202, "nodes":[ myNode ]}}
+    # --name may be a comma separated list. The nodes are spread over the
+    # shards, and each shard adds its share in a single recompose.
+    names = get_name_list(opts, "name")
+    nodes = []
+    for shardNodes in run_parallel(create_shard_nodes, place_nodes(opts, shards, names)):
+        nodes += shardNodes
+    failed = [node for node in nodes if node["status"] == "failed"]
+    for node in failed:
+        sys.stderr.write("ERROR - Failed to create {}: {}\n".format(node["name"], node["error"]))
+    ret = { "CreateNodeResponse":{"version":1, "code":202, "nodes": nodes }}
     print json.dumps(ret)
+    return len(failed)
 
-def del_node(opts, vcm):
+def del_shard_nodes(removal):
+    (shardOpts, vcm), names = removal
+    return vcm.del_vms_from_vapp(shardOpts["vapp"], names)
+
+def del_node(opts, shards):
     if "name" not in opts.keys() and "id" not in opts.keys():
         sys.stderr.write("ERROR - please provide --name or --id to delete node\n")
         sys.exit(1)
 
-    myNode = None
-    nodes = get_status(opts, vcm)
-    for node in nodes:
-        if "name" in opts.keys() and node["name"] == opts["name"]:
-            myNode = node
-            break
-        elif "id" in opts.keys() and node["uniq_id"] == opts["id"]:
-            myNode = node
-            break
-
-    if myNode is not None:
-        vcm.del_vm_from_vapp(opts["vapp"], myNode["name"])
-        ret = { "DestroyNodeResponse": { "version": 1, "code": 202, "nodes": \
-            [{ "created": 0, "uniq_id": myNode['uniq_id'], "status": "destroyed", \
-            "complete": "80"}]}}
-    else:
+    # --name and --id may be comma separated lists, removed in one recompose
+    # per shard
+    names = get_name_list(opts, "name") if "name" in opts.keys() else []
+    ids = get_name_list(opts, "id") if "id" in opts.keys() else []
+
+    # Match against the vApp documents setup() already holds, rather than a
+    # full status sweep with its metadata lookups
+    myNodes = []
+    removals = []
+    for shard in shards:
+        shardOpts, vcm = shard
+        shardNodes = []
+        for vm in vcm.get_vm_status(shardOpts["vapp"]).values():
+            if vm["name"] in names or vm["id"] in ids:
+                shardNodes.append({ "name": vm["name"], "uniq_id": vm["id"] })
+        if len(shardNodes) > 0:
+            removals.append((shard, [node["name"] for node in shardNodes]))
+        myNodes += shardNodes
+
+    run_parallel(del_shard_nodes, removals)
+
+    ret = { "DestroyNodeResponse": { "version": 1, "code": 202, "nodes": [] }}
+    for node in myNodes:
+        ret["DestroyNodeResponse"]["nodes"].append({ "created": 0,
+            "uniq_id": node['uniq_id'], "status": "destroyed", "complete": "80"})
+    found = [node["uniq_id"] for node in myNodes]
+    for uniq_id in ids:
+        if uniq_id not in found:
+            ret["DestroyNodeResponse"]["nodes"].append({ "created": 0,
+                "uniq_id": uniq_id, "status": "destroyed", "complete": "80"})
+    if len(ret["DestroyNodeResponse"]["nodes"]) == 0:
         # should probbaly return a 404???
-        opts["id"] = None if "id" not in opts.keys() else opts["id"]
-        ret = { "DestroyNodeResponse": { "version": 1, "code": 202, "nodes": \
-            [{ "created": 0, "uniq_id": opts['id'], "status": "destroyed", \
-            "complete": "80"}]}}
+        ret["DestroyNodeResponse"]["nodes"].append({ "created": 0,
+            "uniq_id": None, "status": "destroyed", "complete": "80"})
 
     print json.dumps(ret)
 
+def reconcile_shard(job):
+    # Each vApp takes one recompose at a time, so its removals go first and
+    # its new nodes follow in a second recompose
+    (shardOpts, vcm), create, destroy = job
+    results = []
+    if len(destroy) > 0:
+        try:
+            status = vcm.del_vms_from_vapp(shardOpts["vapp"], [node["name"] for node in destroy])
+            if status != "success":
+                raise Exception("Failed to remove VMs from vApp. Task status: {}".format(status))
+            for node in destroy:
+                results.append({ "action": "destroy", "name": node["name"],
+                    "uniq_id": node["uniq_id"], "status": "destroyed", "complete": 80 })
+        except (Exception, SystemExit) as e:
+            for node in destroy:
+                results.append({ "action": "destroy", "name": node["name"],
+                    "uniq_id": node["uniq_id"], "status": "failed", "error": str(e) })
+    if len(create) > 0:
+        for node in create_shard_nodes(((shardOpts, vcm), create)):
+            results.append(dict(node, action="create"))
+    return results
+
+def reconcile(opts, shards):
+    # Returns the number of nodes which failed, so the state is still saved
+    for key in ("count", "imageid", "sizeid"):
+        if key not in opts.keys():
+            sys.stderr.write("ERROR - You must provide --count, --imageid and --sizeid to reconcile\n")
+            sys.exit(1)
+
+    # Keep track of which vApp holds each node, so it is removed from there
+    with Tracer.current().phase("enrich"):
+        shardNodes = run_parallel(get_shard_status, shards)
+    nodes = [node for found in shardNodes for node in found]
+    # A VM doesn't record the template it was made from, and every node
+    # reports the configured sizeid, so only the number of nodes is matched.
+    # Only the VMs named <prefix><n> belong to the pool.
+    create, destroy = plan_reconcile(nodes, int(opts["count"]), {},
+        opts["prefix"] if "prefix" in opts.keys() else "node")
+    print_plan(opts["count"], [(name, (opts["imageid"], opts["sizeid"])) for name in create], destroy)
+
+    results = []
+    dryrun = is_set(opts, "dryrun")
+    if dryrun:
+        results = planned_results(create, destroy)
+    elif len(create) + len(destroy) > 0:
+        # Every vApp with work to do is recomposed at once, up to --parallel
+        placed = dict((id(shard), names) for shard, names in place_nodes(opts, shards, create))
+        jobs = []
+        for shard, found in zip(shards, shardNodes):
+            ids = set(node["uniq_id"] for node in found)
+            removals = [node for node in destroy if node["uniq_id"] in ids]
+            if id(shard) in placed or len(removals) > 0:
+                jobs.append((shard, placed.get(id(shard), []), removals))
+        parallel = int(opts["parallel"]) if "parallel" in opts.keys() else 8
+        for jobResults in run_parallel(reconcile_shard, jobs, parallel):
+            results += jobResults
+
+    failed = len([result for result in results if result["status"] == "failed"])
+    code = 500 if failed > 0 else 202 if len(results) > 0 and not dryrun else 200
+    print json.dumps({ "ReconcileResponse": { "version": 1, "code": code, "nodes": results }})
+    return failed
+
 def print_table(dictionary, wrap=False, spacing=3):
     kl = 0
     vl = 0
@@ -760,14 +1557,46 @@ def print_table(dictionary, wrap=False, spacing=3):
 
         print "{}".format("~"*tl)
 
-def get_vdc_info(opts, vcm):
+def load_inventory(opts):
+    # --cached[=<seconds>] reuses a snapshot younger than that (default 300)
+    if "cached" not in opts.keys():
+        return None
+    maxage = int(opts["cached"]) if opts["cached"] != "" else 300
+    saved = StateFile(opts["inventoryfile"]).read()
+    if "inventory" not in saved.keys() or saved.get("stamp", 0) < time.time() - maxage:
+        return None
+    return saved["inventory"]
+
+def get_vdc_info(opts, shards=None):
+    inventory = load_inventory(opts)
+    if inventory is None:
+        vcm = shards[0][1]
+        vdcs = None
+        if "all" not in opts.keys():
+            vdcs = []
+            for shardOpts, shardVcm in shards:
+                if shardOpts["vdc"] not in vdcs:
+                    vdcs.append(shardOpts["vdc"])
+        inventory = vcm.discover(vdcs)
+        StateFile(opts["inventoryfile"]).write({ "stamp": int(time.time()),
+            "inventory": inventory })
+
+    if "json" in opts.keys():
+        print json.dumps(inventory)
+        return
+
     to_print = {}
-    to_print["Organizations"] = vcm.list_orgs()
-    to_print["Virtual DCs"] = vcm.list_vdcs()
-    to_print["Virtual DC Networks"] = vcm.list_networks()
-    to_print["Virtual Apps"] = vcm.list_vapps()
-    to_print["Virtual App Networks: {}".format(opts['vapp'])] = vcm.list_vapp_networks(opts["vapp"])
-    to_print["Virtual AppTemplates"] = vcm.list_vapp_templates()
+    to_print["Organizations"] = inventory["orgs"]
+    to_print["Virtual DCs"] = {}
+    for vdc in inventory["vdcs"].keys():
+        info = inventory["vdcs"][vdc]
+        to_print["Virtual DCs"][vdc] = info["href"]
+        to_print["Virtual DC Networks: {}".format(vdc)] = info["networks"]
+        to_print["Virtual Apps: {}".format(vdc)] = {}
+        to_print["Virtual AppTemplates: {}".format(vdc)] = info["templates"]
+        for vapp in info["vapps"].keys():
+            to_print["Virtual Apps: {}".format(vdc)][vapp] = info["vapps"][vapp]["href"]
+            to_print["Virtual App Networks: {}".format(vapp)] = info["vapps"][vapp]["networks"]
 
     wrap = False
     if "wrap" in opts.keys():
@@ -809,7 +1638,7 @@ def get_cloud_credentials(opts):
         sys.stderr.write("ERROR - Credential 1 must be set to the VCloud config file name\n")
         sys.exit(1)
 
-def setup(opts):
+def read_config(opts):
 
     if "cred1" not in opts.keys():
         get_cloud_credentials(opts)
@@ -835,6 +1664,10 @@ def setup(opts):
         sys.stderr.write("ERROR - 'vdc' must be specified in the VCD config file: " + opts["cred1"] + "\n")
         sys.exit(1)
 
+    if "vapp" not in opts.keys() and "vapps" not in opts.keys():
+        sys.stderr.write("ERROR - 'vapp' or 'vapps' must be specified in the VCD config file: " + opts["cred1"] + "\n")
+        sys.exit(1)
+
     if "sizeid" not in opts.keys():
         sys.stderr.write("ERROR - 'sizeid' must be specified in the VCD config file: " + opts["cred1"] + "\n")
         sys.exit(1)
@@ -847,10 +1680,84 @@ def setup(opts):
         else:
             opts["statefile"] = None
 
-    # Set up the VCloudManager
-    vcm = VCloudManager(opts["apiHost"], opts["org"], opts["vdc"], opts["verbose"])
-    vcm.setup_session(opts["user"], opts["pass"])
-    vcm.get_vapp_config(opts["vapp"])
+    if "historyfile" not in opts.keys():
+        if opts["statefile"] is not None:
+            opts["historyfile"] = os.path.splitext(opts["statefile"])[0] + ".history"
+        else:
+            opts["historyfile"] = None
+
+    if "inventoryfile" not in opts.keys():
+        if opts["statefile"] is not None:
+            opts["inventoryfile"] = os.path.splitext(opts["statefile"])[0] + ".inventory"
+        else:
+            opts["inventoryfile"] = None
+
+    maxBytes = int(opts["traceMaxKB"]) * 1024 if "traceMaxKB" in opts.keys() else 5242880
+    Tracer.current().enable(get_trace_path(opts, get_state_base(opts)), maxBytes)
+
+def setup(opts):
+
+    tracer = Tracer.current()
+    with tracer.phase("config"):
+        read_config(opts)
+
+    # Set up a VCloudManager for each vApp in the pool, all sharing a single
+    # session and reusing the hrefs resolved by earlier runs
+    state = StateFile(opts["statefile"])
+    saved = state.read()
+    session = saved.get("session")
+    shardHrefs = saved.get("shards", {})
+    shards = checkout_shards(opts)
+    with tracer.phase("auth"):
+        for vdc, vapp in get_shard_list(opts)[len(shards):]:
+            shardOpts = dict(opts, vdc=vdc, vapp=vapp)
+            vcm = new_manager(opts, vdc, session)
+            session = vcm.get_session()
+            if len(shards) == 0:
+                vcm.set_hrefs(saved.get("hrefs"))
+            else:
+                vcm.set_hrefs(shardHrefs.get(vdc + "/" + vapp))
+            vcm.set_creation_times(saved.get("created"))
+            shards.append((shardOpts, vcm))
+
+    # The first shard is the home of the pool's history backup
+    opts["vdc"] = shards[0][0]["vdc"]
+    opts["vapp"] = shards[0][0]["vapp"]
+    with tracer.phase("list"):
+        run_parallel(lambda shard: shard[1].get_vapp_config(shard[0]["vapp"]), shards)
+    return shards
+
+def get_pool_key(opts):
+    keys = ("apiHost", "user", "pass", "org", "sessionTTL", "httpTimeout", "httpRetries",
+        "taskTimeout", "taskTimeoutPerVM", "customize", "powerOnDeploy", "deleteRunning", "verbose", "rateLimit", "rateBurst",
+        "ratefile")
+    return json.dumps([opts.get(key) for key in keys] + [get_shard_list(opts)])
+
+def checkout_shards(opts):
+    # Managers left by an earlier request to the daemon keep their session
+    # and caches. A request takes them for its own use until teardown().
+    with MANAGER_LOCK:
+        pool = MANAGER_POOL.get(get_pool_key(opts), [])
+        if len(pool) == 0:
+            return []
+        return [(dict(opts, vdc=vdc, vapp=vapp), vcm)
+            for (vdc, vapp), (shardOpts, vcm) in zip(get_shard_list(opts), pool.pop())]
+
+def new_manager(opts, vdc, session=None):
+    ttl = int(opts["sessionTTL"]) if "sessionTTL" in opts.keys() else 1500
+    timeout = int(opts["httpTimeout"]) if "httpTimeout" in opts.keys() else 60
+    retries = int(opts["httpRetries"]) if "httpRetries" in opts.keys() else 3
+    task_timeout = int(opts["taskTimeout"]) if "taskTimeout" in opts.keys() else 60
+    vm_timeout = int(opts["taskTimeoutPerVM"]) if "taskTimeoutPerVM" in opts.keys() else 30
+    # Every credential for the cell shares one limiter, next to the state file
+    ratefile = None
+    if opts.get("statefile") is not None:
+        ratefile = os.path.join(os.path.dirname(opts["statefile"]), "vcd.ratelimit")
+    vcm = VCloudManager(opts["apiHost"], opts["org"], vdc, opts["verbose"],
+        timeout=task_timeout, vm_timeout=vm_timeout, session_ttl=ttl,
+        http_timeout=(10, timeout), retries=retries,
+        limiter=get_rate_limiter(opts, ratefile))
+    vcm.setup_session(opts["user"], opts["pass"], session)
 
     if "customize" in opts.keys():
         if opts["customize"].lower() == "true":
@@ -858,22 +1765,133 @@ def setup(opts):
         else:
             vcm.enable_customization(False)
 
+    if "powerOnDeploy" in opts.keys():
+        if opts["powerOnDeploy"].lower() == "false":
+            vcm.enable_power_on_deploy(False)
+
+    if "deleteRunning" in opts.keys():
+        if opts["deleteRunning"].lower() == "true":
+            vcm.enable_delete_running(True)
+
     return vcm
 
-def main():
-    opts = {}
+def teardown(opts, shards):
+    with Tracer.current().phase("teardown"):
+        save_state(opts, shards)
+    with MANAGER_LOCK:
+        MANAGER_POOL.setdefault(get_pool_key(opts), []).append(shards)
+
+def save_state(opts, shards):
+    # Persist anything worth keeping for the next invocation
+    state = StateFile(opts["statefile"])
+    saved = state.read()
+    created = {}
+    for shardOpts, vcm in shards:
+        created.update(vcm.get_creation_times())
+    update = { "hrefs": shards[0][1].get_hrefs(), "created": created,
+        "session": shards[0][1].get_session() }
+    if len(shards) > 1:
+        update["shards"] = {}
+        for shardOpts, vcm in shards[1:]:
+            key = shardOpts["vdc"] + "/" + shardOpts["vapp"]
+            update["shards"][key] = vcm.get_hrefs()
+    for key in update.keys():
+        if saved.get(key) == update[key]:
+            del update[key]
+    if len(update) > 0:
+        state.write(update)
+
+def get_socket_path(opts):
+    # One daemon per cloud credential, listening next to the state file
+    if "statefile" in opts.keys():
+        return os.path.splitext(opts["statefile"])[0] + ".sock"
+    if "cloudcreds" not in opts.keys():
+        return None
+    zh = find_zeus_home()
+    if zh is None:
+        return None
+    return zh + "/zxtm/internal/vcd." + opts["cloudcreds"] + ".sock"
 
-    # Read in the first argument or display the help
-    if len(sys.argv) < 2:
-        help()
-    else:
-        action = sys.argv[1]
 
-    # Process additional arguments
-    for arg in sys.argv:
+def start_vcd_daemon(opts, argv):
+    # Start a daemon in the background to serve the next request
+    if len(argv) < 2 or argv[1].lower() == "daemon":
+        return
+    start_daemon(get_socket_path(opts), os.path.abspath(__file__),
+        [arg for arg in argv[2:] if re.match("--(cloudcreds|cred1|statefile|idle)=", arg)])
+
+def run_daemon(opts):
+    path = get_socket_path(opts)
+    if path is None:
+        sys.stderr.write("ERROR - You must provide --cloudcreds or --statefile to run a daemon\n")
+        sys.exit(1)
+    idle = int(opts["idle"]) if "idle" in opts.keys() else 3600
+    DriverDaemon(path, run, idle).serve()
+
+def get_opts(argv):
+    opts = {}
+    for arg in argv:
         kvp = re.search("--([^=]+)=*(.*)", arg)
         if kvp != None:
             opts[kvp.group(1)] = kvp.group(2)
+    return opts
+
+def main(argv=None):
+    argv = sys.argv if argv is None else argv
+
+    # Requests are served by the daemon for this cloud credential if one is
+    # running, otherwise we do the work here. Profiled requests always run
+    # here, so the profile covers just this action, as do background status
+    # refreshes.
+    opts = get_opts(argv)
+    if len(argv) > 1 and argv[1].lower() not in ("daemon", "help") and \
+        get_profiler(opts) is None and "refresh" not in opts.keys():
+        code = forward_request(get_socket_path(opts), argv)
+        if code is not None:
+            sys.exit(code)
+    try:
+        run(argv, opts)
+    finally:
+        if str(opts.get("daemon", "")).lower() == "true":
+            start_vcd_daemon(opts, argv)
+
+def run(argv, opts=None):
+
+    # Process additional arguments
+    if opts is None:
+        opts = get_opts(argv)
+
+    # Every action is traced in memory. read_config() decides whether the
+    # trace is written out.
+    tracer = Tracer("vcd", argv[1].lower() if len(argv) > 1 else None)
+    Tracer.local.tracer = tracer
+    profiler = get_profiler(opts)
+    code = 1
+    try:
+        if profiler is not None:
+            profiler.start()
+        run_action(argv, opts)
+        code = 0
+    except SystemExit as e:
+        code = e.code if isinstance(e.code, int) or e.code is None else 1
+        raise
+    finally:
+        Tracer.local.tracer = None
+        tracer.finish(code or 0)
+        if profiler is not None:
+            profiler.stop()
+            try:
+                sys.stderr.write(profiler.report(get_profile_base(opts, get_state_base(opts))))
+            except (IOError, OSError) as e:
+                sys.stderr.write("ERROR - Failed to write profile: {}\n".format(e))
+
+def run_action(argv, opts):
+
+    # Read in the first argument or display the help
+    if len(argv) < 2:
+        help()
+    else:
+        action = argv[1]
 
     if "verbose" in opts.keys():
         opts["verbose"] = True
@@ -884,18 +1902,45 @@ def main():
     if action.lower() == "help":
         help()
     elif action.lower() == "status":
-        vcm = setup(opts)
-        nodes = get_status(opts, vcm)
-        print json.dumps({ "NodeStatusResponse":{ "version": 1, "code": 200, "nodes": nodes }})
+        read_config(opts)
+        cache = None
+        if "name" not in opts.keys():
+            cache = get_status_cache(opts, get_state_base(opts), os.path.abspath(__file__),
+                "vCloud API")
+        with StatusWriter(sys.stdout) as out:
+            if cache is None:
+                shards = setup(opts)
+                write_status(opts, shards, out)
+            else:
+                shards = write_cached_status(opts, argv, cache, out)
+        if len(shards) > 0:
+            teardown(opts, shards)
     elif action.lower() == "createnode":
-        vcm = setup(opts)
-        add_node(opts, vcm)
+        shards = setup(opts)
+        failed = add_node(opts, shards)
+        teardown(opts, shards)
+        if failed > 0:
+            sys.exit(1)
     elif action.lower() == "destroynode":
-        vcm = setup(opts)
-        del_node(opts, vcm)
+        shards = setup(opts)
+        del_node(opts, shards)
+        teardown(opts, shards)
+    elif action.lower() == "reconcile":
+        shards = setup(opts)
+        failed = reconcile(opts, shards)
+        teardown(opts, shards)
+        if failed > 0:
+            sys.exit(1)
     elif action.lower() == "get-vdc-info":
-        vcm = setup(opts)
-        get_vdc_info(opts, vcm)
+        read_config(opts)
+        if load_inventory(opts) is not None:
+            get_vdc_info(opts)
+        else:
+            shards = setup(opts)
+            get_vdc_info(opts, shards)
+            teardown(opts, shards)
+    elif action.lower() == "daemon":
+        run_daemon(opts)
     else:
         help()
 